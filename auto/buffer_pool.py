@@ -0,0 +1,72 @@
+import sys
+import numpy as np
+from collections import OrderedDict
+from os.path import join, dirname
+sys.path.append(join(dirname(__file__), '..'))
+
+"""
+Preallocated image buffers for the LKAS pipeline.
+"""
+
+
+class BufferPool:
+    """
+    Buffers keyed by (shape, dtype, stage) that Frame filters write into through OpenCV's dst= outputs,
+    so that frames of the same size stop allocating once the pool is warm.
+    A buffer is overwritten by the next frame, so outputs are only valid until then.
+    """
+
+    def __init__(self, max_buffers=32):
+        """
+        :param max_buffers: The number of buffers kept before the least recently used one is released.
+        """
+        self.max_buffers = max_buffers
+        self._buffers = OrderedDict()
+        self._ids = set()
+        self.requests = 0
+        self.allocations = 0
+
+    def get(self, shape, dtype, stage):
+        """
+        Gets the buffer for a stage, allocating it on first use.
+        :param stage: Identifies the pipeline stage, so that stages never share a buffer.
+        :return: An uninitialized array of the given shape and dtype.
+        """
+        key = (tuple(shape), np.dtype(dtype).str, stage)
+        self.requests += 1
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            buffer = np.empty(shape, dtype)
+            self.allocations += 1
+            self._buffers[key] = buffer
+            self._ids.add(id(buffer))
+            if len(self._buffers) > self.max_buffers:
+                _, evicted = self._buffers.popitem(last=False)
+                self._ids.discard(id(evicted))
+        else:
+            self._buffers.move_to_end(key)
+        return buffer
+
+    def owns(self, array):
+        return id(array) in self._ids
+
+    def clear(self):
+        self._buffers.clear()
+        self._ids.clear()
+
+    def stats(self):
+        """
+        :return: A dict of the buffer count and bytes held, requests, allocations and the share of requests reused.
+        """
+        return {
+            'buffers': len(self._buffers),
+            'bytes': sum(buffer.nbytes for buffer in self._buffers.values()),
+            'requests': self.requests,
+            'allocations': self.allocations,
+            'reuse_rate': 1 - self.allocations / self.requests if self.requests > 0 else 0.
+        }
+
+    def report(self):
+        stats = self.stats()
+        return 'Buffer pool: %d buffers (%.1f KB), %d requests, %d allocations, %.1f%% reused' % (
+            stats['buffers'], stats['bytes'] / 1024, stats['requests'], stats['allocations'], stats['reuse_rate'] * 100)
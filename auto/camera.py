@@ -1,49 +1,315 @@
 from cv2 import *
+import cv2
 import os, sys
 import numpy as np
-from os import mkdir, chdir
-from time import time, sleep
+from functools import partial
+from os import mkdir
+from time import time, sleep, perf_counter
+from threading import Thread, Condition
+from multiprocessing import Process, Event, Value, Condition as ProcessCondition
 from os.path import realpath, join, dirname, exists
 
 from util.timer import Timer
+from auto.frame_ring import FrameRing
+from auto.recorder import FrameWriter, get_writer, close_writer
+from auto.recording import EXTENSION, FLAG_DUPLICATE
+from auto.dedup import FrameDeduplicator
 
-cwd = os.getcwd()
+# Frames between recorder reports while recording frame by frame
+RECORD_REPORT_FRAMES = 100
+
+# Shape of the frames shared by the capture process. Frames of any other size are resized to it.
+CAMERA_SHAPE = (480, 640, 3)
+
+# Seconds to wait for the capture process to open the camera
+CAMERA_OPEN_S = 10
+
+# Seconds between attempts to open a camera that could not be opened
+CAMERA_RETRY_S = 1
 
-camera = VideoCapture(0)
 
 def reset_camera():
-    global camera
-    camera.release()
-    cv2.destroyAllWindows() 
+    """
+    Reloads the webcam driver. Only needed when the camera stops responding, as the device has to be closed first.
+    """
+    cv2.destroyAllWindows()
     os.system('sudo rmmod uvcvideo')
     os.system('sudo modprobe uvcvideo nodrop=1 timeout=10000 quirks=0x80')
-    camera = VideoCapture(0)
+
+
+class CameraGrabber:
+    """
+    Keeps the camera open and reads it continuously on a background thread, holding on to the latest frame only.
+    Frames buffered by the driver are read and dropped as they arrive, so consumers always get the freshest one.
+    """
+
+    def __init__(self, device=0, max_failures=30):
+        """
+        :param device: The VideoCapture device index.
+        :param max_failures: Consecutive failed reads before the driver is reloaded and the device reopened.
+        """
+        self.device = device
+        self.max_failures = max_failures
+        self._camera = None
+        self._thread = None
+        self._running = False
+        self._condition = Condition()
+        self._frame = None
+        self._timestamp = None
+        self._count = 0
+
+    def _open(self):
+        self._camera = cv2.VideoCapture(self.device)
+        # Keep as few frames as possible queued in the driver
+        self._camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        self._camera.set(cv2.CAP_PROP_FRAME_WIDTH, CAMERA_SHAPE[1])
+        self._camera.set(cv2.CAP_PROP_FRAME_HEIGHT, CAMERA_SHAPE[0])
+
+    @property
+    def is_running(self):
+        return self._running
+
+    def start(self):
+        if not self._running:
+            self._open()
+            if not self._camera.isOpened():
+                print("Camera not found")
+                return self
+            self._running = True
+            self._thread = Thread(target=self._grab, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._camera is not None:
+            self._camera.release()
+            self._camera = None
+
+    def _grab(self):
+        failures = 0
+        while self._running:
+            s, img = self._camera.read()
+            timestamp = time()
+            if not s:
+                failures += 1
+                if failures >= self.max_failures:
+                    print("Camera stopped responding, reloading the driver")
+                    self._camera.release()
+                    reset_camera()
+                    self._open()
+                    failures = 0
+                else:
+                    sleep(0.01)
+                continue
+            failures = 0
+            with self._condition:
+                self._frame = img
+                self._timestamp = timestamp
+                self._count += 1
+                self._condition.notify_all()
+
+    def latest(self):
+        """
+        Gets the latest frame without blocking.
+        :return: (image, capture timestamp in seconds since the epoch), or (None, None) before the first frame.
+        """
+        with self._condition:
+            return self._frame, self._timestamp
+
+    def wait(self, timeout=5):
+        """
+        Blocks until a frame newer than the current one arrives.
+        :return: (image, capture timestamp), or (None, None) on timeout.
+        """
+        with self._condition:
+            count = self._count
+            if not self._condition.wait_for(lambda: self._count > count, timeout):
+                return None, None
+            return self._frame, self._timestamp
+
+    @property
+    def frame_count(self):
+        return self._count
+
+
+class SharedCamera:
+    """
+    Reads the camera with a CameraGrabber in a single capture process and shares its latest frame through a FrameRing,
+    so that every process reads the same capture. A V4L2 device can only be opened once, so the frame by frame timers
+    of a Controller could not each open their own.
+    Processes forked after start() read from the ring, and their images are copies they are free to modify.
+    """
+
+    def __init__(self, device=0, shape=CAMERA_SHAPE, slots=3):
+        """
+        :param device: The VideoCapture device index.
+        :param shape: The shape of the shared frames.
+        :param slots: Frames in the ring, so that the capture process rarely waits on a reader.
+        """
+        self.device = device
+        self.ring = FrameRing(slots, shape)
+        self._latest = Value('l', -1)
+        self._count = Value('l', 0)
+        self._new_frame = ProcessCondition()
+        self._running = Value('b', 0)
+        self._opened = Event()
+        self._stop = Event()
+        self._process = None
+
+    def start(self):
+        """
+        Starts the capture process and waits for it to open the camera.
+        :return: self, which is not running if the camera could not be opened.
+        """
+        if not self.is_running:
+            self._opened.clear()
+            self._stop.clear()
+            self._process = Process(target=self._capture, daemon=True)
+            self._process.start()
+            self._opened.wait(CAMERA_OPEN_S)
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._process is not None:
+            self._process.join()
+            self._process = None
+
+    def close(self):
+        self.stop()
+        self.ring.close()
+
+    @property
+    def is_running(self):
+        return bool(self._running.value)
+
+    def _capture(self):
+        grabber = CameraGrabber(self.device).start()
+        self._running.value = grabber.is_running
+        self._opened.set()
+        if not grabber.is_running:
+            return
+        height, width = self.ring.shape[:2]
+        slot = 0
+        try:
+            while not self._stop.is_set():
+                img, timestamp = grabber.wait(timeout=0.1)
+                if img is None:
+                    continue
+                if img.shape != self.ring.shape:
+                    img = cv2.resize(img, (width, height))
+                slot = (slot + 1) % self.ring.slots
+                self.ring.write(slot, img, self._count.value + 1, timestamp)
+                with self._new_frame:
+                    self._latest.value = slot
+                    self._count.value += 1
+                    self._new_frame.notify_all()
+        finally:
+            self._running.value = 0
+            grabber.stop()
+
+    def latest(self):
+        """
+        Gets a copy of the latest frame without blocking.
+        :return: (image, capture timestamp in seconds since the epoch), or (None, None) before the first frame.
+        """
+        slot = self._latest.value
+        if slot < 0:
+            return None, None
+        img, _, timestamp, _ = self.ring.read(slot)
+        return img, timestamp
+
+    def wait(self, timeout=5):
+        """
+        Blocks until a frame newer than the current one arrives.
+        :return: (image, capture timestamp), or (None, None) on timeout or if the camera is not running.
+        """
+        if not self.is_running:
+            return None, None
+        with self._new_frame:
+            count = self._count.value
+            if not self._new_frame.wait_for(lambda: self._count.value > count or not self.is_running, timeout):
+                return None, None
+        return self.latest() if self.is_running else (None, None)
+
+    @property
+    def frame_count(self):
+        return self._count.value
+
+
+_grabber = None
+_grabber_pid = None
+_grabber_opened_at = None
+
+
+def get_grabber():
+    """
+    Gets the shared camera, starting its capture process on first use. Start it before forking any process that reads
+    the camera, as get_frame_by_frame does, so that they share it.
+    A camera that is not running, because it could not be opened or its capture process ended, is opened again once
+    CAMERA_RETRY_S have passed. Until then it returns no frames without waiting.
+    """
+    global _grabber, _grabber_pid, _grabber_opened_at
+    if _grabber is None or (not _grabber.is_running and perf_counter() - _grabber_opened_at >= CAMERA_RETRY_S):
+        # A forked process leaves its parent's camera to the parent
+        if _grabber is not None and _grabber_pid == os.getpid():
+            _grabber.close()
+        _grabber = SharedCamera().start()
+        _grabber_pid = os.getpid()
+        _grabber_opened_at = perf_counter()
+    return _grabber
+
+
+def get_latest_frame():
+    """
+    :return: (image, capture timestamp) of the freshest frame, waiting for the first one if the camera just opened.
+    """
+    grabber = get_grabber()
+    img, timestamp = grabber.latest()
+    if img is None:
+        img, timestamp = grabber.wait()
+    return img, timestamp
+
 
 def get_single_frame():
-    reset_camera()
-    s, img = camera.read()
+    img, _ = get_latest_frame()
     return img
 
-def get_frame_by_frame(name=None, fps=4, write_to_disk=False, display_feed=False, on_capture=None):
+def get_frame_by_frame(name=None, fps=4, write_to_disk=False, display_feed=False, on_capture=None, to_recording=False, dedup=None,
+                       source=None, directory=None):
     """
     Creates a timer that outputs a frame-by-frame set of images.
     :param name: The name of the frame by frame folder.
     :param fps: The frames per second.
     :param write_to_disk: Write the file to disk? Default false.
-    :param on_capture: Callback that passes in the most recent image as a parameter and returns a modified image.
-    :return: A Timer object.
+    :param on_capture: Callback that passes in the most recent image, and its capture time as the timestamp keyword,
+                       and returns a modified image, or (image, steering angle, motor speeds) so that recordings store
+                       what the car did with the frame.
+    :param to_recording: Write a .rec recording instead of a folder of PNGs.
+    :param dedup: A FrameDeduplicator that skips or marks near-duplicate frames before they are written.
+    :param source: Called by the timer's process, returns (image, capture timestamp) or (None, None). Defaults to the
+                   latest camera frame.
+    :param directory: The directory to write into. Defaults to train/data next to the script.
+    :return: A Timer object. Stopping it writes the frames still queued and closes the recording.
     """
 
-    reset_camera()
-
     if name is None:
         name = "fbf_" + str(int(time()))
+
+    if dedup is not None and dedup.mode == FrameDeduplicator.MARK and not to_recording:
+        raise Exception('Duplicates can only be marked in a recording.')
    
     dname = None
     if write_to_disk:
-        chdir(cwd)
-        dname = join(dirname(realpath(sys.argv[0])), "train", "data", name)
-        if not exists(dname):
+        directory = directory or join(dirname(realpath(sys.argv[0])), "train", "data")
+        dname = join(directory, name + (EXTENSION if to_recording else ""))
+        if to_recording:
+            print("Recording to: %s" % dname)
+        elif not exists(dname):
             print("Created dir: %s" % dname)
             mkdir(dname)
         else:
@@ -52,60 +318,91 @@ def get_frame_by_frame(name=None, fps=4, write_to_disk=False, display_feed=False
         print('Not writing to disk')
 
     def _snap(name, dname, write, display, capture_callback):
-        global camera
-        s, img = camera.read()
+        # Never blocks, and reads the camera the timer's process was forked with
+        img, timestamp = source() if source is not None else get_grabber().latest()
+        s = img is not None
 
+        # Hash the frame as captured, before the callback draws on it
+        flags = 0
+        if s and write and dedup is not None and dedup.is_duplicate(img):
+            flags = FLAG_DUPLICATE
+
+        steering, speeds = np.nan, None
         if s and capture_callback:
-            img = capture_callback(img)
+            img = capture_callback(img, timestamp=timestamp)
+            if isinstance(img, tuple):
+                img, steering, speeds = img
 
         if s and display:
             cv2.imshow(name, img)
             cv2.waitKey(1) 
 
         if write:
-            chdir(dname)
-            number_of_files = len([item for item in os.listdir(dname) if os.path.isfile(os.path.join(dname, item))])
-            path = "./" + str(number_of_files + 1) + ".png"
             if s:
-                imwrite(path, img)
-                print("Saved to " + dname + "/" + str(number_of_files + 1) + ".png")
+                # Drops the frame rather than slowing the capture down when the disk falls behind
+                writer = get_writer(dname)
+                if not (flags & FLAG_DUPLICATE and dedup.mode == FrameDeduplicator.SKIP):
+                    # The callback may hand back a buffer that is reused on the next frame
+                    writer.write(img, copy=capture_callback is not None, timestamp=timestamp, flags=flags, steering=steering, speeds=speeds)
+                captured = writer.submitted if dedup is None else dedup.kept + dedup.duplicates
+                if captured % RECORD_REPORT_FRAMES == 0:
+                    print(writer.report())
+                    if dedup is not None:
+                        print(dedup.report())
             else:
-                print("Could not read image %d from camera" % (number_of_files + 1))
-            chdir(cwd)
+                print("Could not read image from camera")
+
+    def _close(dname):
+        # The writer lives in the timer's process, so its queue is written out there before the process ends
+        writer = close_writer(dname)
+        if writer is not None:
+            print(writer.report())
 
-    return Timer(1 / fps, _snap, name, dname, write_to_disk, display_feed, on_capture).use_mp()
+    if source is None:
+        # Open the camera before the timer forks, so that it shares the capture with every other timer
+        get_grabber()
 
+    # A late frame is not worth capturing, so frames that miss their deadline are skipped
+    timer = Timer(1 / fps, _snap, name, dname, write_to_disk, display_feed, on_capture, policy=Timer.SKIP).use_mp()
+    if write_to_disk:
+        timer.on_stop(partial(_close, dname))
+    return timer
 
-def record_frame_by_frame(name=None, fps=4, duration_s=30):
-    global camera
 
-    reset_camera()
+def record_frame_by_frame(name=None, fps=4, duration_s=30, dedup=None):
+    """
+    Records a fixed number of frames to a folder of PNGs.
+    :param dedup: A FrameDeduplicator in SKIP mode that leaves near-duplicate frames out.
+    """
+    grabber = get_grabber()
 
     if name is None:
         name = "fbf_" + str(int(time()))
 
-    chdir(cwd)
     dname = join(dirname(realpath(sys.argv[0])), "train", "data", name)
     if not exists(dname):
         mkdir(dname)
-    chdir(dname)
 
-    file_num = len([item for item in os.listdir(dname) if os.path.isfile(os.path.join(dname, item))])
+    # Every frame of a fixed-length recording is kept, so wait for the disk instead of dropping
+    writer = FrameWriter(dname, block=True)
 
     num_frames = int(duration_s * fps)
     delay = 1 / fps
 
-    for _ in range(num_frames):
-        file_num += 1
-
-        s, img = camera.read()
-        path = "./" + str(file_num) + ".png"
-        if s:
-            imwrite(path, img)
-            print("Saved to " + dname + "/" + str(file_num) + ".png")
+    start = perf_counter()
+    for i in range(num_frames):
+        img, _ = grabber.wait()
+        if img is not None:
+            if dedup is None or not dedup.is_duplicate(img):
+                number = writer.write(img)
+                print("Queued " + dname + "/" + str(number) + ".png")
         else:
-            print("Could not read image %d from camera" % file_num)
+            print("Could not read image from camera")
 
-        cv2.waitKey(delay)
+        # Sleep until the next frame is due, however long this one took
+        sleep(max(0, start + (i + 1) * delay - perf_counter()))
 
-    chdir(cwd)
+    writer.close()
+    print(writer.report())
+    if dedup is not None:
+        print(dedup.report())
@@ -0,0 +1,152 @@
+import cv2
+import sys
+import numpy as np
+from collections import OrderedDict
+from colorsys import rgb_to_hsv
+from functools import lru_cache
+from os.path import join, dirname
+sys.path.append(join(dirname(__file__), '..'))
+
+"""
+Color mask engine for tape color detection.
+
+A (tape color, white balance) pair is compiled once into a quantized 3D BGR lookup table,
+which then maps raw BGR pixels straight to the binary mask without an HSV conversion.
+Quantization makes the mask approximate near the edges of the HSV range.
+
+The lookup is experimental and not meant for driving. It is slower than cvtColor + inRange (1.4 against 0.9 ms per
+frame on train_data_dark), and the approximate mask moves the steering angle on most frames. An exact table needs all
+2^24 colors, which is slower still to index, and the HSV range cannot be split into per-channel tables because the
+value is the max of B, G and R.
+"""
+
+
+class WhiteBalance:
+    DAYLIGHT = 0
+    CLOUDY = 1
+    INDOORS = 2
+    TUNGSTEN = 3
+    FLUORESCENT = 4
+
+
+def get_hsv_range(color, white_balance=WhiteBalance.INDOORS):
+    """
+    Derives the OpenCV HSV bounds that match the given tape color.
+    :param color: The RGB tape color.
+    :param white_balance: The WhiteBalance preset, or None for the default range.
+    :return: (lower, upper) HSV bounds.
+    """
+    return _get_hsv_range(tuple(color), white_balance)
+
+
+@lru_cache(maxsize=32)
+def _get_hsv_range(color, white_balance):
+    # Derive HSV range: (+- hue (degree), * saturation (scalar), * value (scalar))
+    hsv_range = [ [ -15, 15 ], [ 0.5, 1.8 ], [ 0.4, 1.5 ] ]
+    if white_balance == WhiteBalance.DAYLIGHT:
+        hsv_range = [ [ -5, 10 ], [ 0.8, 1.5 ], [ 0.8, 1.2 ] ]
+    elif white_balance == WhiteBalance.CLOUDY:
+        hsv_range = [ [ -5, 20 ], [ 0.6, 1.5 ], [ 0.6, 1.2 ] ]
+    elif white_balance == WhiteBalance.INDOORS:
+        hsv_range = [ [ -10, 20 ], [ 0.3, 1.2 ], [ 0.6, 1.2 ] ]
+    elif white_balance == WhiteBalance.TUNGSTEN:
+        hsv_range = [ [ -20, 20 ], [ 0.5, 1.5 ], [ 0.2, 1.5 ] ]
+    elif white_balance == WhiteBalance.FLUORESCENT:
+        hsv_range = [ [ -5, 5 ], [ 0.6, 1.2 ], [ 0.8, 1.2 ] ]
+
+    rgb = np.array(color) / 255.
+    hsv = rgb_to_hsv(*rgb)
+    hue = hsv[0] * 179
+    lower = np.array([ max(0, hue + hsv_range[0][0]), hsv[1]*255 * hsv_range[1][0], hsv[1]*255 * hsv_range[2][0] ], np.int)
+    upper = np.array([ min(179, hue + hsv_range[0][1]), min(255, hsv[1]*255 * hsv_range[1][1]), min(255, hsv[1]*255 * hsv_range[2][1]) ], np.int)
+    # print("initial: %d°, %d%%, %d%%" % (round(hsv[0]*360), round(hsv[1]*100), round(hsv[2]*100)))
+    # print("lower:   %d°, %d%%, %d%%" % (round(lower[0]*2), round(lower[1]/255*100), round(lower[2]/255*100)))
+    # print("upper:   %d°, %d%%, %d%%" % (round(upper[0]*2), round(upper[1]/255*100), round(upper[2]/255*100)))
+    return lower, upper
+
+
+class ColorMaskCache:
+    """
+    Keyed, evictable cache of compiled BGR -> mask lookup tables.
+    """
+
+    # Ranges of the B, G and R channels covered by the lookup table
+    RANGES = [0, 256, 0, 256, 0, 256]
+
+    def __init__(self, bins=64, max_entries=8):
+        """
+        :param bins: The number of quantization bins per channel. 64 bins keep 6 bits of each channel.
+        :param max_entries: The number of lookup tables kept before the least recently used one is evicted.
+        """
+        self.bins = bins
+        self.max_entries = max_entries
+        self._luts = OrderedDict()
+
+    @staticmethod
+    def _key(color, white_balance):
+        return tuple(int(c) for c in color), white_balance
+
+    def _compile(self, color, white_balance):
+        # Classify the center of every BGR bin in HSV space, exactly like the HSV pipeline would
+        step = 256 // self.bins
+        centers = np.arange(self.bins, dtype=np.uint8) * step + step // 2
+        b, g, r = np.meshgrid(centers, centers, centers, indexing='ij')
+        bgr = np.stack([b, g, r], axis=-1).reshape(-1, 1, 3)
+        hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV)
+        mask = cv2.inRange(hsv, *get_hsv_range(color, white_balance))
+        lut = mask.reshape(self.bins, self.bins, self.bins)
+        if hasattr(cv2, 'Mat'):
+            # Keep the last axis as a histogram dimension rather than 64 channels
+            return cv2.Mat(lut.astype(np.float32), wrap_channels=False)
+        return lut.ravel()
+
+    def get(self, color, white_balance=WhiteBalance.INDOORS):
+        """
+        Gets the lookup table for a tape color and white balance, compiling it on first use.
+        :return: A (bins, bins, bins) table of 0 or 255 indexed by quantized B, G, R, flattened on older OpenCV builds.
+        """
+        key = self._key(color, white_balance)
+        lut = self._luts.get(key)
+        if lut is None:
+            lut = self._compile(color, white_balance)
+            self._luts[key] = lut
+            if len(self._luts) > self.max_entries:
+                self._luts.popitem(last=False)
+        else:
+            self._luts.move_to_end(key)
+        return lut
+
+    def apply(self, bgr_img, color, white_balance=WhiteBalance.INDOORS, dst=None):
+        """
+        Maps a BGR image to the binary mask of the tape color.
+        :param dst: An optional single channel array to write the mask into.
+        :return: A single channel image of 0 or 255.
+        """
+        lut = self.get(color, white_balance)
+        if lut.ndim == 3:
+            return cv2.calcBackProject([bgr_img], [0, 1, 2], lut, ColorMaskCache.RANGES, 1, dst=dst)
+
+        # Older OpenCV builds cannot take a 3D histogram from Python, so index the table with NumPy
+        shift = 8 - int(np.log2(self.bins))
+        quantized = bgr_img >> shift
+        idx = quantized[:, :, 0].astype(np.intp)
+        idx <<= 2 * (8 - shift)
+        idx |= quantized[:, :, 1].astype(np.intp) << (8 - shift)
+        idx |= quantized[:, :, 2]
+        return lut.take(idx, out=dst)
+
+    def evict(self, color, white_balance=WhiteBalance.INDOORS):
+        self._luts.pop(self._key(color, white_balance), None)
+
+    def clear(self):
+        self._luts.clear()
+
+    def __contains__(self, key):
+        return self._key(*key) in self._luts
+
+    def __len__(self):
+        return len(self._luts)
+
+
+# Shared by every Frame in the process
+color_masks = ColorMaskCache()
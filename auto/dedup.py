@@ -0,0 +1,72 @@
+import cv2
+import sys
+import numpy as np
+from os.path import join, dirname
+sys.path.append(join(dirname(__file__), '..'))
+
+"""
+Near-duplicate frame detection for recording, using a difference hash (dHash) of each frame.
+"""
+
+
+def dhash(img, hash_size=8):
+    """
+    Hashes an image by whether each pixel of a tiny grayscale copy is brighter than its right neighbour.
+    Similar images get hashes that differ in few bits.
+    :param hash_size: The hash is hash_size * hash_size bits.
+    :return: The hash as an array of packed bits.
+    """
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    return np.packbits(small[:, 1:] > small[:, :-1])
+
+
+def hamming(a, b):
+    return int(np.unpackbits(np.bitwise_xor(a, b)).sum())
+
+
+class FrameDeduplicator:
+    """
+    Flags frames that barely differ from the last frame kept.
+    Comparing against the last kept frame rather than the previous one means a slow drift is still recorded.
+    """
+
+    SKIP = 'skip'
+    MARK = 'mark'
+
+    def __init__(self, threshold=4, hash_size=8, mode=SKIP):
+        """
+        :param threshold: Frames whose hash differs from the last kept frame's by fewer bits are duplicates.
+        :param hash_size: The hash is hash_size * hash_size bits.
+        :param mode: SKIP to leave duplicates out of the recording, MARK to record them flagged as duplicates.
+        """
+        if mode not in [FrameDeduplicator.SKIP, FrameDeduplicator.MARK]:
+            raise Exception('%s is not a valid dedup mode' % mode)
+        self.threshold = threshold
+        self.hash_size = hash_size
+        self.mode = mode
+        self.reset()
+
+    def reset(self):
+        self._last_hash = None
+        self.kept = 0
+        self.duplicates = 0
+
+    def is_duplicate(self, img):
+        """
+        Checks a frame against the last kept frame, keeping it if it changed enough.
+        :return: True if the frame is a near duplicate.
+        """
+        frame_hash = dhash(img, self.hash_size)
+        if self._last_hash is not None and hamming(frame_hash, self._last_hash) < self.threshold:
+            self.duplicates += 1
+            return True
+        self._last_hash = frame_hash
+        self.kept += 1
+        return False
+
+    def report(self):
+        total = self.kept + self.duplicates
+        action = 'dropped' if self.mode == FrameDeduplicator.SKIP else 'marked'
+        return 'Dedup: %d kept, %d %s (%.1f%% of %d frames)' % (
+            self.kept, self.duplicates, action, self.duplicates / total * 100 if total > 0 else 0., total)
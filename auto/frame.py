@@ -1,11 +1,15 @@
 import cv2
 import sys, os
 import numpy as np
-from colorsys import rgb_to_hsv
+from collections import deque
 from enum import Enum
+from functools import lru_cache
 from os.path import realpath, join, dirname, exists
+from time import perf_counter
 sys.path.append(join(dirname(__file__), '..'))
 
+from auto.color_mask import WhiteBalance, get_hsv_range, color_masks
+
 
 # Reference: https://towardsdatascience.com/deeppicar-part-4-lane-following-via-opencv-737dd9e47c96
 
@@ -18,85 +22,198 @@ class Filter(Enum):
     LANE_DETECTION = 5
     LINES = 6
     FLIP = 7
+    COLOR_LUT = 8
+    CROP = 9
 
 
 class Region(Enum):
+    """
+    Halves of the image. Filters that take a region also accept a polygon of (x, y) points in full-frame coordinates,
+    or a list of polygons with the same number of points.
+    """
     TOP = 0
     RIGHT = 1
     BOTTOM = 2
     LEFT = 3
 
 
-class WhiteBalance:
-    DAYLIGHT = 0
-    CLOUDY = 1
-    INDOORS = 2
-    TUNGSTEN = 3
-    FLUORESCENT = 4
+class FilterProfiler:
+    """
+    Rolling per-filter statistics of the layers computed by Frame.
+    While disabled, computing a layer costs a single attribute check.
+    Enable it with profiler.enable(), or by setting the LKAS_PROFILE environment variable.
+    """
+
+    PERCENTILES = [50, 95, 99]
+
+    def __init__(self, enabled=False, window=1024):
+        """
+        :param enabled: Record samples as layers are computed?
+        :param window: The number of most recent samples kept per filter.
+        """
+        self.enabled = enabled
+        self.window = window
+        self._samples = {}
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        self._samples = {}
+
+    def record(self, filter, seconds, output, output_data=None, reused=[]):
+        """
+        Records one run of a filter.
+        :param reused: Arrays that already existed before the filter ran, which are not counted as allocations.
+        """
+        nbytes = 0
+        allocations = 0
+        for value in [output, output_data]:
+            if isinstance(value, np.ndarray):
+                nbytes += value.nbytes
+                # Views such as crops share memory with their base
+                if value.base is None and not any(value is array for array in reused):
+                    allocations += 1
+        samples = self._samples.get(filter)
+        if samples is None:
+            samples = self._samples[filter] = deque(maxlen=self.window)
+        samples.append((seconds, nbytes, allocations))
+
+    def samples(self, filter):
+        """
+        :return: An (N, 3) array of (seconds, output bytes, allocations), oldest first.
+        """
+        return np.array(self._samples.get(filter, []), np.float64).reshape(-1, 3)
+
+    def stats(self):
+        """
+        :return: A dict from each recorded Filter to its sample count, wall time percentiles in ms,
+                 mean output size in bytes and mean allocation count.
+        """
+        stats = {}
+        for filter in self._samples:
+            samples = self.samples(filter)
+            if len(samples) == 0:
+                continue
+            percentiles = np.percentile(samples[:, 0] * 1000, FilterProfiler.PERCENTILES)
+            stats[filter] = {
+                'count': len(samples),
+                'ms': dict(zip(FilterProfiler.PERCENTILES, percentiles)),
+                'bytes': samples[:, 1].mean(),
+                'allocations': samples[:, 2].mean()
+            }
+        return stats
+
+    def report(self):
+        lines = [ '%-16s %6s %8s %8s %8s %10s %7s' % ('filter', 'n', 'p50 ms', 'p95 ms', 'p99 ms', 'out KB', 'allocs') ]
+        for filter, stats in sorted(self.stats().items(), key=lambda item: item[0].value):
+            ms = stats['ms']
+            lines.append('%-16s %6d %8.2f %8.2f %8.2f %10.1f %7.2f' % (filter.name, stats['count'], ms[50], ms[95], ms[99],
+                                                                       stats['bytes'] / 1024, stats['allocations']))
+        return '\n'.join(lines)
+
+
+# Shared by every Frame in the process
+profiler = FilterProfiler(enabled=bool(os.getenv('LKAS_PROFILE')))
 
 
 class Frame:
     """
     Wrapper around CV2 image for image processing and lane detection.
+
+    Filters are declared with add() and only run when a layer is requested through get(), top() or show().
+    Outputs are memoized, and replacing a layer invalidates the layers that depend on it.
     """
 
-    def __init__(self, img_or_path, name="Frame"):
+    def __init__(self, img_or_path, name="Frame", headless=False, pool=None, draw=None):
+        """
+        :param img_or_path: A CV2 image or a path to one.
+        :param name: The window name used by show().
+        :param headless: Drive mode. Only the source image and the latest computed layer are kept, and no overlays are drawn.
+        :param pool: A BufferPool that filters write their outputs into instead of allocating.
+        :param draw: Whether to draw detected lines over the overlay layers. Defaults to not headless.
+        """
         img, path = self._load_img(img_or_path)
         self._outputs = [img]
         self._output_data = [None]
         self._filters = [None]
+        # Keyword arguments each layer was declared with
+        self._params = [None]
+        self._computed = [True]
+        # (x, y) of each layer's top-left corner in the source image, moved by CROP
+        self._offsets = [(0, 0)]
         self._name = name
         self._path = path
+        self._headless = headless
+        self._pool = pool
+        self._draw = not headless if draw is None else draw
 
     def add(self, filter, replace_idx=None, bounds=(200, 400), region=Region.BOTTOM, overlay_layer=0, lines=[],
-            color=(0, 0, 0), flip_horizontal=True, white_balance=WhiteBalance.INDOORS):
-        if replace_idx is None:
-            _input, input_data, prev_filter = self.top()
-        else:
-            _input, input_data, prev_filter = self.get(max(0, replace_idx))
-
-        output = None
-        output_data = None
-        if filter == Filter.HSV:
-            output = self._filter_hsv(_input)
-        elif filter == Filter.COLOR_DETECT:
-            output = self._filter_color_detect(_input, color, white_balance)
-        elif filter == Filter.EDGE_DETECTION:
-            output = self._filter_edge_detection(_input, bounds)
-        elif filter == Filter.REGION_ISO:
-            output = self._filter_region_isolation(_input, region)
-        elif filter == Filter.LINE_DETECTION:
-            output, output_data = self._filter_line_detection(_input, self._outputs[overlay_layer])
-        elif filter == Filter.LANE_DETECTION:
-            if prev_filter != Filter.LINE_DETECTION:
-                if replace_idx:
-                    raise Exception('Cannot replace layer with Lane Detection if previous layer is not a Line Detection layer.')
-                _input, input_data, prev_filter = self.add(Filter.LINE_DETECTION)
-            output, output_data = self._filter_lane_detection(_input, input_data, self._outputs[overlay_layer])
-        elif filter == Filter.LINES:
-            output = self._draw_lines(_input, lines, color)
-        elif filter == Filter.FLIP:
-            output = self._filter_flip(_input, flip_horizontal)
-        else:
+            color=(0, 0, 0), flip_horizontal=True, white_balance=WhiteBalance.INDOORS, margin=0, hough=(10, 4, 4)):
+        """
+        Declares a filter on top of the previous layer, or in place of an existing layer.
+        :return: The index of the layer.
+        """
+        if not isinstance(filter, Filter):
             raise Exception("%s is not a valid Filter" % filter)
 
-        if replace_idx is not None:
-            self._outputs[replace_idx] = output
-            self._output_data[replace_idx] = output_data
-            self._filters[replace_idx] = filter
-        else:
-            self._outputs.append(output)
-            self._output_data.append(output_data)
+        idx = len(self._filters) if replace_idx is None else self._index(replace_idx)
+        overlay_layer = self._index(overlay_layer)
+        if idx == 0:
+            raise Exception('Cannot replace the source image.')
+
+        if filter == Filter.LANE_DETECTION and self._filters[idx - 1] != Filter.LINE_DETECTION:
+            if replace_idx is not None:
+                raise Exception('Cannot replace layer with Lane Detection if previous layer is not a Line Detection layer.')
+            self.add(Filter.LINE_DETECTION)
+            idx += 1
+
+        params = {
+            'bounds': bounds,
+            'region': region,
+            'overlay_layer': overlay_layer,
+            'lines': lines,
+            'color': color,
+            'flip_horizontal': flip_horizontal,
+            'white_balance': white_balance,
+            'margin': margin,
+            'hough': hough
+        }
+
+        if replace_idx is None:
+            self._outputs.append(None)
+            self._output_data.append(None)
             self._filters.append(filter)
+            self._params.append(params)
+            self._computed.append(False)
+            self._offsets.append(None)
+        else:
+            self._filters[idx] = filter
+            self._params[idx] = params
+            self._invalidate(idx)
 
-        return output, output_data, filter
+        return idx
 
     def replace(self, idx, filter, **kwargs):
-        self.add(filter, replace_idx=idx, **kwargs)
+        return self.add(filter, replace_idx=idx, **kwargs)
 
     def get(self, idx):
+        idx = self._index(idx)
+        self._compute(idx)
         return self._outputs[idx], self._output_data[idx], self._filters[idx]
 
+    def layer_of(self, filter):
+        """
+        :return: The index of the last layer of the filter, or None if the frame has none.
+        """
+        for idx in reversed(range(len(self._filters))):
+            if self._filters[idx] == filter:
+                return idx
+        return None
+
     def bottom(self):
         return self.get(0)
 
@@ -104,10 +221,105 @@ class Frame:
         return self.get(-1)
 
     def show(self, stage_idx=-1, wait_key=0):
-        output = self._outputs[stage_idx]
+        output, _, _ = self.get(stage_idx)
         cv2.imshow(self._name, output)
         cv2.waitKey(wait_key)
 
+    def _index(self, idx):
+        return idx + len(self._filters) if idx < 0 else idx
+
+    def _dependencies(self, idx):
+        filter, params = self._filters[idx], self._params[idx]
+        dependencies = [ idx - 1 ]
+        if filter in [Filter.LINE_DETECTION, Filter.LANE_DETECTION] and self._draw:
+            dependencies.append(params['overlay_layer'])
+        return dependencies
+
+    def _invalidate(self, idx):
+        """
+        Clears a layer and every layer computed from it.
+        """
+        invalid = { idx }
+        for i in range(idx + 1, len(self._filters)):
+            if any(dependency in invalid for dependency in self._dependencies(i)):
+                invalid.add(i)
+        for i in invalid:
+            self._outputs[i] = None
+            self._output_data[i] = None
+            self._computed[i] = False
+
+    def _compute(self, idx):
+        if self._computed[idx]:
+            return
+        for dependency in self._dependencies(idx):
+            self._compute(dependency)
+
+        if profiler.enabled:
+            start = perf_counter()
+            output, output_data, offset = self._apply(idx)
+            elapsed = perf_counter() - start
+            # Outputs handed through from another layer or taken from the pool were not allocated by this filter
+            reused = [ self._outputs[idx - 1], self._outputs[0] ]
+            if self._pool is not None and self._pool.owns(output):
+                reused.append(output)
+            profiler.record(self._filters[idx], elapsed, output, output_data, reused)
+        else:
+            output, output_data, offset = self._apply(idx)
+
+        self._outputs[idx] = output
+        self._output_data[idx] = output_data
+        self._offsets[idx] = offset
+        self._computed[idx] = True
+
+        # Drop the superseded intermediate layer, keeping the source image. It is recomputed if requested again.
+        if self._headless and idx > 1:
+            self._outputs[idx - 1] = None
+            self._output_data[idx - 1] = None
+            self._computed[idx - 1] = False
+
+    def _apply(self, idx):
+        """
+        Runs the filter of a layer on the layer below it.
+        :return: (output, output data, offset)
+        """
+        _input, input_data, offset = self._outputs[idx - 1], self._output_data[idx - 1], self._offsets[idx - 1]
+        filter, params = self._filters[idx], self._params[idx]
+
+        # Frames that never draw use the source image in place of every overlay
+        draw = self._draw
+        overlay = self._outputs[params['overlay_layer'] if draw else 0]
+        full_shape = self._outputs[0].shape
+
+        def dst(shape):
+            # Pooled buffer for this layer's output, or None to let the filter allocate
+            return None if self._pool is None else self._pool.get(shape, np.uint8, idx)
+
+        output = None
+        output_data = None
+        if filter == Filter.HSV:
+            output = self._filter_hsv(_input, dst(_input.shape))
+        elif filter == Filter.COLOR_DETECT:
+            output = self._filter_color_detect(_input, params['color'], params['white_balance'], dst(_input.shape[:2]))
+        elif filter == Filter.EDGE_DETECTION:
+            output = self._filter_edge_detection(_input, params['bounds'], dst(_input.shape))
+        elif filter == Filter.REGION_ISO:
+            output = self._filter_region_isolation(_input, params['region'], offset, full_shape, dst(_input.shape))
+        elif filter == Filter.LINE_DETECTION:
+            output, output_data = self._filter_line_detection(_input, overlay, draw, offset, dst(overlay.shape) if draw else None, params['hough'])
+        elif filter == Filter.LANE_DETECTION:
+            output, output_data = self._filter_lane_detection(_input, input_data, overlay, draw, dst(overlay.shape) if draw else None)
+        elif filter == Filter.LINES:
+            output = self._draw_lines(_input, params['lines'], params['color'], dst(_input.shape)) if draw else _input
+        elif filter == Filter.FLIP:
+            output = self._filter_flip(_input, params['flip_horizontal'], dst(_input.shape))
+        elif filter == Filter.COLOR_LUT:
+            output = self._filter_color_lut(_input, params['color'], params['white_balance'], dst(_input.shape[:2]))
+        elif filter == Filter.CROP:
+            output, output_data = self._filter_crop(_input, params['region'], offset, full_shape, params['margin'])
+            offset = (offset[0] + output_data[0], offset[1] + output_data[1])
+
+        return output, output_data, offset
+
     @staticmethod
     def _load_img(img_or_path):
         if isinstance(img_or_path, str):
@@ -122,70 +334,109 @@ class Frame:
         return image, path
 
     @staticmethod
-    def _filter_hsv(_input):
-        return cv2.cvtColor(_input, cv2.COLOR_BGR2HSV)
+    def _filter_hsv(_input, dst=None):
+        return cv2.cvtColor(_input, cv2.COLOR_BGR2HSV, dst=dst)
 
     @staticmethod
-    def _filter_color_detect(_input, color, white_balance=WhiteBalance.INDOORS):
-
-        # Derive HSV range: (+- hue (degree), * saturation (scalar), * value (scalar))
-        hsv_range = [ [ -15, 15 ], [ 0.5, 1.8 ], [ 0.4, 1.5 ] ]
-        if white_balance == WhiteBalance.DAYLIGHT:
-            hsv_range = [ [ -5, 10 ], [ 0.8, 1.5 ], [ 0.8, 1.2 ] ]
-        elif white_balance == WhiteBalance.CLOUDY:
-            hsv_range = [ [ -5, 20 ], [ 0.6, 1.5 ], [ 0.6, 1.2 ] ]
-        elif white_balance == WhiteBalance.INDOORS:
-            hsv_range = [ [ -10, 20 ], [ 0.3, 1.2 ], [ 0.6, 1.2 ] ]
-        elif white_balance == WhiteBalance.TUNGSTEN:
-            hsv_range = [ [ -20, 20 ], [ 0.5, 1.5 ], [ 0.2, 1.5 ] ]
-        elif white_balance == WhiteBalance.FLUORESCENT:
-            hsv_range = [ [ -5, 5 ], [ 0.6, 1.2 ], [ 0.8, 1.2 ] ]
-
-        def get_color_range(rgb):
-            rgb = np.array(rgb) / 255.
-            hsv = rgb_to_hsv(*rgb)
-            hue = hsv[0] * 179
-            lower = np.array([ max(0, hue + hsv_range[0][0]), hsv[1]*255 * hsv_range[1][0], hsv[1]*255 * hsv_range[2][0] ], np.int)
-            upper = np.array([ min(179, hue + hsv_range[0][1]), min(255, hsv[1]*255 * hsv_range[1][1]), min(255, hsv[1]*255 * hsv_range[2][1]) ], np.int)
-            # print("initial: %d°, %d%%, %d%%" % (round(hsv[0]*360), round(hsv[1]*100), round(hsv[2]*100)))
-            # print("lower:   %d°, %d%%, %d%%" % (round(lower[0]*2), round(lower[1]/255*100), round(lower[2]/255*100)))
-            # print("upper:   %d°, %d%%, %d%%" % (round(upper[0]*2), round(upper[1]/255*100), round(upper[2]/255*100)))
-            return lower, upper
-
-        range = get_color_range(color)
-        output = cv2.inRange(_input, *range)
+    def _filter_color_detect(_input, color, white_balance=WhiteBalance.INDOORS, dst=None):
+        range = get_hsv_range(color, white_balance)
+        output = cv2.inRange(_input, *range, dst=dst)
         return output
 
     @staticmethod
-    def _filter_edge_detection(_input, bounds):
-        return cv2.Canny(_input, *bounds)
+    def _filter_color_lut(_input, color, white_balance=WhiteBalance.INDOORS, dst=None):
+        # Approximately the mask of HSV + COLOR_DETECT, straight from the BGR image
+        return color_masks.apply(_input, color, white_balance, dst)
 
     @staticmethod
-    def _filter_region_isolation(_input, isolated_region):
-        height, width = _input.shape
-        mask = np.zeros_like(_input)
+    def _filter_edge_detection(_input, bounds, dst=None):
+        return cv2.Canny(_input, *bounds, edges=dst)
 
-        if isolated_region == Region.TOP:
+    @staticmethod
+    def _region_edges(shape, region):
+        height, width = shape[:2]
+
+        if region == Region.TOP:
             edges = [(0, 0), (width, 0), (width, height / 2), (0, height / 2)]
-        elif isolated_region == Region.RIGHT:
+        elif region == Region.RIGHT:
             edges = [(width / 2, 0), (width, 0), (width, height), (width / 2, height)]
-        elif isolated_region == Region.BOTTOM:
+        elif region == Region.BOTTOM:
             edges = [(0, height / 2), (width, height / 2), (width, height), (0, height)]
-        else:
+        elif region == Region.LEFT:
             edges = [(0, 0), (width / 2, 0), (width / 2, height), (0, height)]
+        else:
+            edges = np.array(region, np.int32)
+            # A list of polygons is already a batch of them
+            return edges if edges.ndim == 3 else edges[np.newaxis]
+
+        return np.array([edges], np.int32)
 
-        edges = np.array([edges], np.int32)
-        cv2.fillPoly(mask, edges, 255)
+    @staticmethod
+    def _region_mask(shape, full_shape, region, offset=(0, 0)):
+        """
+        Builds the mask of a region over a window of the source image.
+        :param shape: The shape of the window.
+        :param full_shape: The shape of the source image.
+        :param offset: The (x, y) of the window within the source image.
+        """
+        mask = np.zeros(shape[:2], np.uint8)
+        cv2.fillPoly(mask, Frame._region_edges(full_shape, region) - np.array(offset, np.int32), 255)
+        return mask
+
+    @staticmethod
+    @lru_cache(maxsize=16)
+    def _half_mask(shape, full_shape, region, offset=(0, 0)):
+        """
+        The mask of a Region, which is the same on every frame, unlike the polygons of search bands.
+        """
+        mask = Frame._region_mask(shape, full_shape, region, offset)
+        mask.flags.writeable = False
+        return mask
+
+    @staticmethod
+    def _region_rect(shape, region):
+        height, width = shape[:2]
+        x, y, w, h = cv2.boundingRect(Frame._region_edges(shape, region).reshape(-1, 2))
+        x, y = max(0, x), max(0, y)
+        return x, y, min(w, width - x), min(h, height - y)
 
-        return cv2.bitwise_and(_input, mask)
+    @staticmethod
+    def _filter_crop(_input, region, offset=(0, 0), full_shape=None, margin=0):
+        """
+        Slices a view of the bounding box of the region, so later filters only touch those pixels.
+        :param margin: Pixels of context kept around the bounding box.
+        :return: The view and its (x, y) offset within the input.
+        """
+        full_shape = full_shape or _input.shape
+        x, y, w, h = Frame._region_rect(full_shape, region)
+        x, y = max(0, x - margin), max(0, y - margin)
+        w, h = min(full_shape[1] - x, w + 2 * margin), min(full_shape[0] - y, h + 2 * margin)
+        # The region is in source image coordinates, the input may already be cropped
+        x1, y1 = max(0, x - offset[0]), max(0, y - offset[1])
+        x2, y2 = max(x1, x + w - offset[0]), max(y1, y + h - offset[1])
+        return _input[y1:y2, x1:x2], (x1, y1)
+
+    @staticmethod
+    def _filter_region_isolation(_input, isolated_region, offset=(0, 0), full_shape=None, dst=None):
+        full_shape = full_shape or _input.shape
+        if isinstance(isolated_region, Region):
+            mask = Frame._half_mask(_input.shape[:2], tuple(full_shape[:2]), isolated_region, tuple(offset))
+        else:
+            # Polygons move from frame to frame, and filling one over its cropped window is cheap
+            mask = Frame._region_mask(_input.shape[:2], full_shape, isolated_region, offset)
+        return cv2.bitwise_and(_input, mask, dst=dst)
 
     @staticmethod
-    def _filter_flip(_input, flip_horizontal):
-        return cv2.flip(_input, 1 if flip_horizontal else 0)
+    def _filter_flip(_input, flip_horizontal, dst=None):
+        return cv2.flip(_input, 1 if flip_horizontal else 0, dst=dst)
 
     @staticmethod
-    def _draw_lines(frame, lines, color):
-        output = frame.copy()
+    def _draw_lines(frame, lines, color, dst=None):
+        if dst is None:
+            output = frame.copy()
+        else:
+            output = dst
+            np.copyto(output, frame)
         if lines is None:
             lines = []
         for line in lines:
@@ -194,36 +445,61 @@ class Frame:
         return output
 
     @staticmethod
-    def _filter_line_detection(_input, output):
-        lines = cv2.HoughLinesP(_input, 1, np.pi / 180, 10, np.array([]), minLineLength=4, maxLineGap=4)
-        output = Frame._draw_lines(output, lines, (50, 205, 50))
+    def _filter_line_detection(_input, output, draw=True, offset=(0, 0), dst=None, hough=(10, 4, 4)):
+        """
+        :param hough: (accumulator threshold, minimum line length, maximum line gap) of the probabilistic Hough transform.
+        """
+        threshold, min_line_length, max_line_gap = hough
+        lines = cv2.HoughLinesP(_input, 1, np.pi / 180, threshold, np.array([]), minLineLength=min_line_length, maxLineGap=max_line_gap)
+        if lines is not None and offset != (0, 0):
+            # Map the lines from the cropped input back to the source image
+            lines += np.array(offset * 2, np.int32)
+        if draw:
+            output = Frame._draw_lines(output, lines, (50, 205, 50), dst)
         return output, lines
 
     @staticmethod
-    def _filter_lane_detection(_input, lines, output):
-        lane_lines = []
-        if lines is None:
-            return _input, lane_lines
-
-        _, width, _ = _input.shape
-        left_fit = []
-        right_fit = []
+    def _polyfit_segments(x1, y1, x2, y2):
+        """
+        Fits a line through each segment in closed form. The fits agree with np.polyfit((x1, x2), (y1, y2), 1) to a
+        relative or absolute 1e-9, though not bit for bit. Horizontal segments get a slope of exactly 0, where
+        np.polyfit gives them +-epsilon of rounding noise, so they count towards neither lane.
+        :return: The (K, 2) array of (slope, intercept).
+        """
+        run = x2 - x1
+        return np.stack([(y2 - y1) / run, (x2 * y1 - x1 * y2) / run], axis=1)
 
+    @staticmethod
+    def _fit_lane_segments(lines, width):
+        """
+        Fits every Hough segment at once and sorts the fits into the left and right lanes.
+        :param lines: The (N, 1, 4) array of segments from HoughLinesP.
+        :param width: The width of the image.
+        :return: (left fits, right fits), each a (K, 2) array of (slope, intercept).
+        """
         boundary = 1 / 3
         left_region_boundary = width * (1 - boundary)
         right_region_boundary = width * boundary
 
-        for line in lines:
-            for x1, y1, x2, y2 in line:
-                if x1 == x2:
-                    continue
-                fit = np.polyfit((x1, x2), (y1, y2), 1)
-                slope = fit[0]
-                intercept = fit[1]
-                if slope < 0 and x1 < left_region_boundary and x2 < left_region_boundary:
-                    left_fit.append((slope, intercept))
-                elif slope > 0 and x1 > right_region_boundary and x2 > right_region_boundary:
-                    right_fit.append((slope, intercept))
+        segments = lines.reshape(-1, 4).astype(np.float64)
+        # Vertical segments have no slope
+        segments = segments[segments[:, 0] != segments[:, 2]]
+        x1, y1, x2, y2 = segments.T
+        fits = Frame._polyfit_segments(x1, y1, x2, y2)
+        slope = fits[:, 0]
+
+        is_left = (slope < 0) & (x1 < left_region_boundary) & (x2 < left_region_boundary)
+        is_right = (slope > 0) & (x1 > right_region_boundary) & (x2 > right_region_boundary)
+        return fits[is_left], fits[is_right]
+
+    @staticmethod
+    def _filter_lane_detection(_input, lines, output, draw=True, dst=None):
+        lane_lines = []
+        if lines is None:
+            return _input, lane_lines
+
+        _, width, _ = _input.shape
+        left_fit, right_fit = Frame._fit_lane_segments(lines, width)
 
         def lines_intersect(a1, a2, b1, b2):
             det = (a2[0] - a1[0]) * (b2[1] - b1[1]) - (b2[0] - b1[0]) * (a2[1] - a1[1])
@@ -273,6 +549,7 @@ class Frame:
                     right_confident = abs(left_slope) < abs(right_slope) and right_len > left_len
                     del lane_lines[0 if right_confident else 1]
 
-        output = Frame._draw_lines(output, lane_lines, (0, 255, 255))
+        if draw:
+            output = Frame._draw_lines(output, lane_lines, (0, 255, 255), dst)
 
         return output, lane_lines
@@ -0,0 +1,105 @@
+import sys
+import numpy as np
+from multiprocessing import Lock, shared_memory
+from os.path import join, dirname
+sys.path.append(join(dirname(__file__), '..'))
+
+"""
+Shared memory ring of fixed-size frames, for handing images between processes without pickling them.
+"""
+
+# Per-slot header
+SLOT_DTYPE = np.dtype([
+    ('seq', '<i8'),
+    ('timestamp', '<f8'),
+    ('angle', '<f8')
+])
+
+
+class FrameRing:
+    """
+    A block of shared memory holding a header and a frame per slot.
+    Processes only exchange slot indices. A slot's owner writes it with write() and readers copy it out with read().
+
+    Each slot has a lock that write(), publish() and read() hold, so a reader never sees a header without the frame
+    that was written with it. Plain stores to shared memory carry no ordering between processes, and on ARM a reader
+    could otherwise see a new seq before the pixels. Taking the lock is a full memory barrier on both sides.
+    """
+
+    def __init__(self, slots, shape, dtype=np.uint8, name=None, locks=None):
+        """
+        :param slots: The number of frames in the ring.
+        :param shape: The shape of every frame.
+        :param name: The name of an existing ring to attach to, or None to create a new one.
+        :param locks: The slot locks of the existing ring.
+        """
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        header_bytes = SLOT_DTYPE.itemsize * slots
+        frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self._owner = name is None
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=header_bytes + frame_bytes * slots)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self.name = self._shm.name
+        self._locks = locks if locks is not None else [ Lock() for _ in range(slots) ]
+        self.headers = np.ndarray((slots,), SLOT_DTYPE, self._shm.buf, 0)
+        self.frames = np.ndarray((slots,) + self.shape, self.dtype, self._shm.buf, header_bytes)
+        if self._owner:
+            self.headers[:] = 0
+
+    def __reduce__(self):
+        # Processes attach to the same block by name rather than pickling the frames. Like any multiprocessing lock,
+        # the slot locks can only be handed to a process as it is started.
+        return FrameRing, (self.slots, self.shape, self.dtype, self.name, self._locks)
+
+    def frame(self, slot):
+        """
+        :return: A writable view of a slot's frame.
+        """
+        return self.frames[slot]
+
+    def write(self, slot, img, seq, timestamp, angle=np.nan):
+        """
+        Copies a frame and its header into a slot.
+        """
+        with self._locks[slot]:
+            np.copyto(self.frames[slot], img)
+            self._set_header(slot, seq, timestamp, angle)
+
+    def publish(self, slot, seq, timestamp, angle=np.nan):
+        """
+        Updates the header of a slot whose frame was written in place through frame(). Releasing the lock makes the
+        frame visible along with the header.
+        """
+        with self._locks[slot]:
+            self._set_header(slot, seq, timestamp, angle)
+
+    def _set_header(self, slot, seq, timestamp, angle):
+        header = self.headers[slot:slot + 1]
+        header['seq'] = seq
+        header['timestamp'] = timestamp
+        header['angle'] = angle
+
+    def read(self, slot, out=None):
+        """
+        Copies a slot out consistently, waiting while it is being written.
+        :param out: An optional array to copy the frame into.
+        :return: (frame, seq, timestamp, angle).
+        """
+        if out is None:
+            out = np.empty(self.shape, self.dtype)
+        with self._locks[slot]:
+            np.copyto(out, self.frames[slot])
+            header = self.headers[slot].copy()
+        return out, int(header['seq']), float(header['timestamp']), float(header['angle'])
+
+    def close(self):
+        # Views must be released before the block can be closed
+        self.headers = None
+        self.frames = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
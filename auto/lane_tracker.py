@@ -0,0 +1,143 @@
+import sys
+import numpy as np
+from os.path import join, dirname
+sys.path.append(join(dirname(__file__), '..'))
+
+"""
+Temporal lane tracking for the Lane Keeping Assist System (LKAS)
+"""
+
+LEFT = 0
+RIGHT = 1
+
+
+class _LaneFilter:
+    """
+    Kalman filter over one lane line, tracked as the x of its bottom and middle points.
+    Unlike (slope, intercept), these stay well conditioned for near vertical lanes.
+    """
+
+    def __init__(self, measurement, process_noise, measurement_noise):
+        self.x = np.array(measurement, np.float64)
+        self.P = np.eye(2) * measurement_noise
+        self.Q = np.eye(2) * process_noise
+        self.R = np.eye(2) * measurement_noise
+        self.hits = 1
+        self.misses = 0
+
+    def predict(self):
+        # The lanes are assumed to stay put between frames, so only the uncertainty grows
+        self.P = self.P + self.Q
+
+    def update(self, measurement):
+        K = self.P @ np.linalg.inv(self.P + self.R)
+        self.x = self.x + K @ (np.array(measurement, np.float64) - self.x)
+        self.P = (np.eye(2) - K) @ self.P
+        self.hits += 1
+        self.misses = 0
+
+    def miss(self):
+        self.hits = 0
+        self.misses += 1
+
+
+class LaneTracker:
+    """
+    Tracks the left and right lanes across frames so that the search can be narrowed to a band around each lane.
+    """
+
+    def __init__(self, margin=40, min_hits=3, max_misses=2, full_search_every=15, process_noise=25., measurement_noise=100.):
+        """
+        :param margin: Half the width of the search band around a tracked lane, in pixels.
+        :param min_hits: Consecutive detections before a lane is searched for in its band only.
+        :param max_misses: Consecutive frames a lane may go undetected before it is dropped.
+        :param full_search_every: Frames between full-frame searches, which pick up lanes that are not tracked.
+        :param process_noise: How far the lanes are expected to move between frames, as a variance in pixels.
+        :param measurement_noise: How noisy the detected lanes are, as a variance in pixels.
+        """
+        self.margin = margin
+        self.min_hits = min_hits
+        self.max_misses = max_misses
+        self.full_search_every = full_search_every
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.reset()
+
+    def reset(self):
+        self._lanes = [None, None]
+        self._frames_since_full_search = 0
+        self._full_search = True
+
+    def is_confident(self):
+        """
+        :return: True if the next frame only needs to be searched around the tracked lanes.
+        """
+        if self._full_search or self._frames_since_full_search >= self.full_search_every:
+            return False
+        tracked = [ lane for lane in self._lanes if lane is not None ]
+        return len(tracked) > 0 and all(lane.hits >= self.min_hits for lane in tracked)
+
+    def search_bands(self, shape):
+        """
+        Gets the regions to search on the next frame.
+        :param shape: The shape of the image.
+        :return: A polygon around each tracked lane, or None if the whole region has to be searched.
+        """
+        if not self.is_confident():
+            return None
+
+        height, width = shape[:2]
+        bands = []
+        for lane in self._lanes:
+            if lane is None:
+                continue
+            x_bottom, x_middle = lane.x
+            # A band that leaves the image cannot be searched
+            if max(x_bottom, x_middle) + self.margin < 0 or min(x_bottom, x_middle) - self.margin > width:
+                return None
+            bands.append([
+                (int(x_bottom - self.margin), height),
+                (int(x_bottom + self.margin), height),
+                (int(x_middle + self.margin), int(height / 2)),
+                (int(x_middle - self.margin), int(height / 2))
+            ])
+        return bands
+
+    def update(self, lane_lines, shape, searched_bands=False):
+        """
+        Updates the tracked lanes with the lanes detected in a frame.
+        :param lane_lines: The lane lines from lane detection.
+        :param shape: The shape of the image.
+        :param searched_bands: True if only the search bands were searched.
+        :return: The tracked lane lines, left first.
+        """
+        height = shape[0]
+        measurements = [None, None]
+        for line in lane_lines:
+            x1, _, x2, _ = line[0]
+            # The left lane leans right towards the middle of the image, the right lane leans left
+            measurements[LEFT if x2 > x1 else RIGHT] = (x1, x2)
+
+        if searched_bands:
+            self._frames_since_full_search += 1
+        else:
+            self._frames_since_full_search = 0
+        self._full_search = False
+
+        for side in [LEFT, RIGHT]:
+            lane = self._lanes[side]
+            if lane is not None:
+                lane.predict()
+            if measurements[side] is not None:
+                if lane is None:
+                    self._lanes[side] = _LaneFilter(measurements[side], self.process_noise, self.measurement_noise)
+                else:
+                    lane.update(measurements[side])
+            elif lane is not None:
+                lane.miss()
+                # Lost the lane in its band, so look everywhere next frame
+                self._full_search = True
+                if lane.misses > self.max_misses:
+                    self._lanes[side] = None
+
+        return [ [[int(lane.x[0]), height, int(lane.x[1]), int(height / 2)]] for lane in self._lanes if lane is not None ]
@@ -10,6 +10,10 @@ from auto.frame import Frame, Filter, Region, WhiteBalance
 Utility Functions for Lane Keeping Assist System (LKAS)
 """
 
+# Pixels kept around a cropped region so that Canny sees the same neighbours as on the full image
+CROP_MARGIN = 2
+
+
 def _get_steering_angle(lane_img, lane_lines):
     height, width, _ = lane_img.shape
     x_offset, y_offset = 0, 0
@@ -66,33 +70,109 @@ def _stabilize_steering_angle(curr_steering_angle, new_steering_angle, max_angle
     return stabilized_steering_angle
 
 
-def get_steering_angle(cv2_image, curr_steering_angle = 0, stabilize = True, max_angle_deviation_two_lines=5, max_angle_deviation_one_lane=10, tape_color=[105, 157, 252], white_balance=None):
-    frame = Frame(cv2_image)
+def stabilize_steering_angle(curr_steering_angle, steering_angle, num_lanes, max_angle_deviation_two_lines=5, max_angle_deviation_one_lane=10):
+    """
+    Limits the change in steering angle, by less when two lanes were seen.
+    """
+    max_angle_deviation = max_angle_deviation_two_lines if num_lanes == 2 else max_angle_deviation_one_lane
+    return _stabilize_steering_angle(curr_steering_angle, steering_angle, max_angle_deviation)
 
-    # Change to HSV
-    frame.add(Filter.HSV)
 
-    # Lift the tape color from the image
-    frame.add(Filter.COLOR_DETECT, color=tape_color, white_balance=white_balance)
+def carried_steering_angle(steering_angle):
+    """
+    Gets the angle the next frame is stabilized against. The car stops when no lanes are found, which straightens the
+    wheels, so a frame without an angle carries 0, as Car.stop_all does.
+    """
+    return 0 if steering_angle is None else steering_angle
+
+
+def _add_edge_filters(frame, tape_color, white_balance, color_lut, region, roi_first):
+    """
+    Adds the filters that turn the image into the edges of the tape within the region.
+    """
+    if roi_first:
+        # Only process the pixels around the region
+        frame.add(Filter.CROP, region=region, margin=CROP_MARGIN)
+
+    if color_lut:
+        # Lift the tape color straight from the BGR image
+        frame.add(Filter.COLOR_LUT, color=tape_color, white_balance=white_balance)
+    else:
+        # Change to HSV
+        frame.add(Filter.HSV)
+
+        # Lift the tape color from the image
+        frame.add(Filter.COLOR_DETECT, color=tape_color, white_balance=white_balance)
 
     # Detect the edges of the blue blobs
     frame.add(Filter.EDGE_DETECTION)
 
-    # Isolate the bottom region
-    frame.add(Filter.REGION_ISO, region=Region.BOTTOM)
+    # Isolate the region
+    if roi_first:
+        # Drop the margin without copying
+        frame.add(Filter.CROP, region=region)
+    if not roi_first or not isinstance(region, Region):
+        frame.add(Filter.REGION_ISO, region=region)
 
-    # Detect lanes in the image
-    frame.add(Filter.LANE_DETECTION, overlay_layer=0)
+
+def _get_band_lanes(cv2_image, bands, tape_color, white_balance, color_lut):
+    """
+    Detects the lanes by searching only the given bands of the image.
+    The bands are searched together in one pass over the window around them, so that the pixels where they overlap
+    are only searched once.
+    """
+    frame = Frame(cv2_image, headless=True)
+    _add_edge_filters(frame, tape_color, white_balance, color_lut, bands, True)
+    frame.add(Filter.LINE_DETECTION)
+    _, lines, _ = frame.top()
+    _, lanes = Frame._filter_lane_detection(cv2_image, lines, cv2_image, draw=False)
+    return lanes
+
+
+def get_steering_angle(cv2_image, curr_steering_angle = 0, stabilize = True, max_angle_deviation_two_lines=5, max_angle_deviation_one_lane=10, tape_color=[105, 157, 252], white_balance=None, headless=False, color_lut=False, region=Region.BOTTOM, roi_first=False, tracker=None, pool=None):
+    """
+    Runs the lane detection pipeline on an image and computes the steering angle.
+    :param headless: Drive mode. Skips every overlay and returns the lane lines instead of the Frame.
+    :param color_lut: Mask the tape color with the experimental BGR lookup table instead of converting to HSV. It is
+                      slower and only approximates the HSV mask, so leave it off for driving.
+    :param region: The Region, or polygon of (x, y) points, where lanes are searched for.
+    :param roi_first: Crop to the region before any filter runs instead of masking the edges afterwards.
+    :param tracker: A LaneTracker kept across frames. Once it is confident, only bands around its lanes are searched.
+                    The steering angle comes from the lanes found in the frame, not the tracked ones.
+    :param pool: A BufferPool kept across frames that the filters write into. The returned Frame is only valid until the next call.
+    :return: (steering angle, Frame), or (steering angle, lane lines) if headless.
+    """
+    frame = Frame(cv2_image, headless=headless, pool=pool)
+    img = frame.bottom()[0]
+
+    bands = tracker.search_bands(img.shape) if tracker is not None else None
+    if bands:
+        # Search around the tracked lanes only
+        lanes = _get_band_lanes(img, bands, tape_color, white_balance, color_lut)
+    else:
+        _add_edge_filters(frame, tape_color, white_balance, color_lut, region, roi_first)
+
+        # Detect lanes in the image
+        frame.add(Filter.LANE_DETECTION, overlay_layer=0)
+        _, lanes, _ = frame.top()
+
+    if tracker is not None:
+        # The tracked lanes only pick where to search next, and the car steers by what this frame shows, so that it
+        # still stops as soon as the lanes are lost
+        tracker.update(lanes, img.shape, searched_bands=bool(bands))
+        if bands and not headless:
+            frame.add(Filter.LINES, lines=lanes, color=(0, 255, 255))
 
     # Find the steering angle
-    img, lanes, _ = frame.top()
     steering_angle = _get_steering_angle(img, lanes)
 
     # Stabilize the steering angle
     if stabilize:
-        num_lanes = len(lanes)
-        max_angle_deviation = max_angle_deviation_two_lines if num_lanes == 2 else max_angle_deviation_one_lane
-        steering_angle = _stabilize_steering_angle(curr_steering_angle, steering_angle, max_angle_deviation)
+        steering_angle = stabilize_steering_angle(curr_steering_angle, steering_angle, len(lanes),
+                                                  max_angle_deviation_two_lines, max_angle_deviation_one_lane)
+
+    if headless:
+        return (steering_angle if len(lanes) > 0 else None), lanes
 
     # Draw heading line
     height, width, _ = img.shape
@@ -0,0 +1,310 @@
+import sys
+import numpy as np
+from multiprocessing import Process, Queue, Event, Value
+from os.path import join, dirname
+from queue import Empty
+from time import time
+sys.path.append(join(dirname(__file__), '..'))
+
+from auto.frame_ring import FrameRing
+from auto.frame import Filter
+from auto.lkas import get_steering_angle, stabilize_steering_angle, carried_steering_angle
+from auto.lane_tracker import LaneTracker
+from auto.buffer_pool import BufferPool
+from util.timer import Timer
+
+"""
+Capture -> LKAS -> actuation pipeline with a process per stage.
+Frames travel through shared memory rings, and the queues between stages only carry slot indices and sequence numbers.
+"""
+
+# Seconds a stage waits on its queue before checking whether the pipeline was stopped
+POLL_S = 0.1
+
+
+def _camera_source():
+    from auto.camera import get_grabber
+    return get_grabber().latest()
+
+
+def _open_camera():
+    from auto.camera import get_grabber
+    get_grabber()
+
+
+def _car_actuator(tape_color):
+    from car.car import Car
+    car = Car(tape_color=tape_color)
+
+    def actuate(angle):
+        if angle is None:
+            car.stop_all()
+        else:
+            car.steer(angle)
+    return actuate
+
+
+class LkasPipeline:
+    """
+    Runs capture, lane keeping and actuation in separate processes.
+
+    Capture copies the latest camera frame into a free slot of the input ring and queues the slot.
+    LKAS computes the steering angle, copies the frame it shows (annotated unless headless) into the display ring,
+    hands the input slot back and queues the angle. Actuation drives the car with the newest angle only.
+    latest() reads the newest display frame and steering decision back from any process.
+
+    With more than one worker, each worker runs the stateless detection on whichever frame it gets, and a sequencer
+    puts the results back in frame order before stabilizing the angle. Lane tracking needs every frame in order,
+    so it is only used with a single worker.
+    """
+
+    def __init__(self, shape=(480, 640, 3), fps=16, slots=4, display_slots=3, headless=True, tape_color=[105, 157, 252],
+                 white_balance=None, source=_camera_source, actuator_factory=_car_actuator, workers=1):
+        """
+        :param shape: The shape of the camera frames.
+        :param fps: The capture rate.
+        :param slots: Frames that can be in flight between capture and LKAS. Frames are dropped when none are free.
+                      With several workers, frames wait for the sequencer too, so twice the workers keeps them busy.
+        :param display_slots: Slots of the display ring, so that readers rarely race the LKAS process.
+        :param headless: Skip the overlays. The display ring then gets the raw frames.
+        :param source: Called by the capture process, returns (image, capture timestamp) or (None, None).
+        :param actuator_factory: Called with the tape color in the actuation process, returns a function of the angle,
+                                 which is None when the car should stop.
+        :param workers: The number of LKAS worker processes.
+        """
+        self.shape = tuple(shape)
+        self.fps = fps
+        self.headless = headless
+        self.tape_color = tape_color
+        self.white_balance = white_balance
+        self.source = source
+        self.actuator_factory = actuator_factory
+        self.workers = workers
+
+        self.frames = FrameRing(slots, shape)
+        self.display = FrameRing(display_slots, shape)
+        self._free = Queue()
+        for slot in range(slots):
+            self._free.put(slot)
+        self._captured = Queue()
+        self._detected = Queue()
+        self._angles = Queue()
+        self._stop = Event()
+        self._latest = Value('l', -1)
+
+        self._seq = Value('l', 0)
+        self.dropped = Value('l', 0)
+        self.processed = Value('l', 0)
+        # Frames whose lane detection raised, which are decided as if no lanes were found
+        self.failed = Value('l', 0)
+        self.actuated = Value('l', 0)
+        # Seconds summed over processed frames, from capture to decision and from detection to release in order
+        self._latency = Value('d', 0.)
+        self._reorder_wait = Value('d', 0.)
+
+        self._capture = Timer(1 / fps, self._capture_frame, policy=Timer.SKIP).use_mp()
+        self._workers = []
+
+    def start(self):
+        self._stop.clear()
+        if self.workers > 1:
+            lkas = [ Process(target=self._run_detector) for _ in range(self.workers) ]
+            # Sequence numbers carry on from the last run
+            lkas.append(Process(target=self._run_sequencer, args=(self._seq.value + 1,)))
+        else:
+            lkas = [ Process(target=self._run_lkas) ]
+        if self.source is _camera_source:
+            # Share the capture with anything else reading the camera, instead of opening it in the capture process
+            _open_camera()
+        self._workers = lkas + [ Process(target=self._run_actuation) ]
+        for worker in self._workers:
+            worker.start()
+        self._capture.start()
+        return self
+
+    def stop(self):
+        self._capture.stop()
+        self._stop.set()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        # Hand back the slots of frames that were never processed
+        for queue in [self._captured, self._detected]:
+            while True:
+                try:
+                    slot = queue.get(timeout=POLL_S)[0]
+                except Empty:
+                    break
+                self._free.put(slot)
+
+    def close(self):
+        self.stop()
+        self.frames.close()
+        self.display.close()
+
+    def _capture_frame(self):
+        img, timestamp = self.source()
+        if img is None:
+            return
+        try:
+            slot = self._free.get_nowait()
+        except Empty:
+            # LKAS is behind, and a fresh frame will be along soon
+            with self.dropped.get_lock():
+                self.dropped.value += 1
+            return
+        with self._seq.get_lock():
+            self._seq.value += 1
+            seq = self._seq.value
+        self.frames.write(slot, img, seq, timestamp)
+        self._captured.put((slot, seq))
+
+    def _run_lkas(self):
+        tracker = LaneTracker()
+        pool = BufferPool()
+        angle = 0
+        display_slot = 0
+        while not self._stop.is_set():
+            try:
+                slot, seq = self._captured.get(timeout=POLL_S)
+            except Empty:
+                continue
+            img = self.frames.frame(slot)
+            timestamp = float(self.frames.headers[slot]['timestamp'])
+            try:
+                next_angle, result = get_steering_angle(img, angle, tape_color=self.tape_color,
+                                                        white_balance=self.white_balance, headless=self.headless,
+                                                        tracker=tracker, pool=pool)
+                shown = img if self.headless else result.top()[0]
+            except Exception as e:
+                self._fail(seq, e)
+                next_angle, shown = None, img
+            angle = carried_steering_angle(next_angle)
+
+            display_slot = self._release(slot, shown, seq, timestamp, next_angle, display_slot)
+            self._record(timestamp, 0.)
+
+    def _release(self, slot, shown, seq, timestamp, angle, display_slot):
+        """
+        Publishes a frame and its steering decision, and hands its slot back to capture.
+        :return: The display slot written.
+        """
+        display_slot = (display_slot + 1) % self.display.slots
+        self.display.write(display_slot, shown, seq, timestamp, np.nan if angle is None else angle)
+        self._latest.value = display_slot
+        # The frame has been copied out, so capture can reuse the slot
+        self._free.put(slot)
+        self._angles.put((seq, angle))
+        return display_slot
+
+    def _fail(self, seq, e):
+        print('Lane detection failed on frame %d: %s' % (seq, e))
+        with self.failed.get_lock():
+            self.failed.value += 1
+
+    def _record(self, timestamp, reorder_wait):
+        with self.processed.get_lock():
+            self.processed.value += 1
+            self._latency.value += time() - timestamp
+            self._reorder_wait.value += reorder_wait
+
+    def _run_detector(self):
+        pool = BufferPool()
+        while not self._stop.is_set():
+            try:
+                slot, seq = self._captured.get(timeout=POLL_S)
+            except Empty:
+                continue
+            img = self.frames.frame(slot)
+            try:
+                steering_angle, result = get_steering_angle(img, stabilize=False, tape_color=self.tape_color,
+                                                            white_balance=self.white_balance, headless=self.headless,
+                                                            pool=pool)
+                if self.headless:
+                    num_lanes = len(result)
+                else:
+                    layer = result.layer_of(Filter.LANE_DETECTION)
+                    num_lanes = 0 if steering_angle is None or layer is None else len(result.get(layer)[1])
+                    # The source frame is no longer needed, so the overlays take its place in the slot
+                    np.copyto(img, result.top()[0])
+            except Exception as e:
+                # The sequencer waits for every seq in order, so a failed frame still gets a result
+                self._fail(seq, e)
+                steering_angle, num_lanes = None, 0
+            self._detected.put((slot, seq, steering_angle, num_lanes, time()))
+
+    def _run_sequencer(self, next_seq):
+        angle = 0
+        display_slot = 0
+        pending = {}
+        while not self._stop.is_set():
+            try:
+                slot, seq, steering_angle, num_lanes, detected_at = self._detected.get(timeout=POLL_S)
+            except Empty:
+                continue
+            pending[seq] = (slot, steering_angle, num_lanes, detected_at)
+            # Stabilization depends on the previous decision, so decide in frame order
+            while next_seq in pending:
+                slot, steering_angle, num_lanes, detected_at = pending.pop(next_seq)
+                next_angle = None
+                if steering_angle is not None:
+                    next_angle = stabilize_steering_angle(angle, steering_angle, num_lanes)
+                angle = carried_steering_angle(next_angle)
+                timestamp = float(self.frames.headers[slot]['timestamp'])
+                display_slot = self._release(slot, self.frames.frame(slot), next_seq, timestamp, next_angle, display_slot)
+                self._record(timestamp, time() - detected_at)
+                next_seq += 1
+
+    def _run_actuation(self):
+        actuate = self.actuator_factory(self.tape_color)
+        while not self._stop.is_set():
+            try:
+                seq, angle = self._angles.get(timeout=POLL_S)
+            except Empty:
+                continue
+            # Only the newest decision matters
+            while True:
+                try:
+                    seq, angle = self._angles.get_nowait()
+                except Empty:
+                    break
+            actuate(angle)
+            with self.actuated.get_lock():
+                self.actuated.value += 1
+
+    def latest(self, out=None):
+        """
+        Reads back the newest frame the LKAS process produced.
+        :param out: An optional array to copy the frame into.
+        :return: (frame, seq, capture timestamp, steering angle or None), or None before the first frame.
+        """
+        slot = self._latest.value
+        if slot < 0:
+            return None
+        frame, seq, timestamp, angle = self.display.read(slot, out)
+        return frame, seq, timestamp, None if np.isnan(angle) else angle
+
+    def stats(self):
+        """
+        :return: A dict of frame counts, including frames whose detection failed, the mean ms from capture to decision,
+                 and the mean ms frames waited to be put back in order.
+        """
+        with self.processed.get_lock():
+            processed = self.processed.value
+            latency = self._latency.value
+            reorder_wait = self._reorder_wait.value
+        return {
+            'captured': self._seq.value,
+            'dropped': self.dropped.value,
+            'processed': processed,
+            'failed': self.failed.value,
+            'actuated': self.actuated.value,
+            'latency_ms': latency / processed * 1000 if processed > 0 else 0.,
+            'reorder_wait_ms': reorder_wait / processed * 1000 if processed > 0 else 0.
+        }
+
+    def report(self):
+        stats = self.stats()
+        return ('Pipeline: %d captured, %d dropped, %d processed, %d failed, %d actuated, %.1f ms latency, '
+                '%.1f ms reorder wait') % (stats['captured'], stats['dropped'], stats['processed'], stats['failed'],
+                                           stats['actuated'], stats['latency_ms'], stats['reorder_wait_ms'])
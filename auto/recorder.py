@@ -0,0 +1,175 @@
+import cv2
+import os, sys
+import numpy as np
+from collections import deque
+from os.path import join, dirname, isfile
+from queue import Queue, Full
+from threading import Thread, Lock
+from time import perf_counter
+sys.path.append(join(dirname(__file__), '..'))
+
+from auto.recording import RecordingWriter, EXTENSION
+
+"""
+Asynchronous frame recording, so that encoding and writing images never holds up the capture loop.
+"""
+
+
+class FrameWriter:
+    """
+    Writes numbered PNGs to a directory, or frames to a recording, from a bounded queue drained by writer threads.
+    OpenCV releases the GIL while encoding and writing, so the writers run alongside the capture loop.
+    """
+
+    # Write latencies kept for the percentiles
+    WINDOW = 256
+
+    def __init__(self, dname, workers=2, max_queue=16, block=False):
+        """
+        :param dname: The directory to write to, or a recording path ending in .rec. Numbering continues after the frames
+                      already in it.
+        :param workers: The number of writer threads. Recordings are appended in order, so they get a single one.
+        :param max_queue: The number of frames that can wait to be written.
+        :param block: Wait for room in the queue when it is full instead of dropping the frame.
+        """
+        self.dname = dname
+        self.block = block
+        self._recording = None
+        if dname.endswith(EXTENSION):
+            self._recording = RecordingWriter(dname)
+            self._next_number = self._recording.count
+            workers = 1
+        else:
+            # The directory is only listed once, after which frames are numbered in memory
+            self._next_number = len([ item for item in os.listdir(dname) if isfile(join(dname, item)) ]) + 1
+        self._queue = Queue(max_queue)
+        self._lock = Lock()
+        self._number_lock = Lock()
+        self._latencies = deque(maxlen=FrameWriter.WINDOW)
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._workers = [ Thread(target=self._write, daemon=True) for _ in range(workers) ]
+        for worker in self._workers:
+            worker.start()
+
+    def write(self, img, copy=False, timestamp=None, flags=0, steering=np.nan, speeds=None):
+        """
+        Queues a frame to be written.
+        :param img: The image, which must not be modified afterwards unless copy is True.
+        :param copy: Copy the image before queueing it.
+        :param timestamp: The capture time, stored in recordings.
+        :param flags: Flag bits such as FLAG_DUPLICATE, stored in recordings.
+        :param steering: The steering angle in degrees when the frame was captured, or NaN if unknown, stored in recordings.
+        :param speeds: The four motor speeds when the frame was captured, or None if unknown, stored in recordings.
+        :return: The number of the file or recording frame the frame will be written to, or None if it was dropped.
+        """
+        if copy:
+            img = img.copy()
+        with self._lock:
+            self.submitted += 1
+        # Numbers are only taken by queued frames, so that dropped frames leave no gaps for a later recording to fill
+        with self._number_lock:
+            number = self._next_number
+            try:
+                self._queue.put((number, img, timestamp, flags, steering, speeds, perf_counter()), block=self.block)
+            except Full:
+                with self._lock:
+                    self.dropped += 1
+                return None
+            self._next_number += 1
+        return number
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            number, img, timestamp, flags, steering, speeds, queued_at = item
+            if self._recording is not None:
+                try:
+                    self._recording.append(img, timestamp, steering, speeds, flags)
+                    success = True
+                except Exception as e:
+                    print('Could not record frame %d: %s' % (number, e))
+                    success = False
+            else:
+                success = cv2.imwrite(join(self.dname, '%d.png' % number), img)
+            with self._lock:
+                if success:
+                    self.written += 1
+                else:
+                    self.failed += 1
+                self._latencies.append(perf_counter() - queued_at)
+            self._queue.task_done()
+
+    def flush(self):
+        """
+        Blocks until every queued frame is written.
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Writes the queued frames and stops the writer threads.
+        """
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        if self._recording is not None:
+            self._recording.close()
+
+    def stats(self):
+        """
+        :return: A dict of frames submitted, written, dropped, failed and still queued, and the queue to disk latency in ms.
+        """
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            stats = {
+                'submitted': self.submitted,
+                'written': self.written,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'queued': self._queue.qsize()
+            }
+        stats['latency_ms'] = {
+            'mean': latencies.mean() if len(latencies) > 0 else 0.,
+            'p95': np.percentile(latencies, 95) if len(latencies) > 0 else 0.,
+            'max': latencies.max() if len(latencies) > 0 else 0.
+        }
+        return stats
+
+    def report(self):
+        stats = self.stats()
+        latency = stats['latency_ms']
+        return 'Recorder: %d written, %d dropped, %d failed, %d queued, write latency %.1f ms mean, %.1f ms p95, %.1f ms max' % (
+            stats['written'], stats['dropped'], stats['failed'], stats['queued'], latency['mean'], latency['p95'], latency['max'])
+
+
+_writers = {}
+
+
+def get_writer(dname, **kwargs):
+    """
+    Gets the writer of a directory for the current process, starting it on first use.
+    Writer threads do not survive a fork, so a process started by a Timer starts its own.
+    """
+    key = (os.getpid(), dname)
+    writer = _writers.get(key)
+    if writer is None:
+        writer = _writers[key] = FrameWriter(dname, **kwargs)
+    return writer
+
+
+def close_writer(dname):
+    """
+    Writes the queued frames of the current process's writer of a directory and closes it.
+    :return: The closed writer, or None if the process had none.
+    """
+    writer = _writers.pop((os.getpid(), dname), None)
+    if writer is not None:
+        writer.close()
+    return writer
@@ -0,0 +1,228 @@
+import cv2
+import os, sys
+import numpy as np
+from os import mkdir, listdir
+from os.path import join, dirname, exists, getsize, getmtime
+from time import time
+sys.path.append(join(dirname(__file__), '..'))
+
+"""
+Chunked, indexed container for recorded drives.
+
+A recording is a directory holding encoded frames appended to chunk files and a fixed-size record per frame in
+index.bin. The index is a 16 byte header followed by INDEX_DTYPE records, so it can be opened with np.memmap and
+any frame found in O(1). Both files are only ever appended to, and a record is written after its frame,
+so a recording cut short by a crash is still readable up to its last complete record.
+Examples:
+    To convert a training dataset of numbered PNGs:
+    python3 -m auto.recording auto/train_data/train_data_dark train_data_dark.rec
+"""
+
+MAGIC = b'LKASREC\0'
+VERSION = 1
+
+INDEX_DTYPE = np.dtype([
+    ('chunk', '<u4'),
+    ('offset', '<u8'),
+    ('length', '<u4'),
+    ('timestamp', '<f8'),
+    ('steering', '<f4'),
+    ('speeds', '<f4', (4,)),
+    ('flags', '<u4')
+])
+
+HEADER_DTYPE = np.dtype([ ('magic', 'S8'), ('version', '<u4'), ('record_size', '<u4') ])
+
+INDEX_FILE = 'index.bin'
+
+EXTENSION = '.rec'
+
+# Bits of the flags field
+FLAG_DUPLICATE = 1
+
+
+def _chunk_name(chunk):
+    return 'chunk_%05d.bin' % chunk
+
+
+class RecordingWriter:
+    """
+    Appends frames to a recording, creating it if needed.
+    """
+
+    def __init__(self, path, encoding='.png', chunk_bytes=64 * 1024 * 1024):
+        """
+        :param path: The recording directory.
+        :param encoding: The image format frames are encoded with, as an extension understood by cv2.imencode.
+        :param chunk_bytes: The size past which a new chunk file is started.
+        """
+        self.path = path
+        self.encoding = encoding
+        self.chunk_bytes = chunk_bytes
+        if not exists(path):
+            mkdir(path)
+
+        index_path = join(path, INDEX_FILE)
+        if not exists(index_path) or getsize(index_path) < HEADER_DTYPE.itemsize:
+            header = np.array([ (MAGIC, VERSION, INDEX_DTYPE.itemsize) ], HEADER_DTYPE)
+            with open(index_path, 'wb') as f:
+                f.write(header.tobytes())
+        else:
+            _read_header(index_path)
+            # Drop a record left incomplete by a crash
+            records = (getsize(index_path) - HEADER_DTYPE.itemsize) // INDEX_DTYPE.itemsize
+            os.truncate(index_path, HEADER_DTYPE.itemsize + records * INDEX_DTYPE.itemsize)
+        self._index = open(index_path, 'ab')
+        self.count = (self._index.tell() - HEADER_DTYPE.itemsize) // INDEX_DTYPE.itemsize
+
+        # Continue the last chunk, after the end of its last indexed frame
+        self._chunk = 0
+        offset = 0
+        if self.count > 0:
+            last = np.fromfile(index_path, INDEX_DTYPE, count=1, offset=HEADER_DTYPE.itemsize + (self.count - 1) * INDEX_DTYPE.itemsize)[0]
+            self._chunk = int(last['chunk'])
+            offset = int(last['offset']) + int(last['length'])
+        chunk_path = join(path, _chunk_name(self._chunk))
+        if exists(chunk_path):
+            os.truncate(chunk_path, offset)
+        self._data = open(chunk_path, 'ab')
+
+    def append(self, img, timestamp=None, steering=np.nan, speeds=None, flags=0):
+        """
+        Encodes a frame and appends it.
+        :param timestamp: The capture time in seconds since the epoch. Defaults to now.
+        :param steering: The steering angle in degrees, or NaN if unknown.
+        :param speeds: The four motor speeds, or None if unknown.
+        :return: The index of the frame.
+        """
+        success, data = cv2.imencode(self.encoding, img)
+        if not success:
+            raise Exception('Could not encode frame as %s' % self.encoding)
+        return self.append_encoded(data.tobytes(), timestamp, steering, speeds, flags)
+
+    def append_encoded(self, data, timestamp=None, steering=np.nan, speeds=None, flags=0):
+        """
+        Appends an already encoded frame, such as the bytes of an image file.
+        :return: The index of the frame.
+        """
+        if self._data.tell() > 0 and self._data.tell() + len(data) > self.chunk_bytes:
+            self._data.close()
+            self._chunk += 1
+            self._data = open(join(self.path, _chunk_name(self._chunk)), 'ab')
+
+        offset = self._data.tell()
+        self._data.write(data)
+        self._data.flush()
+
+        record = np.zeros(1, INDEX_DTYPE)
+        record['chunk'] = self._chunk
+        record['offset'] = offset
+        record['length'] = len(data)
+        record['timestamp'] = time() if timestamp is None else timestamp
+        record['steering'] = steering
+        record['speeds'] = np.nan if speeds is None else speeds
+        record['flags'] = flags
+        self._index.write(record.tobytes())
+        self._index.flush()
+
+        self.count += 1
+        return self.count - 1
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _read_header(index_path):
+    header = np.fromfile(index_path, HEADER_DTYPE, count=1)[0]
+    if header['magic'] != MAGIC.rstrip(b'\0'):
+        raise Exception('%s is not a recording index' % index_path)
+    if header['version'] != VERSION or header['record_size'] != INDEX_DTYPE.itemsize:
+        raise Exception('Unsupported recording version %d' % header['version'])
+    return header
+
+
+class RecordingReader:
+    """
+    Lazily reads a recording. Chunks are memory mapped on first use, and frames are only decoded when requested.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        index_path = join(path, INDEX_FILE)
+        _read_header(index_path)
+        records = (getsize(index_path) - HEADER_DTYPE.itemsize) // INDEX_DTYPE.itemsize
+        # The (N,) structured array of every frame's chunk, offset, length, timestamp, steering, speeds and flags
+        if records > 0:
+            self.index = np.memmap(index_path, INDEX_DTYPE, mode='r', offset=HEADER_DTYPE.itemsize, shape=(records,))
+        else:
+            self.index = np.zeros(0, INDEX_DTYPE)
+        self._chunks = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def _chunk(self, chunk):
+        data = self._chunks.get(chunk)
+        if data is None:
+            data = self._chunks[chunk] = np.memmap(join(self.path, _chunk_name(chunk)), np.uint8, mode='r')
+        return data
+
+    def raw(self, i):
+        """
+        :return: The encoded bytes of frame i, as a view into its chunk.
+        """
+        record = self.index[i]
+        offset = int(record['offset'])
+        return self._chunk(int(record['chunk']))[offset:offset + int(record['length'])]
+
+    def read(self, i, flags=cv2.IMREAD_COLOR):
+        """
+        :return: Frame i decoded as a CV2 image.
+        """
+        return cv2.imdecode(self.raw(i), flags)
+
+    def __getitem__(self, i):
+        return self.read(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.read(i)
+
+    def close(self):
+        self._chunks.clear()
+        self.index = np.zeros(0, INDEX_DTYPE)
+
+
+def convert_png_folder(dname, path, **kwargs):
+    """
+    Copies a folder of numbered PNGs (1.png, 2.png, ...) into a recording without re-encoding them.
+    File modification times stand in for capture timestamps.
+    :return: The number of frames converted.
+    """
+    numbers = sorted(int(item[:-4]) for item in listdir(dname) if item.endswith('.png') and item[:-4].isdigit())
+    with RecordingWriter(path, encoding='.png', **kwargs) as writer:
+        for number in numbers:
+            file_path = join(dname, '%d.png' % number)
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            # Skip files that OpenCV cannot decode, such as ones cut short while recording
+            if cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED) is None:
+                print('Skipping unreadable %s' % file_path)
+                continue
+            writer.append_encoded(data, timestamp=getmtime(file_path))
+        return writer.count
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print('Usage: python3 -m auto.recording <png folder> <recording>')
+        sys.exit(1)
+    frames = convert_png_folder(sys.argv[1], sys.argv[2])
+    print('Wrote %d frames to %s' % (frames, sys.argv[2]))
@@ -0,0 +1,99 @@
+import argparse
+import csv
+from multiprocessing import Pool, cpu_count
+from os import listdir
+from time import perf_counter
+
+from auto.frame import Filter, profiler
+from lkasbench import MODES, load_dataset, tape_color, white_balance, TRAIN_DATA_DIR
+from auto.lkas import get_steering_angle, carried_steering_angle
+
+"""
+Abstract: Runs the LKAS pipeline over train_data sequences in parallel and writes a per-frame results table.
+Each sequence runs in order in a single process, so the steering angle stabilization carries from frame to frame,
+while separate sequences run in separate processes.
+Examples:
+    To evaluate every dataset in auto/train_data with one process per core:
+    python3 batcheval.py
+
+    To evaluate two datasets in drive mode with lane tracking on 2 processes:
+    python3 batcheval.py train_data_dark train_data_wide --mode tracked --workers 2 --out results.csv
+"""
+
+STAGES = [ filter.name for filter in Filter ]
+COLUMNS = [ 'dataset', 'image', 'angle', 'lanes', 'ms' ] + [ '%s ms' % stage for stage in STAGES ]
+
+
+def _lane_lines(frame):
+    layer = frame.layer_of(Filter.LANE_DETECTION)
+    return [] if layer is None else frame.get(layer)[1]
+
+
+def evaluate_sequence(task):
+    """
+    Runs one sequence of images through the pipeline, chaining the stabilized steering angle.
+    :param task: (dataset name, mode label)
+    :return: (dataset name, per-frame rows, seconds spent on the pipeline)
+    """
+    name, mode = task
+    options = dict(MODES)[mode]
+    if 'tracker' in options:
+        options['tracker'].reset()
+
+    profiler.enable()
+    rows = []
+    curr_steering_angle = 0
+    elapsed = 0.
+    for i, img in enumerate(load_dataset(name)):
+        profiler.clear()
+        start = perf_counter()
+        angle, result = get_steering_angle(img, curr_steering_angle=curr_steering_angle, stabilize=True,
+                                           tape_color=tape_color, white_balance=white_balance, **options)
+        seconds = perf_counter() - start
+        elapsed += seconds
+
+        lanes = result if options.get('headless') else _lane_lines(result)
+        # Stabilize the next frame against the angle the car is left at, which is straight after it stops
+        curr_steering_angle = carried_steering_angle(angle)
+
+        row = { 'dataset': name, 'image': '%d.png' % (i + 1), 'angle': '' if angle is None else '%.4f' % angle,
+                'lanes': 0 if lanes is None else len(lanes), 'ms': '%.3f' % (seconds * 1000) }
+        # Sum every run of a stage in the frame
+        for filter in Filter:
+            samples = profiler.samples(filter)
+            row['%s ms' % filter.name] = '%.3f' % (samples[:, 0].sum() * 1000) if len(samples) > 0 else ''
+        rows.append(row)
+    return name, rows, elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Evaluates the LKAS pipeline over train_data sequences in parallel.')
+    parser.add_argument('datasets', nargs='*', help='train_data directories, all of them by default')
+    parser.add_argument('--mode', default='headless', choices=[ label for label, _ in MODES ], help='lkasbench mode to run')
+    parser.add_argument('--workers', type=int, default=cpu_count(), help='number of processes')
+    parser.add_argument('--out', default='batcheval.csv', help='path of the per-frame results table')
+    args = parser.parse_args()
+
+    datasets = args.datasets if len(args.datasets) > 0 else sorted(listdir(TRAIN_DATA_DIR))
+    workers = max(1, min(args.workers, len(datasets)))
+
+    start = perf_counter()
+    with Pool(workers) as pool, open(args.out, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        total_frames = 0
+        print('%-20s %8s %10s %8s %10s' % ('dataset', 'frames', 'ms/frame', 'fps', 'detected'))
+        for name, rows, elapsed in pool.imap(evaluate_sequence, [ (name, args.mode) for name in datasets ]):
+            writer.writerows(rows)
+            total_frames += len(rows)
+            if len(rows) == 0:
+                print('%-20s no images' % name)
+                continue
+            detected = sum(row['lanes'] > 0 for row in rows) / len(rows)
+            print('%-20s %8d %10.2f %8.1f %9.1f%%' % (name, len(rows), elapsed / len(rows) * 1000, len(rows) / elapsed, detected * 100))
+    wall = perf_counter() - start
+
+    print('')
+    print('%d frames in %.2fs on %d workers (%s mode)' % (total_frames, wall, workers, args.mode))
+    print('Throughput: %.1f frames/sec, %.1f frames/sec per core' % (total_frames / wall, total_frames / wall / workers))
+    print('Results written to %s' % args.out)
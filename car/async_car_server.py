@@ -0,0 +1,185 @@
+import sys
+import asyncio
+from os.path import join, dirname
+from time import monotonic
+sys.path.append(join(dirname(__file__), '..'))
+
+from util.networking import open_async_socket, open_async_udp_socket, encode_text, encode_message, encode_telemetry, \
+    decode_speeds, MessageType, RATE, PRIORITY, SequenceTracker
+from car.car_constants import CAR_PORT, CAR_UDP_PORT, PRIORITY_AUTONOMY, PRIORITY_HOLD_S, TELEMETRY_MAX_HZ, WATCHDOG_S
+from car.ramp_engine import RampEngine
+from car.motor_driver import MotorDriver
+
+# Telemetry is skipped for a subscriber with more unsent bytes than this, rather than queued behind them
+TELEMETRY_BACKLOG_BYTES = 4096
+
+
+class AsyncCarServer:
+    """
+    Car server on an asyncio event loop, serving any number of clients at once.
+
+    Clients can send a PRIORITY message for their connection, which starts at PRIORITY_AUTONOMY. A command is
+    rejected while a command with a higher priority was applied in the last hold_s seconds, so the gamepad
+    overrides autonomy. Clients can also SUBSCRIBE to a stream of the motors' throttles and targets.
+
+    Commands can also come over UDP, where each sender's commands are applied only if newer than its last one.
+    While the last command applied came over UDP, a watchdog stops the motors if no command follows within watchdog_s.
+    """
+
+    def __init__(self, car=None, port=CAR_PORT, hold_s=PRIORITY_HOLD_S, udp_port=CAR_UDP_PORT, watchdog_s=WATCHDOG_S):
+        """
+        :param car: A MotorKit, or a stand-in such as FakeMotorKit. Defaults to the MotorKit on the Pi.
+        :param hold_s: Seconds a command holds off commands with a lower priority.
+        :param udp_port: The port to take commands over UDP on, or None for TCP only.
+        :param watchdog_s: Seconds the motors keep going without a new command over UDP.
+        """
+        if car is None:
+            from adafruit_motorkit import MotorKit
+            car = MotorKit()
+        self.car = car
+        self.port = port
+        self.hold_s = hold_s
+        self.udp_port = udp_port
+        self.watchdog_s = watchdog_s
+        # Turn off all motors
+        self.driver = MotorDriver(self.car)
+        self.driver.set_throttles([ 0, 0, 0, 0 ])
+        self.ramp = RampEngine(self.driver)
+        # Priority and time of the last applied command
+        self._owner_priority = 0
+        self._owner_time = 0.
+        self.clients = 0
+        self.applied = 0
+        self.rejected = 0
+        self.telemetry_sent = 0
+        self.telemetry_skipped = 0
+        # Priority and sequence tracker of every UDP sender, by address
+        self.udp_senders = {}
+        # When the last command applied came over UDP, or None if it came over TCP
+        self._udp_command_time = None
+        self.watchdog_trips = 0
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.ramp.start()
+        server = await open_async_socket(self.port, self.__on_msg, self.__on_connect, self.__on_disconnect)
+        print("Started car socket on port %d" % self.port)
+        udp, watchdog = None, None
+        if self.udp_port is not None:
+            udp = await open_async_udp_socket(self.udp_port, self.__on_datagram)
+            watchdog = asyncio.get_running_loop().create_task(self.__watchdog())
+            print("Started car UDP socket on port %d" % self.udp_port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if udp:
+                watchdog.cancel()
+                udp.close()
+            self.ramp.halt()
+            print("Closed car socket on port %d" % self.port)
+
+    def __on_connect(self, conn):
+        self.clients += 1
+        conn.state['priority'] = PRIORITY_AUTONOMY
+
+    def __on_disconnect(self, conn):
+        self.clients -= 1
+        stream = conn.state.get('stream')
+        if stream:
+            stream.cancel()
+
+    def __on_msg(self, conn, msg):
+        if msg.type == MessageType.TEXT:
+            speeds = [ float(speed.strip()) for speed in msg.payload.split(",") ]
+            return encode_text(msg.payload if self.__command(conn, speeds) else 'REJECTED')
+        if msg.type == MessageType.SPEEDS:
+            applied = self.__command(conn, decode_speeds(msg.payload))
+            return encode_message(MessageType.ACK if applied else MessageType.REJECTED, b'', msg.seq, msg.timestamp)
+        if msg.type == MessageType.PRIORITY:
+            conn.state['priority'] = PRIORITY.unpack(msg.payload)[0]
+        elif msg.type == MessageType.SUBSCRIBE:
+            self.__subscribe(conn, RATE.unpack(msg.payload)[0])
+        else:
+            raise Exception('Unexpected message type %d' % msg.type)
+        return encode_message(MessageType.ACK, b'', msg.seq, msg.timestamp)
+
+    def __command(self, conn, speeds):
+        """
+        Applies a command unless a command with a higher priority holds the motors.
+        :return: True if the command was applied.
+        """
+        if not self.__apply(conn.state['priority'], speeds):
+            return False
+        self._udp_command_time = None
+        return True
+
+    def __apply(self, priority, speeds):
+        now = monotonic()
+        if priority < self._owner_priority and now - self._owner_time < self.hold_s:
+            self.rejected += 1
+            return False
+        self._owner_priority = priority
+        self._owner_time = now
+        self.ramp.set_targets(speeds)
+        self.applied += 1
+        return True
+
+    def __on_datagram(self, addr, msg):
+        sender = self.udp_senders.get(addr)
+        if sender is None:
+            sender = self.udp_senders[addr] = { 'priority': PRIORITY_AUTONOMY, 'tracker': SequenceTracker() }
+        if msg.type == MessageType.PRIORITY:
+            sender['priority'] = PRIORITY.unpack(msg.payload)[0]
+        elif msg.type == MessageType.SPEEDS:
+            # Out of order commands are older than the one already applied
+            if sender['tracker'].accept(msg) and self.__apply(sender['priority'], decode_speeds(msg.payload)):
+                self._udp_command_time = monotonic()
+        else:
+            raise Exception('Unexpected message type %d over UDP' % msg.type)
+
+    async def __watchdog(self):
+        while True:
+            await asyncio.sleep(self.watchdog_s / 4)
+            if self._udp_command_time is not None and monotonic() - self._udp_command_time > self.watchdog_s:
+                # The sender went quiet, so stop rather than keep going on its last command
+                self._udp_command_time = None
+                self.ramp.set_targets([ 0, 0, 0, 0 ])
+                self.watchdog_trips += 1
+
+    def __subscribe(self, conn, rate):
+        stream = conn.state.pop('stream', None)
+        if stream:
+            stream.cancel()
+        if rate > 0:
+            conn.state['stream'] = asyncio.get_running_loop().create_task(self.__stream(conn, min(rate, TELEMETRY_MAX_HZ)))
+
+    async def __stream(self, conn, rate):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        seq = 0
+        while not conn.closed:
+            if conn.buffered() > TELEMETRY_BACKLOG_BYTES:
+                # The subscriber is behind, and only the newest state matters
+                self.telemetry_skipped += 1
+            else:
+                seq += 1
+                throttles, targets = self.ramp.state()
+                conn.send(encode_telemetry(throttles, targets, seq))
+                self.telemetry_sent += 1
+            deadline = max(deadline + 1 / rate, loop.time())
+            await asyncio.sleep(deadline - loop.time())
+
+    def stats(self):
+        return {
+            'clients': self.clients,
+            'applied': self.applied,
+            'rejected': self.rejected,
+            'telemetry_sent': self.telemetry_sent,
+            'telemetry_skipped': self.telemetry_skipped,
+            'watchdog_trips': self.watchdog_trips,
+            'driver': self.driver.stats(),
+            'udp': { addr: sender['tracker'].stats() for addr, sender in self.udp_senders.items() }
+        }
@@ -1,29 +1,68 @@
+import os
 import sys
 import numpy as np
+from contextlib import contextmanager
+from multiprocessing import Array
 from os.path import join, dirname
-from time import sleep
-from util.networking import send_to_socket
+from threading import Lock, RLock
+from time import time, sleep, monotonic
+from util.networking import SocketClient, UdpClient, MessageType, encode_speeds, encode_priority
 from util.timer import Timer
-from car.car_constants import CAR_PORT, MIN_SPEED, MAX_SPEED, GO_DEFAULT, DOUBLE_STOP_DEFAULT, DEFAULT_TAPE_COLOR, STOP, MAX_ANGLE
+from car.car_constants import CAR_PORT, CAR_UDP_PORT, CAR_TRANSPORT, HEARTBEAT_S, PRIORITY_HOLD_S, MIN_SPEED, MAX_SPEED, GO_DEFAULT, DOUBLE_STOP_DEFAULT, DEFAULT_TAPE_COLOR, STOP, MAX_ANGLE, PROFILE_REPORT_FRAMES
 
 import atexit
 
+from car.steering import wheel_speeds
 from auto.lkas import get_steering_angle
+from auto.lane_tracker import LaneTracker
+from auto.buffer_pool import BufferPool
+from auto.frame import profiler
 
 sys.path.append(join(dirname(__file__), '..'))
 
 # Wheels 1, 2, 3, 4 -> top-left, top-right, bottom-left, bottom-right
 
+# Maneuvers that commands are counted under. Batches with other names count under 'other'.
+MANEUVERS = [ 'move_speeds', 'stop_all', 'change_speed', 'move_angle', 'steer', 'move_forward', 'move_backward',
+              'move_left', 'move_right', 'other' ]
+COMMAND_COUNTS = [ 'sent', 'suppressed', 'rejected' ]
+
 
 class Car:
 
-    def __init__(self, go=GO_DEFAULT, double_stop=DOUBLE_STOP_DEFAULT, tape_color = DEFAULT_TAPE_COLOR):
+    def __init__(self, go=GO_DEFAULT, double_stop=DOUBLE_STOP_DEFAULT, tape_color = DEFAULT_TAPE_COLOR, priority = None, transport = CAR_TRANSPORT):
         # Car instance
         self.go = go
         self.angle = 0
         self.double_stop = double_stop
         self.tape_color = tape_color
         self.speeds = [ 0, 0, 0, 0 ]
+        hello = None if priority is None else encode_priority(priority)
+        self.transport = transport
+        # Started by the first command of every process that sends, since a forked process has no threads of its parent
+        self._heartbeat = None
+        self._pid = os.getpid()
+        if transport == 'udp':
+            # Datagrams never wait on the server, and the server's watchdog stops the car if they stop coming
+            self.client = UdpClient(CAR_UDP_PORT, hello=hello)
+        else:
+            # Commands are pipelined over one connection, so speeds are updated as they are sent rather than on the ack
+            # The priority is declared again on every new connection
+            self.client = SocketClient(CAR_PORT, pipeline=True, hello=hello)
+        # Speeds last sent to the server and when, guarded by _sent_lock since responses arrive on the reader thread
+        self._sent_speeds = None
+        self._sent_at = 0.
+        self._sent_lock = Lock()
+        # How deep in batch() the car is
+        self._batch_depth = 0
+        self._maneuver = None
+        self._batch_lock = RLock()
+        # Commands sent, suppressed and rejected by the server per maneuver, in shared memory so that commands sent
+        # from a forked process, such as LKAS on a use_mp() Timer, are counted where the car was made
+        self._command_counts = Array('l', len(MANEUVERS) * len(COMMAND_COUNTS))
+        self.lane_tracker = LaneTracker()
+        self.buffer_pool = BufferPool()
+        self.lkas_frames = 0
 
         self.stop_all()
         atexit.register(self.stop_all)
@@ -32,11 +71,101 @@ class Car:
     # Reusables
     ##
 
+    @contextmanager
+    def batch(self, maneuver=None):
+        """
+        Stages every speed change made inside the block and sends the final speeds as one command when it ends,
+        so the motors never pass through the intermediate states. Batches can be nested, and only the outermost sends.
+        If the block raises, nothing is sent and the speeds go back to what they were before it.
+        :param maneuver: The name the command is counted under, by default the outermost batch's.
+        """
+        self._check_pid()
+        with self._batch_lock:
+            if self._batch_depth == 0:
+                self._maneuver = maneuver
+            speeds = self.speeds.copy()
+            self._batch_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._batch_depth -= 1
+                self.speeds = speeds
+                raise
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self._flush()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # Forked from the process that made the car. Its locks may have been held mid-fork, and its heartbeat
+            # thread did not come along.
+            self._pid = os.getpid()
+            self._batch_lock = RLock()
+            self._sent_lock = Lock()
+            self._batch_depth = 0
+            self._heartbeat = None
+
+    def _flush(self):
+        maneuver = self._maneuver or 'move_speeds'
+        maneuver = MANEUVERS.index(maneuver if maneuver in MANEUVERS else 'other')
+        with self._sent_lock:
+            # The server already runs at these speeds, unless another client took over after the priority hold.
+            # Recorded before sending, so that a rejection can't arrive first and be overwritten.
+            if self.speeds == self._sent_speeds and monotonic() - self._sent_at < PRIORITY_HOLD_S:
+                self._count(maneuver, 'suppressed')
+                return
+            self._sent_speeds = self.speeds.copy()
+            self._sent_at = monotonic()
+        self.client.send(encode_speeds(self.speeds, self.client.next_seq()), lambda res: self._on_response(res, maneuver))
+        self._count(maneuver, 'sent')
+        if self.transport == 'udp' and self._heartbeat is None:
+            self._heartbeat = Timer(HEARTBEAT_S, self._resend, policy=Timer.SKIP)
+            self._heartbeat.start()
+
+    def _forget_sent(self):
+        # The next command is sent even if it repeats the last one
+        with self._sent_lock:
+            self._sent_speeds = None
+
+    def _resend(self):
+        # Keeps the watchdog fed while moving, since repeated commands are suppressed
+        with self._batch_lock:
+            with self._sent_lock:
+                speeds = self._sent_speeds
+            if speeds is not None and any(speed != 0 for speed in speeds):
+                self.client.send(encode_speeds(speeds, self.client.next_seq()))
+
+    def _count(self, maneuver, count):
+        with self._command_counts.get_lock():
+            self._command_counts[maneuver * len(COMMAND_COUNTS) + COMMAND_COUNTS.index(count)] += 1
+
+    def _on_response(self, res, maneuver):
+        if getattr(res, 'type', None) == MessageType.REJECTED:
+            # A client with a higher priority holds the motors, so the speeds were never applied
+            self._forget_sent()
+            self._count(maneuver, 'rejected')
+
+    @property
+    def command_counts(self):
+        """
+        :return: A dict of the sent, suppressed and rejected commands of every maneuver used, from all processes.
+        """
+        with self._command_counts.get_lock():
+            values = list(self._command_counts)
+        counts = {}
+        for i, maneuver in enumerate(MANEUVERS):
+            row = values[i * len(COMMAND_COUNTS):(i + 1) * len(COMMAND_COUNTS)]
+            if any(row):
+                counts[maneuver] = dict(zip(COMMAND_COUNTS, row))
+        return counts
+
+    def command_report(self):
+        return 'Commands: ' + ', '.join('%s %d sent %d suppressed %d rejected' % (maneuver, counts['sent'], counts['suppressed'], counts['rejected'])
+                                        for maneuver, counts in self.command_counts.items())
+
     def move_speeds(self, *speeds):
-        speeds = list(speeds)
-        def reassign_speeds(res):
-            self.speeds = speeds
-        send_to_socket(CAR_PORT, str(speeds)[1:-1], reassign_speeds)
+        with self.batch():
+            self.speeds = [ float(speed) for speed in speeds ]
 
     def move_ids(self, speed, *motor_ids):
         speeds = self.speeds.copy()
@@ -46,14 +175,17 @@ class Car:
         self.move_speeds(*speeds)
 
     def move_all(self, speed):
-        self.move_idx(speed, 1, 2, 3, 4)
+        self.move_ids(speed, 1, 2, 3, 4)
 
     def stop(self, *motor_ids):
         self.move_ids(0, *motor_ids)
 
     def stop_all(self):
-        self.angle = 0
-        self.move_speeds(0, 0, 0, 0)
+        with self.batch('stop_all'):
+            self.angle = 0
+            self.move_speeds(0, 0, 0, 0)
+            # Always send a stop, since another client may have moved the car since
+            self._forget_sent()
 
     def reset(self):
         self.go = GO_DEFAULT
@@ -63,67 +195,81 @@ class Car:
         dgo = mag_int / 10
         new_go = max(MIN_SPEED, min(MAX_SPEED, self.go + dgo))
         if self.go != new_go:
-            self.move_ids(new_go, 1) if self.speeds[0] != STOP else self.stop(1)
-            self.move_ids(new_go, 2) if self.speeds[1] != STOP else self.stop(2)
-            self.move_ids(new_go, 3) if self.speeds[2] != STOP else self.stop(3)
-            self.move_ids(new_go, 4) if self.speeds[3] != STOP else self.stop(4)
+            with self.batch('change_speed'):
+                self.move_ids(new_go, 1) if self.speeds[0] != STOP else self.stop(1)
+                self.move_ids(new_go, 2) if self.speeds[1] != STOP else self.stop(2)
+                self.move_ids(new_go, 3) if self.speeds[2] != STOP else self.stop(3)
+                self.move_ids(new_go, 4) if self.speeds[3] != STOP else self.stop(4)
             self.go = new_go
 
     def move_angle(self, angle):
-        self.go = abs(self.go)
-        if abs(angle) < 3:
-            self.move_all(self.go)
-            return
-        self.angle = angle
-        right_turn = angle > 0
-        angle = abs(angle)
-
-        ninety_deg_sec = 2.6
-        turn_duration = np.round(ninety_deg_sec * (angle / 90), 2)
-
-        prev_speeds = self.speeds.copy()
+        """
+        Steers by the angle until the next command, like steer. It used to pivot for a time and then replay the speeds
+        from before the turn, which overlapping turns replayed out of date.
+        :param angle: The steering angle in degrees, positive to the right.
+        """
+        print("Rotating %2.2fdeg" % abs(angle))
+        with self.batch('move_angle'):
+            self.steer(angle)
 
-        print("Rotating %2.2fdeg" % angle)
-        self.stop_all()
-        if right_turn:
-            self.move_ids(self.go, 1, 3)
-        else:
-            self.move_ids(self.go, 2, 4)
-
-        Timer(turn_duration, lambda: self.move_speeds(prev_speeds), timeout=True).start()
+    def steer(self, angle):
+        """
+        Turns by driving each side at its own speed, as one command that does not wait on anything, so that steering
+        can follow every LKAS decision.
+        :param angle: The steering angle in degrees, positive to the right.
+        """
+        self.go = abs(self.go)
+        with self.batch('steer'):
+            self.angle = angle
+            self.move_speeds(*wheel_speeds(angle, self.go))
 
-    def move_lkas(self, img):
+    def move_lkas(self, img, headless=False, timestamp=None):
+        """
+        Steers by the lanes in an image.
+        :param timestamp: The capture time of the image in seconds since the epoch, to log how old it is when steered by.
+        :return: (image, steering angle or NaN if the car stopped, motor speeds), the image drawn on unless headless.
+        """
         current_angle = self.angle
-        next_angle, frame = get_steering_angle(img, current_angle, tape_color=self.tape_color)
+        next_angle, frame = get_steering_angle(img, current_angle, tape_color=self.tape_color, headless=headless, tracker=self.lane_tracker, pool=self.buffer_pool)
+        age = '' if timestamp is None else ' (frame %d ms old)' % ((time() - timestamp) * 1000)
         if next_angle is not None:
-            print("Rotating %1.4fdeg" % next_angle)
-            self.move_angle(next_angle)
+            print("Steering %1.4fdeg%s" % (next_angle, age))
+            self.steer(next_angle)
         else:
-            print("Stopping car")
+            print("Stopping car%s" % age)
             self.stop_all()
-        return frame.top()[0]
+        self.lkas_frames += 1
+        if profiler.enabled and self.lkas_frames % PROFILE_REPORT_FRAMES == 0:
+            print(profiler.report())
+            print(self.buffer_pool.report())
+        # Nothing was drawn in headless mode, so hand back the raw image
+        return img if headless else frame.top()[0], np.nan if next_angle is None else next_angle, self.speeds.copy()
 
     def move_forward(self):
         self.angle = 0
         self.go = abs(self.go)
-        self.move_ids(self.go, 1, 2, 3, 4)
+        with self.batch('move_forward'):
+            self.move_ids(self.go, 1, 2, 3, 4)
 
     def move_backward(self):
         self.angle = 0
         self.go = -abs(self.go)
-        self.move_ids(self.go, 1, 2, 3, 4)
+        with self.batch('move_backward'):
+            self.move_ids(self.go, 1, 2, 3, 4)
 
     def move_left(self):
         self.angle = -MAX_ANGLE
-        self.move_ids(self.go, 2, 4)
-        self.stop(1)
-        self.move_ids(self.go, 3) if not self.double_stop else self.stop(3)
+        with self.batch('move_left'):
+            self.move_ids(self.go, 2, 4)
+            self.stop(1)
+            self.move_ids(self.go, 3) if not self.double_stop else self.stop(3)
 
     def move_right(self):
         self.angle = MAX_ANGLE
-        self.move_ids(self.go, 1, 3)
-        self.stop(2)
-        self.move_ids(self.go, 4) if not self.double_stop else self.stop(4)
+        with self.batch('move_right'):
+            self.move_ids(self.go, 1, 3)
+            self.stop(2)
+            self.move_ids(self.go, 4) if not self.double_stop else self.stop(4)
 
     def toggle_double_stop(self, double_stop=None):
         self.double_stop = double_stop if double_stop is not None else (not self.double_stop)
@@ -7,6 +7,22 @@ DEFAULT_TAPE_COLOR = [105, 157, 252]
 
 # Networking
 CAR_PORT = 8080
+CAR_UDP_PORT = 8082
+# 'tcp' or 'udp' for motor commands
+CAR_TRANSPORT = 'tcp'
+
+# Over UDP, the car resends its speeds every HEARTBEAT_S seconds while moving,
+# and the server stops the motors when no command arrived for WATCHDOG_S seconds
+HEARTBEAT_S = 0.15
+WATCHDOG_S = 0.5
+
+# Command priorities. A command is rejected for PRIORITY_HOLD_S seconds after one with a higher priority.
+PRIORITY_AUTONOMY = 1
+PRIORITY_GAMEPAD = 2
+PRIORITY_HOLD_S = 1.0
+
+# Fastest telemetry stream a client can subscribe to, in messages per second
+TELEMETRY_MAX_HZ = 100
 
 # Car dimensions
 CAR_DIMS = {
@@ -17,6 +33,9 @@ CAR_DIMS = {
 # Stop on two wheels when turning?
 DOUBLE_STOP_DEFAULT = True
 
+# Frames between LKAS profiling reports, when LKAS_PROFILE is set
+PROFILE_REPORT_FRAMES = 160
+
 # Limits
 MIN_SPEED = 0.7
 MAX_SPEED = 0.95
@@ -0,0 +1,206 @@
+import sys
+from os.path import join, dirname
+from threading import Lock
+from time import perf_counter, sleep
+sys.path.append(join(dirname(__file__), '..'))
+
+from car.motor_driver import MOTOR_CHANNELS, LED0_ON_L, PWM_REGS, channel_regs, motor_duty_cycles
+
+"""
+Stand-ins for adafruit_motorkit.MotorKit, for running the car server's motor code off the Raspberry Pi.
+FakeMotorKit records throttle writes. SimulatedMotorKit models the PCA9685 behind a MotorKit and counts the I2C
+transactions reaching it.
+"""
+
+
+class FakeMotor:
+
+    def __init__(self, kit, channel):
+        self._kit = kit
+        self.channel = channel
+        self._throttle = None
+
+    @property
+    def throttle(self):
+        return self._throttle
+
+    @throttle.setter
+    def throttle(self, value):
+        self._throttle = value
+        self._kit._record(self.channel, value)
+
+
+class FakeMotorKit:
+    """
+    Has motor1 to motor4 like a MotorKit. Every throttle write is appended to writes as
+    (perf_counter timestamp, channel, throttle).
+    """
+
+    def __init__(self, write_delay=0.):
+        """
+        :param write_delay: Seconds each write blocks for, to stand in for the I2C transaction.
+        """
+        self.write_delay = write_delay
+        self.writes = []
+        self._lock = Lock()
+        self.motor1 = FakeMotor(self, 1)
+        self.motor2 = FakeMotor(self, 2)
+        self.motor3 = FakeMotor(self, 3)
+        self.motor4 = FakeMotor(self, 4)
+
+    def _record(self, channel, value):
+        if self.write_delay > 0:
+            sleep(self.write_delay)
+        with self._lock:
+            self.writes.append((perf_counter(), channel, value))
+
+    def writes_to(self, channel):
+        """
+        :return: The (timestamp, throttle) writes to one motor.
+        """
+        with self._lock:
+            return [ (timestamp, value) for timestamp, write_channel, value in self.writes if write_channel == channel ]
+
+    def clear(self):
+        with self._lock:
+            self.writes = []
+
+
+class SimulatedI2CDevice:
+    """
+    I2C bus to a simulated PCA9685, used like adafruit_bus_device's I2CDevice.
+    """
+
+    def __init__(self, pca, transaction_s=0.):
+        """
+        :param transaction_s: Seconds each transaction blocks for.
+        """
+        self._pca = pca
+        self.transaction_s = transaction_s
+        self._lock = Lock()
+        self.reads = 0
+        self.writes = 0
+        self.bytes = 0
+
+    @property
+    def transactions(self):
+        return self.reads + self.writes
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self._lock.release()
+
+    def _transact(self, size):
+        if self.transaction_s > 0:
+            sleep(self.transaction_s)
+        self.bytes += size
+
+    def write(self, buf):
+        """
+        Writes registers from buf[0] on, auto-incrementing through them.
+        """
+        self._transact(len(buf))
+        self.writes += 1
+        channel, offset = divmod(buf[0] - LED0_ON_L, 4)
+        if offset != 0 or (len(buf) - 1) % PWM_REGS.size != 0:
+            raise ValueError('Only whole channels can be written')
+        for i in range((len(buf) - 1) // PWM_REGS.size):
+            self._pca.regs[channel + i] = PWM_REGS.unpack_from(buf, 1 + i * PWM_REGS.size)
+
+    def write_then_readinto(self, out_buf, in_buf):
+        """
+        Reads the registers of whole channels from out_buf[0] on into in_buf.
+        """
+        self._transact(len(out_buf) + len(in_buf))
+        self.reads += 1
+        channel = (out_buf[0] - LED0_ON_L) // 4
+        for i in range(len(in_buf) // PWM_REGS.size):
+            PWM_REGS.pack_into(in_buf, i * PWM_REGS.size, *self._pca.regs[channel + i])
+
+
+class SimulatedPWMChannel:
+    """
+    A PCA9685 channel, where every duty cycle read or write is an I2C transaction, as in adafruit_pca9685.
+    """
+
+    def __init__(self, pca, index):
+        self._pca = pca
+        self._index = index
+
+    @property
+    def duty_cycle(self):
+        data = bytearray(PWM_REGS.size)
+        with self._pca.i2c_device as i2c:
+            i2c.write_then_readinto(bytes([ LED0_ON_L + 4 * self._index ]), data)
+        on, off = PWM_REGS.unpack(data)
+        if on == 0x1000:
+            return 0xFFFF
+        if off == 0x1000:
+            return 0
+        return off << 4
+
+    @duty_cycle.setter
+    def duty_cycle(self, value):
+        data = bytes([ LED0_ON_L + 4 * self._index ]) + PWM_REGS.pack(*channel_regs(value))
+        with self._pca.i2c_device as i2c:
+            i2c.write(data)
+
+
+class SimulatedPCA9685:
+
+    def __init__(self, transaction_s=0.):
+        self.regs = [ (0, 0x1000) for _ in range(16) ]
+        self.i2c_device = SimulatedI2CDevice(self, transaction_s)
+        self.channels = [ SimulatedPWMChannel(self, i) for i in range(16) ]
+
+
+class SimulatedDCMotor:
+    """
+    A motor driven by two channels, with the throttle logic of adafruit_motor's DCMotor in fast decay mode.
+    """
+
+    def __init__(self, positive, negative):
+        self._positive = positive
+        self._negative = negative
+
+    @property
+    def throttle(self):
+        positive, negative = self._positive.duty_cycle, self._negative.duty_cycle
+        if positive == 0 and negative == 0:
+            return None
+        if positive == 0xFFFF and negative == 0xFFFF:
+            return 0.
+        if negative > 0:
+            return -negative / 0xFFFF
+        return positive / 0xFFFF
+
+    @throttle.setter
+    def throttle(self, value):
+        if value is not None and (value > 1.0 or value < -1.0):
+            raise ValueError('Throttle must be None or between -1.0 and +1.0')
+        positive, negative = motor_duty_cycles(value)
+        self._positive.duty_cycle = positive
+        self._negative.duty_cycle = negative
+
+
+class SimulatedMotorKit:
+    """
+    Has motor1 to motor4 on a simulated PCA9685, wired like a MotorKit. i2c counts the transactions.
+    """
+
+    def __init__(self, transaction_s=0.):
+        """
+        :param transaction_s: Seconds each I2C transaction blocks for.
+        """
+        self._pca = SimulatedPCA9685(transaction_s)
+        for i, (pwm, in1, in2) in enumerate(MOTOR_CHANNELS):
+            # MotorKit holds the PWM channel fully on and drives the inputs
+            self._pca.channels[pwm].duty_cycle = 0xFFFF
+            setattr(self, 'motor%d' % (i + 1), SimulatedDCMotor(self._pca.channels[in1], self._pca.channels[in2]))
+
+    @property
+    def i2c(self):
+        return self._pca.i2c_device
@@ -0,0 +1,160 @@
+import sys
+import struct
+from os.path import join, dirname
+sys.path.append(join(dirname(__file__), '..'))
+
+"""
+Motor driver layer between the car server and a MotorKit, which keeps I2C traffic to the PCA9685 down.
+"""
+
+# PCA9685 (PWM, IN1, IN2) channels of motors 1 to 4, as wired by adafruit_motorkit
+MOTOR_CHANNELS = [ (8, 9, 10), (13, 11, 12), (2, 3, 4), (7, 5, 6) ]
+
+# Register of channel 0's ON_L. Each channel has four registers, ON_L, ON_H, OFF_L and OFF_H.
+LED0_ON_L = 0x06
+# ON and OFF counts of a channel
+PWM_REGS = struct.Struct('<HH')
+
+# Unchanged channels written again to join two runs into one transaction. Each costs 4 bytes on the bus, while a
+# transaction costs a start, the device address, the register address and a stop.
+MAX_BRIDGE = 2
+
+
+def channel_regs(duty_cycle):
+    """
+    :return: The (ON, OFF) registers adafruit_pca9685 writes for a 16 bit duty cycle.
+    """
+    if duty_cycle == 0xFFFF:
+        return (0x1000, 0)
+    if duty_cycle < 0x0010:
+        return (0, 0x1000)
+    return (0, duty_cycle >> 4)
+
+
+def motor_duty_cycles(throttle):
+    """
+    :return: The (IN1, IN2) duty cycles adafruit_motor's DCMotor sets for a throttle in fast decay mode.
+    """
+    if throttle is None:
+        # Coast
+        return 0, 0
+    if throttle == 0:
+        # Brake
+        return 0xFFFF, 0xFFFF
+    duty_cycle = int(0xFFFF * abs(throttle))
+    return (0, duty_cycle) if throttle < 0 else (duty_cycle, 0)
+
+
+def kit_i2c_device(kit):
+    """
+    The only place the driver reaches into a MotorKit's internals. adafruit_motorkit keeps its PCA9685 in the private
+    attribute _pca, so a release that renames it, or a kit without one, makes the driver set motorN.throttle instead.
+    :return: The I2C device of the kit's PCA9685, or None if the kit does not have one.
+    """
+    pca = getattr(kit, '_pca', None)
+    return getattr(pca, 'i2c_device', None)
+
+
+def _runs(channels, known, max_bridge=0):
+    """
+    :param known: Channels whose registers are cached, which can be written again to bridge a gap.
+    :return: The channels split into runs of consecutive channels.
+    """
+    runs = []
+    for channel in sorted(channels):
+        if len(runs) > 0:
+            gap = range(runs[-1][-1] + 1, channel)
+            if len(gap) <= max_bridge and all(bridged in known for bridged in gap):
+                runs[-1] += list(gap) + [ channel ]
+                continue
+        runs.append([ channel ])
+    return runs
+
+
+class MotorDriver:
+    """
+    Sets the throttles of a MotorKit's four motors, skipping writes of values a channel already has and writing
+    consecutive channels in one I2C transaction.
+
+    The registers last written are cached, so nothing else may write to the motors behind the driver's back.
+    Without the kit's PCA9685 (see kit_i2c_device), such as with a FakeMotorKit, it falls back to setting each changed
+    motor's throttle.
+    """
+
+    def __init__(self, kit, cache=True, batch=True):
+        """
+        :param kit: A MotorKit, or a stand-in such as SimulatedMotorKit.
+        :param cache: Skip channels whose registers would not change.
+        :param batch: Write runs of consecutive channels together, using the PCA9685's register auto-increment.
+        """
+        self.motors = [ kit.motor1, kit.motor2, kit.motor3, kit.motor4 ]
+        self.cache = cache
+        self.batch = batch
+        self._i2c_device = kit_i2c_device(kit)
+        self._regs = {}
+        self._throttles = [ None for _ in self.motors ]
+        self.commands = 0
+        self.requested = 0
+        self.skipped = 0
+        self.transactions = 0
+
+    def throttles(self):
+        """
+        :return: The throttles last set, or None for motors never set. The motors are not read.
+        """
+        return list(self._throttles)
+
+    def set_throttles(self, throttles):
+        """
+        Sets the throttle of every motor.
+        :param throttles: Four throttles, where None leaves a motor as it is.
+        :return: The I2C transactions used.
+        """
+        start = self.transactions
+        self.commands += 1
+        changed = {}
+        for i, throttle in enumerate(throttles):
+            if throttle is None:
+                continue
+            self.requested += 1
+            if self.cache and self._throttles[i] == throttle:
+                self.skipped += 1
+                continue
+            changed[i] = throttle
+            self._throttles[i] = throttle
+
+        if self._i2c_device is None:
+            for i, throttle in changed.items():
+                self.motors[i].throttle = throttle
+                # A DCMotor writes both of its input channels
+                self.transactions += 2
+            return self.transactions - start
+
+        regs = {}
+        for i, throttle in changed.items():
+            _, in1, in2 = MOTOR_CHANNELS[i]
+            for channel, duty_cycle in zip([ in1, in2 ], motor_duty_cycles(throttle)):
+                value = channel_regs(duty_cycle)
+                if self.cache and self._regs.get(channel) == value:
+                    continue
+                regs[channel] = value
+        self._regs.update(regs)
+        runs = _runs(regs, self._regs, MAX_BRIDGE) if self.batch else [ [ channel ] for channel in sorted(regs) ]
+        for run in runs:
+            data = bytes([ LED0_ON_L + 4 * run[0] ]) + b''.join(PWM_REGS.pack(*self._regs[channel]) for channel in run)
+            with self._i2c_device as i2c:
+                i2c.write(data)
+            self.transactions += 1
+        return self.transactions - start
+
+    def stats(self):
+        """
+        :return: A dict of commands, motor writes requested and skipped, and I2C transactions in total and per command.
+        """
+        return {
+            'commands': self.commands,
+            'requested': self.requested,
+            'skipped': self.skipped,
+            'transactions': self.transactions,
+            'transactions_per_command': self.transactions / self.commands if self.commands > 0 else 0.
+        }
@@ -0,0 +1,114 @@
+import sys
+from os.path import join, dirname
+from threading import Lock
+sys.path.append(join(dirname(__file__), '..'))
+
+from util.timer import Timer
+from car.car_constants import MIN_SPEED, MAX_SPEED
+
+"""
+Fixed-rate throttle ramping for the four motors, independent of the motor library so it can run against a stand-in kit.
+"""
+
+# Ticks per second
+RAMP_RATE_HZ = 100
+# Largest throttle change per motor per tick
+RAMP_INCREMENT = 0.1
+
+
+def clamp_speed(speed):
+    """
+    :return: The throttle a speed is driven at. Non-zero speeds are kept between MIN_SPEED and MAX_SPEED.
+    """
+    if speed == 0:
+        return 0.
+    sign = 1 if speed > 0 else -1
+    return min(MAX_SPEED, max(MIN_SPEED, abs(speed))) * sign
+
+
+class RampEngine:
+    """
+    Steps every motor's throttle toward its target on each tick of a timer, all motors on the same tick.
+    set_targets() only swaps the targets, so it never waits on a ramp, and a new command takes over from wherever the
+    ramp in flight got to.
+    """
+
+    def __init__(self, driver, rate_hz=RAMP_RATE_HZ, increment=RAMP_INCREMENT):
+        """
+        :param driver: The MotorDriver of the motors.
+        :param rate_hz: Ticks per second.
+        :param increment: Largest throttle change per motor per tick.
+        """
+        self.driver = driver
+        self.increment = increment
+        # Throttles as last written, so the motors are never read back
+        self._throttles = [ throttle or 0. for throttle in driver.throttles() ]
+        self._targets = list(self._throttles)
+        self._lock = Lock()
+        self.commands = 0
+        self.writes = 0
+        self._timer = Timer(1 / rate_hz, self._tick, policy=Timer.SKIP)
+
+    def start(self):
+        self._timer.start()
+        return self
+
+    def stop(self):
+        self._timer.stop()
+
+    def set_targets(self, speeds):
+        """
+        Replaces the targets of the motors. Returns right away.
+        """
+        targets = [ clamp_speed(speed) for speed in speeds ]
+        with self._lock:
+            self._targets = targets
+            self.commands += 1
+
+    def halt(self):
+        """
+        Stops the ramping and cuts every motor right away.
+        """
+        self.stop()
+        with self._lock:
+            self._targets = [ 0. for _ in self._targets ]
+            self._throttles = [ 0. for _ in self._throttles ]
+            self.driver.set_throttles(self._throttles)
+
+    def state(self):
+        """
+        :return: (throttles as last written, target throttles) of the motors.
+        """
+        with self._lock:
+            return list(self._throttles), list(self._targets)
+
+    def is_settled(self):
+        with self._lock:
+            return self._throttles == self._targets
+
+    def _tick(self):
+        with self._lock:
+            changed = False
+            for i, target in enumerate(self._targets):
+                throttle = self._throttles[i]
+                if throttle == target:
+                    continue
+                if target == 0 or abs(target - throttle) <= self.increment:
+                    # Stop at once, as the motors always have
+                    throttle = target
+                else:
+                    throttle += self.increment if target > throttle else -self.increment
+                self._throttles[i] = throttle
+                self.writes += 1
+                changed = True
+            if changed:
+                # All the motors of a tick go to the driver together
+                self.driver.set_throttles(self._throttles)
+
+    def stats(self):
+        return {
+            'commands': self.commands,
+            'writes': self.writes,
+            'driver': self.driver.stats(),
+            'timer': self._timer.stats()
+        }
@@ -0,0 +1,73 @@
+import sys
+import numpy as np
+from os.path import join, dirname
+sys.path.append(join(dirname(__file__), '..'))
+
+from car.car_constants import CAR_DIMS, MIN_SPEED, MAX_SPEED, MAX_ANGLE
+
+"""
+Differential drive steering, turning the car by driving its left and right wheels at different speeds.
+"""
+
+
+def drivable_speed(speed):
+    """
+    Motors stall below MIN_SPEED, so a speed is moved to the nearest one they can hold: stopped, or between MIN_SPEED
+    and MAX_SPEED either way.
+    :return: The speed, rounded to hundredths so that nearby speeds send the same command.
+    """
+    magnitude = abs(speed)
+    if magnitude < MIN_SPEED / 2:
+        return 0.
+    magnitude = min(MAX_SPEED, max(MIN_SPEED, magnitude))
+    return float(np.round(magnitude if speed > 0 else -magnitude, 2))
+
+
+def _held_ratio(outer, ratio):
+    """
+    Picks drivable outer and inner wheel speeds for a ratio of inner to outer speed.
+    Both sides can only turn between MIN_SPEED and MAX_SPEED, so the ratios they can hold are 1 down to
+    MIN_SPEED / MAX_SPEED (about 0.74), 0 with the inner wheels stopped, and -MIN_SPEED / MAX_SPEED down to -1.
+    :param outer: The drivable speed of the outer wheels, which is not 0.
+    :return: (outer speed, inner speed) before rounding.
+    """
+    inner = outer * ratio
+    if abs(inner) >= MIN_SPEED:
+        return outer, inner
+    held = MIN_SPEED / MAX_SPEED
+    if abs(ratio) >= held:
+        # Speed the outer wheels up so that the inner ones turn at MIN_SPEED and the ratio survives
+        return MIN_SPEED / abs(ratio) * np.sign(outer), MIN_SPEED * np.sign(inner)
+    # Any slower inner wheels would stall, so take the nearest ratio the motors can hold
+    if abs(ratio) >= held / 2:
+        return MAX_SPEED * np.sign(outer), MIN_SPEED * np.sign(inner)
+    return outer, 0.
+
+
+def wheel_speeds(angle, speed, dims=CAR_DIMS):
+    """
+    Maps a steering angle to speeds for the four wheels.
+    The car turns about the point a front wheel steered by the angle would turn about, at a radius of
+    wheelbase / tan(angle) from the middle of the rear axle. The outer wheels keep the given speed and the inner
+    wheels slow down in proportion to their radius, down to spinning backwards to pivot in place at 90 degrees.
+    Where the inner wheels would drop below MIN_SPEED, the outer wheels speed up to keep the ratio between them, so
+    turns stay continuous up to about 19 degrees. The motors cannot hold the ratios of sharper turns, so from there
+    to about 86 degrees the turn is quantized to three levels: inner wheels at MIN_SPEED with the outer ones at
+    MAX_SPEED up to 46 degrees, inner wheels stopped up to 78 degrees, then inner wheels backwards at MIN_SPEED.
+    Past that it is continuous again.
+    :param angle: The steering angle in degrees, positive to the right.
+    :param speed: The speed of the outer wheels.
+    :return: The speeds of wheels 1, 2, 3 and 4.
+    """
+    angle = np.radians(min(MAX_ANGLE, max(-MAX_ANGLE, angle)))
+    wheelbase, track = dims['WHEELBASE_CM'], dims['TRACK_CM']
+    # (radius - track / 2) / (radius + track / 2), without dividing by tan(angle) near 90 degrees
+    reach, offset = 2 * wheelbase * np.cos(angle), track * abs(np.sin(angle))
+    ratio = (reach - offset) / (reach + offset)
+    outer = drivable_speed(speed)
+    if outer == 0:
+        return [ 0., 0., 0., 0. ]
+    outer, inner = map(drivable_speed, _held_ratio(outer, ratio))
+    left, right = (outer, inner) if angle >= 0 else (inner, outer)
+    # Wheels 1, 2, 3, 4 -> top-left, top-right, bottom-left, bottom-right
+    return [ left, right, left, right ]
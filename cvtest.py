@@ -1,10 +1,11 @@
 import cv2
 from sys import argv
-from time import sleep
+from time import sleep, time
 
-from auto.camera import get_single_frame
+from auto.camera import get_latest_frame
 from auto.lkas import get_steering_angle
 from auto.frame import WhiteBalance
+from auto.recording import RecordingReader
 
 """
 Abstract: Use this for testing CV functions.
@@ -17,6 +18,10 @@ Examples:
     
     For video:
     python3 cvtest.py -1 video
+
+    To play back a recording frame-by-frame or as video:
+    python3 cvtest.py -1 fbf train_data_dark.rec
+    python3 cvtest.py -1 video train_data_dark.rec
 """
 
 # Tape colors
@@ -31,6 +36,7 @@ layer_idx = int(argv[1]) if len(argv) > 1 else -1
 
 fbf = len(argv) > 2 and argv[2] == 'fbf'
 video = len(argv) > 2 and argv[2] == 'video'
+recording = argv[3] if (fbf or video) and len(argv) > 3 else None
 single = len(argv) == 2 or (len(argv) == 3 and argv[2].isdigit())
 
 TRAIN_DATA = 'train_data_dark'
@@ -40,8 +46,8 @@ if single:
     # Get the frame
     idx = int(argv[2]) if len(argv) > 2 else 1
     if idx == 0:
-        img = get_single_frame()
-        print('captured image')
+        img, timestamp = get_latest_frame()
+        print('captured image %d ms ago' % ((time() - timestamp) * 1000))
     else:
         print('image %d.png' % idx, end='\r')
         img = cv2.imread('auto/train_data/%s/%d.png' % (TRAIN_DATA, idx))
@@ -53,16 +59,29 @@ if single:
     layer_idx = int(argv[1]) if len(argv) > 1 else -1
     frame.show(layer_idx)
 
-if fbf or video:
-    # Run through all images
-    curr_steering_angle = 0
+
+def train_data_images():
     i = 1
     while True:
         img = cv2.imread('auto/train_data/%s/%d.png' % (TRAIN_DATA, i))
         if img is None:
             break
         print('image %d.png' % i, end='\r')
+        yield img
+        i += 1
+
 
+def recording_images(path):
+    reader = RecordingReader(path)
+    for i in range(len(reader)):
+        print('frame %d/%d' % (i + 1, len(reader)), end='\r')
+        yield reader.read(i)
+
+
+if fbf or video:
+    # Run through all images
+    curr_steering_angle = 0
+    for img in (train_data_images() if recording is None else recording_images(recording)):
         # Get the steering angle
         angle, frame = get_steering_angle(img, curr_steering_angle=curr_steering_angle, stabilize=True, tape_color=tape_color, white_balance=white_balance)
         curr_steering_angle = angle
@@ -71,5 +90,4 @@ if fbf or video:
         frame.show(layer_idx, 1 if video else 0)
         if video:
             sleep(0.1)
-        i += 1
     print('')
@@ -3,7 +3,7 @@ from time import sleep
 from auto.camera import get_frame_by_frame
 from auto.lkas import get_steering_angle
 
-def hud(img):
+def hud(img, timestamp=None):
     angle, frame = get_steering_angle(img)
     img = frame.top()[0]
     return img
@@ -0,0 +1,118 @@
+import numpy as np
+from os import listdir
+from sys import argv, exit
+from time import perf_counter
+
+from auto.frame import Frame, Filter
+from auto.lkas import get_steering_angle
+from lkasbench import TRAIN_DATA_DIR, load_dataset, tape_color, white_balance
+
+"""
+Abstract: Microbenchmarks lane fitting with a Python loop over the Hough segments against the vectorized fit.
+Checks that every segment's fit is within FIT_TOLERANCE of np.polyfit, and exits with 1 if any is not.
+Lane lines can still differ on frames with horizontal segments: np.polyfit gives them a slope of +-epsilon, whose sign
+is rounding noise and puts them in either lane, where the vectorized fit gives them exactly 0 and leaves them out.
+Examples:
+    To benchmark every dataset in auto/train_data:
+    python3 lanebench.py
+
+    To benchmark a single dataset:
+    python3 lanebench.py train_data_dark
+"""
+
+REPEATS = 5
+# Relative and absolute tolerance of the vectorized fits against np.polyfit
+FIT_TOLERANCE = 1e-9
+
+
+def fit_lane_segments_loop(lines, width):
+    """
+    The original per-segment fit, kept as the reference implementation.
+    """
+    left_fit = []
+    right_fit = []
+
+    boundary = 1 / 3
+    left_region_boundary = width * (1 - boundary)
+    right_region_boundary = width * boundary
+
+    for line in lines:
+        for x1, y1, x2, y2 in line:
+            if x1 == x2:
+                continue
+            fit = np.polyfit((x1, x2), (y1, y2), 1)
+            slope = fit[0]
+            intercept = fit[1]
+            if slope < 0 and x1 < left_region_boundary and x2 < left_region_boundary:
+                left_fit.append((slope, intercept))
+            elif slope > 0 and x1 > right_region_boundary and x2 > right_region_boundary:
+                right_fit.append((slope, intercept))
+
+    return left_fit, right_fit
+
+
+def get_hough_lines(img):
+    _, frame = get_steering_angle(img, stabilize=False, tape_color=tape_color, white_balance=white_balance)
+    layer = frame.layer_of(Filter.LINE_DETECTION)
+    return None if layer is None else frame.get(layer)[1]
+
+
+def fits_close(lines):
+    """
+    :return: True if the vectorized fit of every non-vertical segment is within FIT_TOLERANCE of np.polyfit.
+    """
+    if lines is None:
+        return True
+    segments = lines.reshape(-1, 4).astype(np.float64)
+    segments = segments[segments[:, 0] != segments[:, 2]]
+    reference = np.array([ np.polyfit((x1, x2), (y1, y2), 1) for x1, y1, x2, y2 in segments ]).reshape(-1, 2)
+    fits = Frame._polyfit_segments(*segments.T)
+    return np.allclose(fits, reference, rtol=FIT_TOLERANCE, atol=FIT_TOLERANCE)
+
+
+def detect_lanes(samples, fit):
+    """
+    Runs lane detection over (image, lines) samples with the given fitting function.
+    :return: (seconds per frame, lane lines of each frame)
+    """
+    vectorized_fit = Frame._fit_lane_segments
+    Frame._fit_lane_segments = staticmethod(fit)
+    try:
+        lanes = []
+        start = perf_counter()
+        for _ in range(REPEATS):
+            lanes = [ Frame._filter_lane_detection(img, lines, img, draw=False)[1] for img, lines in samples ]
+        elapsed = perf_counter() - start
+    finally:
+        Frame._fit_lane_segments = staticmethod(vectorized_fit)
+    return elapsed / (REPEATS * len(samples)), lanes
+
+
+if __name__ == "__main__":
+    datasets = argv[1:] if len(argv) > 1 else sorted(listdir(TRAIN_DATA_DIR))
+
+    print('%-20s %10s %10s %10s %10s %10s %10s %8s' % ('dataset', 'segments', 'loop ms', 'vector ms', 'speedup',
+                                                      'fits ok', 'same lanes', 'max px'))
+    failed = []
+    for name in datasets:
+        samples = [ (img, get_hough_lines(img)) for img in load_dataset(name) ]
+        if len(samples) == 0:
+            print('%-20s no images' % name)
+            continue
+        segments = np.mean([ 0 if lines is None else len(lines) for _, lines in samples ])
+        loop_time, loop_lanes = detect_lanes(samples, fit_lane_segments_loop)
+        vector_time, vector_lanes = detect_lanes(samples, Frame._fit_lane_segments)
+        close = sum(fits_close(lines) for _, lines in samples)
+        same = sum(np.array_equal(a, b) for a, b in zip(loop_lanes, vector_lanes))
+        # Largest endpoint difference between frames that found the same number of lanes
+        max_px = max([ np.abs(np.array(a) - np.array(b)).max() for a, b in zip(loop_lanes, vector_lanes)
+                       if len(a) == len(b) and len(a) > 0 ] + [0])
+        print('%-20s %10.1f %10.3f %10.3f %9.1fx %10s %10s %8d' % (name, segments, loop_time * 1000, vector_time * 1000,
+                                                                   loop_time / vector_time, '%d/%d' % (close, len(samples)),
+                                                                   '%d/%d' % (same, len(samples)), max_px))
+        if close != len(samples):
+            failed.append(name)
+
+    if len(failed) > 0:
+        print('Vectorized fit is not within %g of np.polyfit on: %s' % (FIT_TOLERANCE, ', '.join(failed)))
+        exit(1)
@@ -0,0 +1,99 @@
+import cv2
+import tracemalloc
+from os import listdir
+from os.path import join, dirname, realpath
+from sys import argv
+from time import perf_counter
+
+from auto.lkas import get_steering_angle
+from auto.frame import WhiteBalance
+from auto.lane_tracker import LaneTracker
+from auto.buffer_pool import BufferPool
+
+"""
+Abstract: Benchmarks the LKAS pipeline in debug mode against headless drive mode,
+with and without the color lookup table, region-first cropping, lane tracking and the buffer pool.
+Examples:
+    To benchmark every dataset in auto/train_data:
+    python3 lkasbench.py
+
+    To benchmark a single dataset:
+    python3 lkasbench.py train_data_dark
+"""
+
+TRAIN_DATA_DIR = join(dirname(realpath(__file__)), 'auto', 'train_data')
+
+tape_color = [105, 157, 252]
+white_balance = WhiteBalance.TUNGSTEN
+
+# Label -> get_steering_angle options
+MODES = [
+    ('debug', {}),
+    ('headless', { 'headless': True }),
+    # Experimental, approximate and slower than headless
+    ('lut', { 'headless': True, 'color_lut': True }),
+    ('roi', { 'headless': True, 'roi_first': True }),
+    ('tracked', { 'headless': True, 'tracker': LaneTracker() }),
+    ('pooled', { 'headless': True, 'pool': BufferPool() }),
+]
+
+
+def load_dataset(name):
+    images = []
+    i = 1
+    while True:
+        img = cv2.imread(join(TRAIN_DATA_DIR, name, '%d.png' % i))
+        if img is None:
+            break
+        images.append(img)
+        i += 1
+    return images
+
+
+def run(img, options):
+    return get_steering_angle(img, stabilize=False, tape_color=tape_color, white_balance=white_balance, **options)
+
+
+def time_per_frame(images, options):
+    start = perf_counter()
+    for img in images:
+        run(img, options)
+    return (perf_counter() - start) / len(images)
+
+
+def memory_per_frame(images, options):
+    """
+    :return: (mean peak bytes allocated while processing a frame, mean bytes still held by the result)
+    """
+    peak_total = 0
+    retained_total = 0
+    tracemalloc.start()
+    for img in images:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        result = run(img, options)
+        current, peak = tracemalloc.get_traced_memory()
+        peak_total += peak - before
+        retained_total += current - before
+        del result
+    tracemalloc.stop()
+    return peak_total / len(images), retained_total / len(images)
+
+
+if __name__ == "__main__":
+    datasets = argv[1:] if len(argv) > 1 else sorted(listdir(TRAIN_DATA_DIR))
+
+    print('%-20s %-8s %10s %12s %14s' % ('dataset', 'mode', 'ms/frame', 'peak KB', 'retained KB'))
+    for name in datasets:
+        images = load_dataset(name)
+        if len(images) == 0:
+            print('%-20s no images' % name)
+            continue
+        for mode, options in MODES:
+            if 'tracker' in options:
+                options['tracker'].reset()
+            # Warm up OpenCV and the lookup table cache before timing
+            run(images[0], options)
+            latency = time_per_frame(images, options)
+            peak, retained = memory_per_frame(images, options)
+            print('%-20s %-8s %10.2f %12.1f %14.1f' % (name, mode, latency * 1000, peak / 1024, retained / 1024))
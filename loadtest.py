@@ -0,0 +1,111 @@
+import argparse
+import numpy as np
+from multiprocessing import Process
+from threading import Thread, Lock
+from time import perf_counter, sleep
+
+from car.async_car_server import AsyncCarServer
+from car.car_constants import PRIORITY_AUTONOMY, PRIORITY_GAMEPAD
+from car.fake_motor_kit import FakeMotorKit
+from netbench import free_port
+from util.networking import SocketClient, MessageType, encode_speeds, encode_priority, encode_subscribe
+
+"""
+Abstract: Load tests the AsyncCarServer on a FakeMotorKit with many local clients at once.
+Autonomy clients send commands at a fixed rate for the whole run, a gamepad client sends commands during the middle
+third of it, and subscribers stream telemetry. Reports command round trip latency, how many commands the gamepad
+overrode, and the telemetry rate each subscriber got.
+Examples:
+    To run 32 autonomy clients at 20 commands/sec and 4 subscribers at 50 Hz for 6 seconds:
+    python3 loadtest.py
+
+    To run 100 autonomy clients for 10 seconds:
+    python3 loadtest.py --clients 100 --duration 10
+"""
+
+SPEEDS = [ 0.95, 0, 0.95, 0 ]
+
+
+def run_server(port):
+    AsyncCarServer(FakeMotorKit(), port=port).run()
+
+
+def run_commands(port, priority, rate, start, stop, results, lock):
+    """
+    Sends commands at a fixed rate between start and stop seconds into the run, waiting for each response.
+    """
+    client = SocketClient(port, hello=encode_priority(priority))
+    latencies, types = [], []
+    epoch = results['epoch']
+    tick = 0
+    while perf_counter() - epoch < start:
+        sleep(0.01)
+    while True:
+        deadline = epoch + start + tick / rate
+        if deadline > epoch + stop:
+            break
+        sleep(max(0., deadline - perf_counter()))
+        sent = perf_counter()
+        client.send(encode_speeds(SPEEDS, client.next_seq()), lambda res: types.append(res.type))
+        latencies.append(perf_counter() - sent)
+        tick += 1
+    client.close()
+    with lock:
+        results[priority]['latencies'] += latencies
+        results[priority]['applied'] += types.count(MessageType.ACK)
+        results[priority]['rejected'] += types.count(MessageType.REJECTED)
+
+
+def run_subscriber(port, rate, duration, results, lock):
+    arrivals = []
+    client = SocketClient(port, pipeline=True, on_push=lambda msg: arrivals.append(perf_counter()))
+    client.send(encode_subscribe(rate))
+    sleep(duration)
+    client.send(encode_subscribe(0))
+    client.close()
+    with lock:
+        results['telemetry'].append(arrivals)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load tests the AsyncCarServer with many local clients.')
+    parser.add_argument('--clients', type=int, default=32, help='number of autonomy clients')
+    parser.add_argument('--rate', type=float, default=20, help='commands/sec per client')
+    parser.add_argument('--subscribers', type=int, default=4, help='number of telemetry subscribers')
+    parser.add_argument('--telemetry-hz', type=float, default=50, help='telemetry rate per subscriber')
+    parser.add_argument('--duration', type=float, default=6, help='seconds to run')
+    args = parser.parse_args()
+
+    port = free_port()
+    server = Process(target=run_server, args=(port,), daemon=True)
+    server.start()
+    sleep(0.5)
+
+    lock = Lock()
+    results = { 'epoch': perf_counter() + 0.5, 'telemetry': [] }
+    for priority in [ PRIORITY_AUTONOMY, PRIORITY_GAMEPAD ]:
+        results[priority] = { 'latencies': [], 'applied': 0, 'rejected': 0 }
+    third = args.duration / 3
+    threads = [ Thread(target=run_commands, args=(port, PRIORITY_AUTONOMY, args.rate, 0, args.duration, results, lock))
+                for _ in range(args.clients) ]
+    threads.append(Thread(target=run_commands, args=(port, PRIORITY_GAMEPAD, args.rate, third, 2 * third, results, lock)))
+    threads += [ Thread(target=run_subscriber, args=(port, args.telemetry_hz, args.duration, results, lock))
+                 for _ in range(args.subscribers) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.terminate()
+
+    print('%d autonomy clients at %.0f commands/sec, 1 gamepad client for %.1fs, %d subscribers at %.0f Hz' % (
+        args.clients, args.rate, third, args.subscribers, args.telemetry_hz))
+    print('%-10s %9s %9s %9s %10s %10s %10s %10s' % ('source', 'commands', 'applied', 'rejected', 'rtt p50', 'rtt p95', 'rtt p99', 'rtt max'))
+    for name, priority in [ ('autonomy', PRIORITY_AUTONOMY), ('gamepad', PRIORITY_GAMEPAD) ]:
+        result = results[priority]
+        rtt = np.array(result['latencies']) * 1000
+        print('%-10s %9d %9d %9d %8.3fms %8.3fms %8.3fms %8.3fms' % (name, len(rtt), result['applied'], result['rejected'],
+              np.percentile(rtt, 50), np.percentile(rtt, 95), np.percentile(rtt, 99), rtt.max()))
+    rates = [ len(arrivals) / args.duration for arrivals in results['telemetry'] ]
+    gaps = np.concatenate([ np.diff(arrivals) for arrivals in results['telemetry'] ]) * 1000
+    print('Telemetry: %.1f - %.1f messages/sec per subscriber, gap p50 %.1fms, max %.1fms' % (
+        min(rates), max(rates), np.percentile(gaps, 50), gaps.max()))
@@ -1,7 +1,9 @@
 from util.controller import Controller
 from util.audio import play_sound, speak
 from car.car_server import CarServer
+from car.async_car_server import AsyncCarServer
 from multiprocessing import Process
+from sys import argv
 from time import sleep
 
 # Notify the operator of the device IP
@@ -15,11 +17,14 @@ OUTDOOR_BLUE_COLOR = [0, 192, 250]
 # Color of the current tape
 tape_color = INDOOR_BLUE_COLOR
 
+# Run with `async` to serve the car on the asyncio server, with priorities, telemetry and UDP commands
+use_async_server = len(argv) > 1 and argv[1] == 'async'
+
 """
 1. Start car server in another process.
 """
 
-Process(target=lambda: CarServer()).start()
+Process(target=lambda: AsyncCarServer().run() if use_async_server else CarServer()).start()
 sleep(2)
 
 """
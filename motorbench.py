@@ -0,0 +1,104 @@
+from sys import argv
+from time import sleep
+
+from car.car_constants import GO_DEFAULT, MIN_SPEED, MAX_SPEED
+from car.fake_motor_kit import SimulatedMotorKit
+from car.motor_driver import MotorDriver
+from car.ramp_engine import RampEngine
+
+"""
+Abstract: Counts the I2C transactions a drive's worth of motor commands takes on a SimulatedMotorKit, comparing the
+CarServer's old ramp, which reads and writes each motor directly, against the RampEngine on a MotorDriver with and
+without its write cache and batched writes.
+Examples:
+    To compare with 0.25 ms per transaction, about a 6 byte write at 400 kHz:
+    python3 motorbench.py
+
+    To compare with 0.6 ms per transaction, about 100 kHz:
+    python3 motorbench.py 0.6
+"""
+
+GO = GO_DEFAULT
+SLOW = GO_DEFAULT - 0.1
+
+# Speeds the car sends while driving, in order
+TRACE = [
+    [ GO, GO, GO, GO ],         # move_forward
+    [ GO, GO, GO, GO ],         # move_forward again
+    [ 0, GO, 0, GO ],           # move_left
+    [ GO, GO, GO, GO ],         # move_forward
+    [ GO, 0, GO, 0 ],           # move_right
+    [ SLOW, 0, SLOW, 0 ],       # change_speed
+    [ SLOW, SLOW, SLOW, SLOW ], # move_forward
+    [ -SLOW, -SLOW, -SLOW, -SLOW ], # move_backward
+    [ 0, 0, 0, 0 ],             # stop_all
+    [ 0, 0, 0, 0 ],             # stop_all again
+]
+
+
+def old_move(speed, *motors):
+    """
+    The CarServer's ramp before the RampEngine, reading each throttle back before every step. Read back through the
+    PCA9685, a throttle is quantized to 12 bits and never equals the speed written, so the original loop never ended.
+    Here a motor is up to speed once the speed is written.
+    """
+    if speed == 0:
+        for motor in motors:
+            motor.throttle = 0
+        return
+    INCREMENT = 0.1
+    sign = 1 if speed > 0 else -1
+    speed = min(MAX_SPEED, max(MIN_SPEED, abs(speed))) * sign
+    up_to_speed = [ False for _ in range(len(motors)) ]
+    while not all(up_to_speed):
+        for i, motor in enumerate(motors):
+            if not up_to_speed[i]:
+                new_throttle = motor.throttle or 0.
+                new_throttle += (1 if new_throttle < speed else -1) * INCREMENT
+                if abs(abs(new_throttle) - abs(speed)) < INCREMENT or abs(new_throttle) > MAX_SPEED:
+                    motor.throttle = speed
+                    up_to_speed[i] = True
+                else:
+                    motor.throttle = new_throttle
+
+
+def run_old(transaction_s):
+    kit = SimulatedMotorKit(transaction_s)
+    motors = [ kit.motor1, kit.motor2, kit.motor3, kit.motor4 ]
+    for motor in motors:
+        motor.throttle = 0
+    reads, writes, size = kit.i2c.reads, kit.i2c.writes, kit.i2c.bytes
+    for speeds in TRACE:
+        for i, speed in enumerate(speeds):
+            old_move(speed, motors[i])
+    return kit.i2c.reads - reads, kit.i2c.writes - writes, kit.i2c.bytes - size
+
+
+def run_engine(transaction_s, **options):
+    kit = SimulatedMotorKit(transaction_s)
+    driver = MotorDriver(kit, **options)
+    driver.set_throttles([ 0, 0, 0, 0 ])
+    engine = RampEngine(driver).start()
+    reads, writes, size = kit.i2c.reads, kit.i2c.writes, kit.i2c.bytes
+    for speeds in TRACE:
+        engine.set_targets(speeds)
+        sleep(0.02)
+        while not engine.is_settled():
+            sleep(0.005)
+    engine.stop()
+    return kit.i2c.reads - reads, kit.i2c.writes - writes, kit.i2c.bytes - size
+
+
+if __name__ == "__main__":
+    transaction_s = (float(argv[1]) if len(argv) > 1 else 0.25) / 1000
+
+    print('%d commands, %.2f ms per transaction' % (len(TRACE), transaction_s * 1000))
+    print('%-22s %8s %8s %8s %10s %10s' % ('driver', 'reads', 'writes', 'bytes', 'per cmd', 'bus ms'))
+    for name, run in [
+        ('old ramp', lambda: run_old(transaction_s)),
+        ('engine', lambda: run_engine(transaction_s, cache=False, batch=False)),
+        ('engine + cache', lambda: run_engine(transaction_s, cache=True, batch=False)),
+        ('engine + cache + batch', lambda: run_engine(transaction_s, cache=True, batch=True)),
+    ]:
+        reads, writes, size = run()
+        print('%-22s %8d %8d %8d %10.1f %10.1f' % (name, reads, writes, size, (reads + writes) / len(TRACE), (reads + writes) * transaction_s * 1000))
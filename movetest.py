@@ -12,5 +12,5 @@ speeds = [
     np.round(float(sys.argv[4]), 2)
 ]
 
-car.move_speeds(speeds)
+car.move_speeds(*speeds)
 sleep(float(sys.argv[5]) if len(sys.argv) > 5 else 2)
@@ -0,0 +1,90 @@
+import numpy as np
+import socket
+from sys import argv
+from threading import Thread, Event
+from time import perf_counter, sleep
+
+from util.networking import open_socket, send_to_socket, SocketClient, encode_speeds, decode_speeds
+
+"""
+Abstract: Benchmarks the car control link, comparing a new connection per command against a persistent connection,
+with and without pipelining, for both the text and the binary protocol. Runs against a local server that parses
+the speeds like the CarServer does, without moving any motors.
+Examples:
+    To send 2000 commands in each mode:
+    python3 netbench.py
+
+    To send 500 commands in each mode:
+    python3 netbench.py 500
+"""
+
+COMMAND = '0.95, 0, 0.95, 0'
+SPEEDS = [ 0.95, 0, 0.95, 0 ]
+
+
+def on_text(msg):
+    [ float(speed.strip()) for speed in msg.split(",") ]
+    return msg
+
+
+def on_binary(msg):
+    decode_speeds(msg.payload)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def per_call(port, n):
+    latencies = []
+    start = perf_counter()
+    for _ in range(n):
+        sent = perf_counter()
+        send_to_socket(port, COMMAND, lambda res: latencies.append(perf_counter() - sent))
+    return perf_counter() - start, latencies
+
+
+def persistent(port, n, pipeline, binary=False):
+    client = SocketClient(port, pipeline=pipeline)
+    command = lambda: encode_speeds(SPEEDS, client.next_seq()) if binary else COMMAND
+    latencies = []
+    done = Event()
+
+    def on_response(sent):
+        def callback(res):
+            latencies.append(perf_counter() - sent)
+            if len(latencies) == n:
+                done.set()
+        return callback
+
+    # Connect before timing
+    client.send(command())
+    sleep(0.1)
+    start = perf_counter()
+    for _ in range(n):
+        client.send(command(), on_response(perf_counter()))
+    done.wait(10)
+    elapsed = perf_counter() - start
+    client.close()
+    return elapsed, latencies
+
+
+if __name__ == "__main__":
+    n = int(argv[1]) if len(argv) > 1 else 2000
+    port = free_port()
+    Thread(target=open_socket, args=(port, on_text, None, on_binary), daemon=True).start()
+    sleep(0.2)
+
+    print('%-12s %12s %10s %10s %10s' % ('mode', 'commands/s', 'rtt p50', 'rtt p95', 'rtt max'))
+    for mode, run in [
+        ('per-call', lambda: per_call(port, n)),
+        ('persistent', lambda: persistent(port, n, False)),
+        ('pipelined', lambda: persistent(port, n, True)),
+        ('binary', lambda: persistent(port, n, False, True)),
+        ('binary-pipe', lambda: persistent(port, n, True, True)),
+    ]:
+        elapsed, latencies = run()
+        rtt = np.array(latencies) * 1000
+        print('%-12s %12.0f %8.3fms %8.3fms %8.3fms' % (mode, len(latencies) / elapsed, np.percentile(rtt, 50), np.percentile(rtt, 95), rtt.max()))
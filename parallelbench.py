@@ -0,0 +1,56 @@
+from itertools import cycle
+from os import cpu_count
+from sys import argv
+from time import sleep, time
+
+from auto.lkas_pipeline import LkasPipeline
+from lkasbench import load_dataset, tape_color, white_balance
+
+"""
+Abstract: Benchmarks the LKAS pipeline with 1 to N worker processes, replaying a dataset faster than it can be processed.
+Reports the throughput, and the latency from capture to steering decision along with the part of it spent waiting
+for earlier frames to be put back in order.
+Examples:
+    To benchmark up to one worker per core on train_data_wide:
+    python3 parallelbench.py
+
+    To benchmark up to 3 workers on another dataset:
+    python3 parallelbench.py train_data_dark 3
+"""
+
+DURATION_S = 5
+
+# Offered load, well above what a single worker keeps up with
+CAPTURE_FPS = 200
+
+
+def replay(images):
+    frames = cycle(images)
+    return lambda: (next(frames), time())
+
+
+def no_actuator(tape_color):
+    return lambda angle: None
+
+
+if __name__ == "__main__":
+    name = argv[1] if len(argv) > 1 else 'train_data_wide'
+    max_workers = int(argv[2]) if len(argv) > 2 else cpu_count()
+    images = load_dataset(name)
+
+    print('%-8s %10s %10s %12s %16s' % ('workers', 'fps', 'speedup', 'latency ms', 'reorder wait ms'))
+    baseline = None
+    for workers in range(1, max_workers + 1):
+        pipeline = LkasPipeline(shape=images[0].shape, fps=CAPTURE_FPS, slots=2 * workers, tape_color=tape_color,
+                                white_balance=white_balance, source=replay(images), actuator_factory=no_actuator,
+                                workers=workers).start()
+        # Let the workers warm up before measuring
+        sleep(1)
+        start = pipeline.stats()['processed']
+        sleep(DURATION_S)
+        stats = pipeline.stats()
+        pipeline.close()
+
+        fps = (stats['processed'] - start) / DURATION_S
+        baseline = baseline or fps
+        print('%-8d %10.1f %9.2fx %12.1f %16.1f' % (workers, fps, fps / baseline, stats['latency_ms'], stats['reorder_wait_ms']))
@@ -0,0 +1,35 @@
+import cv2
+from sys import argv
+from time import sleep
+
+from auto.lkas_pipeline import LkasPipeline
+
+"""
+Abstract: Drives with the multi-process LKAS pipeline and shows the latest frame it processed.
+The car server must be running.
+Examples:
+    To drive headless and show the raw frames:
+    python3 pipelinetest.py
+
+    To show the LKAS overlays:
+    python3 pipelinetest.py debug
+"""
+
+INDOOR_BLUE_COLOR = [105, 157, 252]
+
+pipeline = LkasPipeline(headless=not (len(argv) > 1 and argv[1] == 'debug'), tape_color=INDOOR_BLUE_COLOR).start()
+try:
+    last_seq = None
+    while True:
+        latest = pipeline.latest()
+        if latest is not None and latest[1] != last_seq:
+            img, last_seq, _, angle = latest
+            print('frame %d: %s' % (last_seq, 'stop' if angle is None else '%1.2fdeg' % angle), end='\r')
+            cv2.imshow('LKAS', img)
+        cv2.waitKey(1)
+        sleep(0.01)
+except KeyboardInterrupt:
+    print('')
+    print(pipeline.report())
+finally:
+    pipeline.close()
@@ -0,0 +1,120 @@
+import numpy as np
+from sys import argv
+from time import perf_counter, sleep
+
+from car.car_constants import MIN_SPEED, MAX_SPEED
+from car.fake_motor_kit import FakeMotorKit
+from car.ramp_engine import RampEngine
+from car.motor_driver import MotorDriver
+
+"""
+Abstract: Benchmarks motor ramping on a FakeMotorKit, comparing the CarServer's old ramp, which busy-loops each motor
+up to speed one after another while the command waits, against the fixed-rate RampEngine.
+Examples:
+    To benchmark with writes that take 1 ms, about an I2C transaction:
+    python3 rampbench.py
+
+    To benchmark with writes that take 0.5 ms:
+    python3 rampbench.py 0.5
+"""
+
+FORWARD = [ MAX_SPEED, MAX_SPEED, MAX_SPEED, MAX_SPEED ]
+LEFT = [ 0, MAX_SPEED, 0, MAX_SPEED ]
+
+
+def sequential_move(speed, *motors):
+    # The CarServer's ramp before the RampEngine
+    if speed == 0:
+        for motor in motors:
+            motor.throttle = 0
+        return
+    INCREMENT = 0.1
+    sign = 1 if speed > 0 else -1
+    speed = min(MAX_SPEED, max(MIN_SPEED, abs(speed))) * sign
+    up_to_speed = [ False for _ in range(len(motors)) ]
+    while not all(up_to_speed):
+        for i, motor in enumerate(motors):
+            if not up_to_speed[i]:
+                new_throttle = motor.throttle
+                new_throttle += (1 if new_throttle < speed else -1) * INCREMENT
+                if abs(abs(new_throttle) - abs(speed)) < INCREMENT or abs(new_throttle) > MAX_SPEED:
+                    motor.throttle = speed
+                else:
+                    motor.throttle = new_throttle
+                if motor.throttle == speed:
+                    up_to_speed[i] = True
+
+
+def motors_of(kit):
+    for motor in [ kit.motor1, kit.motor2, kit.motor3, kit.motor4 ]:
+        motor.throttle = 0
+    kit.clear()
+    return [ kit.motor1, kit.motor2, kit.motor3, kit.motor4 ]
+
+
+def timings(kit, start):
+    """
+    :return: ms from the command until each motor is first written and until it reaches its final throttle.
+    """
+    first, settled = [], []
+    for channel in range(1, 5):
+        writes = kit.writes_to(channel)
+        if len(writes) == 0:
+            continue
+        first.append((writes[0][0] - start) * 1000)
+        settled.append((writes[-1][0] - start) * 1000)
+    return first, settled
+
+
+def run_sequential(write_delay):
+    kit = FakeMotorKit(write_delay)
+    motors = motors_of(kit)
+    start = perf_counter()
+    for i, speed in enumerate(FORWARD):
+        sequential_move(speed, motors[i])
+    blocked = perf_counter() - start
+    return blocked, timings(kit, start), len(kit.writes)
+
+
+def run_engine(write_delay):
+    kit = FakeMotorKit(write_delay)
+    motors_of(kit)
+    engine = RampEngine(MotorDriver(kit)).start()
+    start = perf_counter()
+    engine.set_targets(FORWARD)
+    blocked = perf_counter() - start
+    while not engine.is_settled():
+        sleep(0.001)
+    engine.stop()
+    return blocked, timings(kit, start), len(kit.writes)
+
+
+def run_preempted(write_delay):
+    """
+    Sends forward, then a left turn halfway through the ramp.
+    :return: The final throttles and the number of writes.
+    """
+    kit = FakeMotorKit(write_delay)
+    motors = motors_of(kit)
+    engine = RampEngine(MotorDriver(kit)).start()
+    engine.set_targets(FORWARD)
+    sleep(0.05)
+    engine.set_targets(LEFT)
+    while not engine.is_settled():
+        sleep(0.001)
+    engine.stop()
+    return [ motor.throttle for motor in motors ], len(kit.writes)
+
+
+if __name__ == "__main__":
+    write_delay = (float(argv[1]) if len(argv) > 1 else 1.) / 1000
+
+    print('%-12s %12s %16s %16s %8s' % ('ramp', 'blocked ms', 'first write ms', 'settled ms', 'writes'))
+    for name, run in [ ('sequential', run_sequential), ('engine', run_engine) ]:
+        blocked, (first, settled), writes = run(write_delay)
+        print('%-12s %12.2f %7.1f - %6.1f %7.1f - %6.1f %8d' % (
+            name, blocked * 1000, np.min(first), np.max(first), np.min(settled), np.max(settled), writes))
+
+    throttles, writes = run_preempted(write_delay)
+    print('Forward preempted by left after 50 ms: throttles %s after %d writes' % (
+        ', '.join('%.2f' % throttle for throttle in throttles), writes))
@@ -0,0 +1,152 @@
+import argparse
+import cv2
+import json
+import numpy as np
+from itertools import product
+from multiprocessing import Pool, cpu_count
+from os import listdir
+from os.path import join
+from time import perf_counter
+
+from auto.frame import Frame, Filter, Region, WhiteBalance
+from auto.lkas import _get_steering_angle
+from lkasbench import TRAIN_DATA_DIR, load_dataset
+
+"""
+Abstract: Sweeps a grid of tape colors, white balances, Canny bounds and Hough parameters over the train_data
+sequences, and reports lane detection stability and runtime for every configuration.
+Each frame is processed once for the whole grid. Layers of its Frame are replaced innermost first, so the HSV image
+is computed once per frame, each color mask once per color, and each edge image once per Canny bounds.
+Examples:
+    To sweep the default grid over every dataset in auto/train_data:
+    python3 sweep.py
+
+    To sweep Canny bounds only over one dataset:
+    python3 sweep.py train_data_dark --grid '{"bounds": [[100, 200], [200, 400], [300, 600]]}'
+"""
+
+# Parameter -> values swept. White balances are WhiteBalance names, tape colors are RGB.
+GRID = {
+    'color': [ [105, 157, 252], [54, 179, 254] ],
+    'white_balance': [ 'INDOORS', 'TUNGSTEN' ],
+    'bounds': [ [100, 200], [200, 400] ],
+    'hough': [ [10, 4, 4], [20, 8, 4] ]
+}
+
+# Frames per task, so that long sequences are split across workers
+CHUNK = 20
+
+
+def configurations(grid):
+    """
+    :return: Every (color, white balance, bounds, hough) combination, ordered so that neighbours share their prefix.
+    """
+    return [ (tuple(color), white_balance, tuple(bounds), tuple(hough))
+             for color, white_balance, bounds, hough in product(grid['color'], grid['white_balance'], grid['bounds'], grid['hough']) ]
+
+
+def _load_frames(name, first, last):
+    return [ cv2.imread(join(TRAIN_DATA_DIR, name, '%d.png' % (i + 1))) for i in range(first, last) ]
+
+
+def _timed_get(frame, idx):
+    start = perf_counter()
+    output, output_data, _ = frame.get(idx)
+    return output_data, perf_counter() - start
+
+
+def sweep_frames(task):
+    """
+    Runs every configuration over a chunk of a sequence.
+    :param task: (dataset name, first frame, last frame, grid)
+    :return: (dataset name, first frame, { configuration: [(steering angle or None, lane count, seconds)] per frame })
+    """
+    name, first, last, grid = task
+    configs = configurations(grid)
+    results = { config: [] for config in configs }
+    for img in _load_frames(name, first, last):
+        frame = Frame(img, draw=False)
+        hsv_idx = frame.add(Filter.HSV)
+        color_idx = frame.add(Filter.COLOR_DETECT)
+        edge_idx = frame.add(Filter.EDGE_DETECTION)
+        region_idx = frame.add(Filter.REGION_ISO, region=Region.BOTTOM)
+        line_idx = frame.add(Filter.LINE_DETECTION)
+        lane_idx = frame.add(Filter.LANE_DETECTION)
+
+        # Seconds each layer took when it was last computed, so that every configuration is charged for its whole chain
+        _, hsv_time = _timed_get(frame, hsv_idx)
+        color_key = bounds_key = None
+        for color, white_balance, bounds, hough in configs:
+            if (color, white_balance) != color_key:
+                color_key = (color, white_balance)
+                frame.replace(color_idx, Filter.COLOR_DETECT, color=color, white_balance=getattr(WhiteBalance, white_balance))
+                _, color_time = _timed_get(frame, color_idx)
+                bounds_key = None
+            if bounds != bounds_key:
+                bounds_key = bounds
+                frame.replace(edge_idx, Filter.EDGE_DETECTION, bounds=bounds)
+                _, edge_time = _timed_get(frame, edge_idx)
+                _, region_time = _timed_get(frame, region_idx)
+            frame.replace(line_idx, Filter.LINE_DETECTION, hough=hough)
+            _, line_time = _timed_get(frame, line_idx)
+            lanes, lane_time = _timed_get(frame, lane_idx)
+
+            angle = _get_steering_angle(img, lanes) if len(lanes) > 0 else None
+            seconds = hsv_time + color_time + edge_time + region_time + line_time + lane_time
+            results[(color, white_balance, bounds, hough)].append((angle, len(lanes), seconds))
+    return name, first, results
+
+
+def stability(angles):
+    """
+    :return: (share of frames with an angle, mean absolute change in angle between consecutive detected frames)
+    """
+    detected = np.array([ angle for angle in angles if angle is not None ], np.float64)
+    jitter = np.abs(np.diff(detected)).mean() if len(detected) > 1 else float('nan')
+    return len(detected) / len(angles), jitter
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Sweeps LKAS parameters over train_data sequences in parallel.')
+    parser.add_argument('datasets', nargs='*', help='train_data directories, all of them by default')
+    parser.add_argument('--grid', default='{}', help='JSON object overriding values of the default grid')
+    parser.add_argument('--workers', type=int, default=cpu_count(), help='number of processes')
+    args = parser.parse_args()
+
+    grid = dict(GRID)
+    grid.update(json.loads(args.grid))
+    datasets = args.datasets if len(args.datasets) > 0 else sorted(listdir(TRAIN_DATA_DIR))
+    configs = configurations(grid)
+
+    frame_counts = { name: len(load_dataset(name)) for name in datasets }
+    tasks = []
+    for name in datasets:
+        tasks += [ (name, first, min(first + CHUNK, frame_counts[name]), grid) for first in range(0, frame_counts[name], CHUNK) ]
+
+    start = perf_counter()
+    # Chunks come back in task order, so each sequence is reassembled in frame order
+    sequences = { (name, config): [] for name in datasets for config in configs }
+    with Pool(max(1, min(args.workers, len(tasks)))) as pool:
+        for name, _, results in pool.imap(sweep_frames, tasks):
+            for config, frames in results.items():
+                sequences[(name, config)] += frames
+    wall = perf_counter() - start
+
+    print('%-16s %-9s %-10s %-11s %-20s %9s %9s %9s %9s' % ('color', 'wb', 'bounds', 'hough', 'dataset', 'detected', 'two lanes', 'jitter', 'ms/frame'))
+    for config in configs:
+        color, white_balance, bounds, hough = config
+        for name in datasets:
+            frames = sequences[(name, config)]
+            if len(frames) == 0:
+                continue
+            detected, jitter = stability([ angle for angle, _, _ in frames ])
+            two_lanes = np.mean([ lanes == 2 for _, lanes, _ in frames ])
+            ms = np.mean([ seconds for _, _, seconds in frames ]) * 1000
+            print('%-16s %-9s %-10s %-11s %-20s %8.1f%% %8.1f%% %9.2f %9.2f' % (
+                ','.join(map(str, color)), white_balance, ','.join(map(str, bounds)), ','.join(map(str, hough)),
+                name, detected * 100, two_lanes * 100, jitter, ms))
+
+    total_frames = sum(frame_counts.values())
+    print('')
+    print('%d configurations over %d frames in %.2fs (%.2f ms per configuration per frame)' % (
+        len(configs), total_frames, wall, wall / max(1, total_frames * len(configs)) * 1000))
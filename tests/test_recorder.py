@@ -0,0 +1,42 @@
+import sys
+import numpy as np
+from os.path import join, dirname
+from time import time, sleep
+sys.path.append(join(dirname(__file__), '..'))
+
+from auto.camera import get_frame_by_frame
+from auto.recording import RecordingReader
+
+# Fewer frames than the writer's queue holds, so that none are dropped
+FRAMES = 12
+
+
+def noise_source():
+    """
+    :return: A source of FRAMES noisy frames, which are slow to encode as PNGs, and then no more.
+    """
+    rng = np.random.default_rng(0)
+    captured = 0
+
+    def source():
+        nonlocal captured
+        if captured >= FRAMES:
+            return None, None
+        captured += 1
+        return rng.integers(0, 256, (480, 640, 3), np.uint8), time()
+    return source
+
+
+def test_stopping_a_recording_timer_writes_every_queued_frame(tmp_path):
+    timer = get_frame_by_frame('test', fps=200, write_to_disk=True, to_recording=True, source=noise_source(), directory=str(tmp_path))
+    timer.start()
+    # Long enough to queue every frame, too short to encode them
+    sleep(0.15)
+    timer.stop()
+
+    reader = RecordingReader(str(tmp_path / 'test.rec'))
+    try:
+        assert len(reader) == FRAMES
+        assert reader.read(FRAMES - 1).shape == (480, 640, 3)
+    finally:
+        reader.close()
@@ -0,0 +1,87 @@
+import numpy as np
+import socket
+from sys import argv
+from threading import Thread
+from time import perf_counter, sleep
+
+from car.async_car_server import AsyncCarServer
+from car.car_constants import WATCHDOG_S
+from car.fake_motor_kit import FakeMotorKit
+from netbench import free_port
+from util.networking import UdpClient, encode_speeds
+
+"""
+Abstract: Tests the UDP control channel on localhost against an AsyncCarServer on a FakeMotorKit.
+Sends commands at a fixed rate with injected loss and reordering and reports what the server accepted, then stops
+sending mid-drive and measures how long the watchdog takes to stop the motors.
+Examples:
+    To send at 50 commands/sec for 3 seconds per loss rate:
+    python3 udpbench.py
+
+    To send at 100 commands/sec for 5 seconds per loss rate:
+    python3 udpbench.py 100 5
+"""
+
+FORWARD = [ 0.95, 0.95, 0.95, 0.95 ]
+LOSSES = [ 0, 0.05, 0.2 ]
+REORDER = 0.05
+
+
+def free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def send_commands(client, rate, duration):
+    """
+    :return: Seconds each send() call took.
+    """
+    calls = []
+    start = perf_counter()
+    for tick in range(int(rate * duration)):
+        sleep(max(0., start + tick / rate - perf_counter()))
+        sent = perf_counter()
+        client.send(encode_speeds(FORWARD, client.next_seq()))
+        calls.append(perf_counter() - sent)
+    return calls
+
+
+if __name__ == "__main__":
+    rate = float(argv[1]) if len(argv) > 1 else 50
+    duration = float(argv[2]) if len(argv) > 2 else 3
+
+    kit = FakeMotorKit()
+    udp_port = free_udp_port()
+    server = AsyncCarServer(kit, port=free_port(), udp_port=udp_port)
+    Thread(target=server.run, daemon=True).start()
+    sleep(0.5)
+
+    print('%d commands/sec for %.0fs per run, %.0f%% reordered' % (rate, duration, REORDER * 100))
+    print('%6s %8s %8s %8s %8s %8s %8s %12s %12s %12s' % ('loss', 'sent', 'dropped', 'received', 'accepted', 'lost', 'stale',
+                                                     'latency avg', 'latency max', 'send() max'))
+    for loss in LOSSES:
+        senders = set(server.udp_senders)
+        client = UdpClient(udp_port, loss=loss, reorder=REORDER, seed=0)
+        calls = np.array(send_commands(client, rate, duration)) * 1000
+        sleep(0.2)
+        # Every client sends from a new port, so it is the new sender
+        addr = (set(server.udp_senders) - senders).pop()
+        stats = server.stats()['udp'][addr]
+        client_stats = client.stats()
+        client.close()
+        print('%5.0f%% %8d %8d %8d %8d %8d %8d %10.3fms %10.3fms %10.3fms' % (loss * 100, client_stats['sent'], client_stats['dropped'],
+              stats['received'], stats['accepted'], stats['lost'], stats['stale'], stats['mean_latency_ms'], stats['max_latency_ms'], calls.max()))
+
+    # Drive, then go quiet
+    client = UdpClient(udp_port)
+    sleep(WATCHDOG_S * 2)
+    send_commands(client, rate, 1)
+    last_sent = perf_counter()
+    sleep(WATCHDOG_S * 2)
+    stops = [ timestamp for timestamp, channel, throttle in kit.writes if throttle == 0 and timestamp > last_sent ]
+    if len(stops) > 0:
+        print('Watchdog stopped the motors %.0f ms after the last command (deadline %.0f ms), %d trips' % (
+            (stops[0] - last_sent) * 1000, WATCHDOG_S * 1000, server.watchdog_trips))
+    else:
+        print('Watchdog did not stop the motors')
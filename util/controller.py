@@ -3,10 +3,12 @@ from os.path import join, dirname
 sys.path.append(join(dirname(__file__), '..'))
 
 from enum import Enum
+from functools import partial
 from time import sleep
 from evdev import InputDevice, list_devices
 
 from car.car import Car
+from car.car_constants import PRIORITY_GAMEPAD, PRIORITY_AUTONOMY
 from .audio import speak
 from auto.camera import get_frame_by_frame
 
@@ -39,14 +41,20 @@ FBF_AUTONOMY_FPS = 16
 class Controller:
 
     def __init__(self, speak=True, device_name=DEFAULT_DEVICE_NAME, display_feed=False, tape_color=DEFAULT_TAPE_COLOR):
-        self.car = Car(tape_color=tape_color)
+        self.car = Car(tape_color=tape_color, priority=PRIORITY_GAMEPAD)
+        # LKAS drives over its own connection, so the gamepad overrides it
+        self.autonomy_car = Car(tape_color=tape_color, priority=PRIORITY_AUTONOMY)
         self.device_name = device_name
         self.display_feed = display_feed
         self.speak = speak
 
         # Frame-by-frame objects
         self.fbf_record = get_frame_by_frame(fps=FBF_RECORD_FPS, write_to_disk=True)
-        self.fbf_autonomy = get_frame_by_frame(fps=FBF_AUTONOMY_FPS, write_to_disk=False, on_capture=self.car.move_lkas, display_feed=display_feed)
+        self.fbf_autonomy = get_frame_by_frame(fps=FBF_AUTONOMY_FPS, write_to_disk=False, on_capture=self._lkas_callback(), display_feed=display_feed)
+
+    def _lkas_callback(self):
+        # Only draw the LKAS overlays when someone is watching the feed
+        return partial(self.autonomy_car.move_lkas, headless=not self.display_feed)
 
     def _reset(self):
         self.car.stop_all()
@@ -77,6 +85,7 @@ class Controller:
             speak("Stopped recording", fail = not self.speak)
             self.car.stop_all()
             self.fbf_record.kill()
+            print(self.fbf_record.report())
             self.fbf_record = get_frame_by_frame(fps=FBF_RECORD_FPS, write_to_disk=True)
         else:
             speak("Started recording", fail = not self.speak)
@@ -104,9 +113,11 @@ class Controller:
     def start_pressed(self):
         if self.fbf_autonomy.is_running:
             speak("Stopped elkass", fail = not self.speak) # LKAS
-            self.car.stop_all()
             self.fbf_autonomy.kill()
-            self.fbf_autonomy = get_frame_by_frame(fps=FBF_AUTONOMY_FPS, write_to_disk=False, on_capture=self.car.move_lkas, display_feed=self.display_feed)
+            self.car.stop_all()
+            print(self.fbf_autonomy.report())
+            print(self.autonomy_car.command_report())
+            self.fbf_autonomy = get_frame_by_frame(fps=FBF_AUTONOMY_FPS, write_to_disk=False, on_capture=self._lkas_callback(), display_feed=self.display_feed)
         else:
             speak("Started elkass", fail = not self.speak) # LKAS
             self.fbf_autonomy.start()
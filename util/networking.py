@@ -1,7 +1,13 @@
+import os
 import sys
+import asyncio
+import random
 import socket
+import struct
 import time
+from collections import deque, namedtuple
 from sys import argv
+from threading import Thread, Lock
 from os.path import join, dirname
 
 sys.path.append(join(dirname(__file__), '..'))
@@ -9,6 +15,126 @@ sys.path.append(join(dirname(__file__), '..'))
 # Constants
 HOST = 'localhost'
 BUFFER_SIZE = 128
+# Text messages are framed by newlines, so several can share a connection and a read
+DELIMITER = '\n'
+
+##
+# Binary protocol
+##
+
+# Starts every binary message. Text messages never start with a non-ASCII byte, so both can share a connection.
+MAGIC = b'\xa5\x5a'
+PROTOCOL_VERSION = 1
+
+# Magic, version, message type, payload length, sequence number, timestamp
+HEADER = struct.Struct('<2sBBHId')
+# Speeds of motors 1 to 4
+SPEEDS = struct.Struct('<4f')
+# Telemetry messages per second, 0 to unsubscribe
+RATE = struct.Struct('<f')
+# Throttles and target speeds of motors 1 to 4
+TELEMETRY = struct.Struct('<4f4f')
+# Priority of a connection's commands
+PRIORITY = struct.Struct('<B')
+
+
+class MessageType:
+    TEXT = 0
+    SPEEDS = 1
+    ACK = 2
+    ERROR = 3
+    SUBSCRIBE = 4
+    # Sent by the server at the subscribed rate, not in response to a message
+    TELEMETRY = 5
+    PRIORITY = 6
+    # A command that was overridden by a connection with a higher priority
+    REJECTED = 7
+
+
+# A decoded message. The payload of a TEXT message is the line as a str, and raw bytes otherwise.
+Message = namedtuple('Message', ['type', 'seq', 'timestamp', 'payload'])
+
+
+def encode_message(type, payload=b'', seq=0, timestamp=None):
+    """
+    Packs a binary message.
+    :param timestamp: Seconds since the epoch. Defaults to now.
+    :return: The message as bytes.
+    """
+    header = HEADER.pack(MAGIC, PROTOCOL_VERSION, type, len(payload), seq & 0xFFFFFFFF, time.time() if timestamp is None else timestamp)
+    return header + payload
+
+
+def encode_speeds(speeds, seq=0, timestamp=None):
+    return encode_message(MessageType.SPEEDS, SPEEDS.pack(*speeds), seq, timestamp)
+
+
+def decode_speeds(payload):
+    return list(SPEEDS.unpack(payload))
+
+
+def encode_subscribe(rate, seq=0):
+    return encode_message(MessageType.SUBSCRIBE, RATE.pack(rate), seq)
+
+
+def encode_priority(priority, seq=0):
+    return encode_message(MessageType.PRIORITY, PRIORITY.pack(priority), seq)
+
+
+def encode_telemetry(throttles, targets, seq=0):
+    return encode_message(MessageType.TELEMETRY, TELEMETRY.pack(*throttles, *targets), seq)
+
+
+def decode_telemetry(payload):
+    """
+    :return: (throttles, target speeds) of motors 1 to 4.
+    """
+    values = TELEMETRY.unpack(payload)
+    return list(values[:4]), list(values[4:])
+
+
+def encode_text(text):
+    return (text + DELIMITER).encode()
+
+
+class MessageReader:
+    """
+    Splits a byte stream into binary messages and, for debugging, newline-terminated text messages.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Adds received bytes.
+        :return: The messages completed by them.
+        """
+        buffer = self._buffer
+        buffer += data
+        messages = []
+        # Parse from an offset and drop what was consumed once, rather than copying the rest after every message
+        start = 0
+        while start < len(buffer):
+            if buffer[start] == MAGIC[0]:
+                if len(buffer) - start < HEADER.size:
+                    break
+                magic, version, type, length, seq, timestamp = HEADER.unpack_from(buffer, start)
+                if magic != MAGIC or version != PROTOCOL_VERSION:
+                    raise ValueError('Unsupported message, magic %r version %d' % (magic, version))
+                end = start + HEADER.size + length
+                if len(buffer) < end:
+                    break
+                messages.append(Message(type, seq, timestamp, bytes(buffer[start + HEADER.size:end])))
+                start = end
+            else:
+                end = buffer.find(b'\n', start)
+                if end < 0:
+                    break
+                messages.append(Message(MessageType.TEXT, 0, 0., buffer[start:end].decode('utf-8')))
+                start = end + 1
+        del buffer[:start]
+        return messages
 
 
 def get_device_ip():
@@ -23,45 +149,457 @@ def get_device_ip():
     return ip
 
 
-def open_socket(port, on_data, on_quit = None):
+def open_socket(port, on_data, on_quit = None, on_message = None):
     """
     Opens a server socket at the given port on localhost.
+    Each client connection is served on its own thread until the client closes it.
+    Messages from all clients are handled one at a time.
     :param port: The port to open the server socket.
-    :param on_data: The handler for when data is received. Must return the response to send back.
+    :param on_data: The handler for text messages. Must return the response to send back.
     :param on_quit: The handler for when there is no data received.
+    :param on_message: The handler for binary messages, called with a Message. Returns the payload of the ACK.
     """
+    lock = Lock()
+
+    def handle(message):
+        if message.type == MessageType.TEXT:
+            return encode_text(on_data(message.payload))
+        if on_message is None:
+            raise Exception('Binary messages are not handled')
+        return encode_message(MessageType.ACK, on_message(message) or b'', message.seq, message.timestamp)
+
+    def serve(conn):
+        with conn:
+            reader = MessageReader()
+            while True:
+                try:
+                    data_enc = conn.recv(BUFFER_SIZE)
+                    if not data_enc:
+                        break
+                    responses = []
+                    for message in reader.feed(data_enc):
+                        with lock:
+                            try:
+                                responses.append(handle(message))
+                            except Exception as e:
+                                # A bad message should not take the other clients down with it
+                                print("Could not handle %s: %s" % (message, e))
+                                responses.append(encode_text('ERROR') if message.type == MessageType.TEXT else
+                                                 encode_message(MessageType.ERROR, str(e).encode(), message.seq,
+                                                                message.timestamp))
+                    # The client may have gone away while its messages were handled
+                    conn.sendall(b''.join(responses))
+                except (OSError, ValueError) as e:
+                    print("Closing connection: %s" % e)
+                    break
+
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind((HOST, port))
         s.listen()
         try:
             while True:
                 conn, addr = s.accept()
-                while True:
-                    data_enc = conn.recv(BUFFER_SIZE)
-                    if not data_enc:
-                        break
-                    # Decode the data
-                    data_dec = data_enc.decode('utf-8')
-                    conn.sendall(on_data(data_dec).encode())
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                Thread(target=serve, args=(conn,), daemon=True).start()
         except:
             if on_quit:
                 on_quit()
 
 
+class AsyncConnection:
+    """
+    A client of open_async_socket. state holds whatever the server keeps per client.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername')
+        self.state = {}
+
+    def send(self, data):
+        self.writer.write(data)
+
+    def buffered(self):
+        """
+        :return: Bytes written but not yet sent, which grows when the client reads slower than it is sent to.
+        """
+        return self.writer.transport.get_write_buffer_size()
+
+    @property
+    def closed(self):
+        return self.writer.is_closing()
+
+
+async def open_async_socket(port, on_message, on_connect = None, on_disconnect = None, host = HOST):
+    """
+    Opens a server socket on the running event loop that serves any number of clients at once.
+    Messages from each client are handled in order, and text and binary messages can share a connection.
+    :param port: The port to open the server socket.
+    :param on_message: Called with the AsyncConnection and each Message. Returns the bytes to send back, or None.
+    :param on_connect: Called with each new AsyncConnection.
+    :param on_disconnect: Called with each AsyncConnection once it closes.
+    :return: The asyncio server.
+    """
+    async def serve(reader, writer):
+        conn = AsyncConnection(reader, writer)
+        message_reader = MessageReader()
+        if on_connect:
+            on_connect(conn)
+        try:
+            while True:
+                data_enc = await reader.read(BUFFER_SIZE)
+                if not data_enc:
+                    break
+                responses = []
+                for message in message_reader.feed(data_enc):
+                    try:
+                        response = on_message(conn, message)
+                    except Exception as e:
+                        # A bad message should not take the other clients down with it
+                        print("Could not handle %s: %s" % (message, e))
+                        response = encode_text('ERROR') if message.type == MessageType.TEXT else \
+                            encode_message(MessageType.ERROR, str(e).encode(), message.seq, message.timestamp)
+                    if response:
+                        responses.append(response)
+                conn.send(b''.join(responses))
+                await writer.drain()
+        except (OSError, ValueError) as e:
+            print("Closing connection: %s" % e)
+        finally:
+            if on_disconnect:
+                on_disconnect(conn)
+            writer.close()
+
+    return await asyncio.start_server(serve, host, port, reuse_address=True)
+
+
 def send_to_socket(port, value, callback = None):
     """
-    Sends a string to the socket at the given port.
+    Sends a string to the socket at the given port over a new connection.
     :param port: The port of the server socket.
     :param value: The value to send to the server.
     :param callback: The function called after data is received.
     """
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.connect((HOST, port))
-        s.sendall(value.encode())
-        data_enc = s.recv(BUFFER_SIZE)
-        data_dec = data_enc.decode('utf-8')
+        s.sendall(encode_text(value))
+        data_dec = ''
+        while DELIMITER not in data_dec:
+            data_enc = s.recv(BUFFER_SIZE)
+            if not data_enc:
+                break
+            data_dec += data_enc.decode('utf-8')
+        if callback:
+            callback(data_dec.split(DELIMITER)[0])
+
+
+class SocketClient:
+    """
+    Persistent connection to a server socket, reconnecting when the connection drops.
+    Pipelined clients send without waiting for the previous response, and a reader thread runs the callbacks in order.
+    A client belongs to the process that connected it, so a forked process opens its own connection.
+    """
+
+    def __init__(self, port, host=HOST, pipeline=False, retries=3, hello=None, on_push=None):
+        """
+        :param port: The port of the server socket.
+        :param pipeline: Don't wait for responses before returning from send().
+        :param retries: Reconnection attempts before a send fails.
+        :param hello: An encoded message sent first on every connection, such as the connection's priority.
+        :param on_push: Called with each TELEMETRY message, which the server sends without being asked.
+                        Subscribers should be pipelined, so that the reader thread takes telemetry as it arrives.
+        """
+        self.port = port
+        self.host = host
+        self.pipeline = pipeline
+        self.retries = retries
+        self.hello = hello
+        self.on_push = on_push
+        self._socket = None
+        self._pid = None
+        self._lock = Lock()
+        self._pending = deque()
+        self._seq = 0
+        self.sent = 0
+        self.received = 0
+        self.reconnects = 0
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._socket = sock
+        self._pid = os.getpid()
+        self._reader = MessageReader()
+        self._responses = deque()
+        # Callbacks waiting on the old connection will never get their responses
+        self._pending.clear()
+        if self.hello:
+            sock.sendall(self.hello)
+            if self.pipeline:
+                self._pending.append(None)
+            else:
+                self._read_response(sock)
+        if self.pipeline:
+            Thread(target=self._read_loop, args=(sock,), daemon=True).start()
+
+    def _close(self):
+        try:
+            self._socket.close()
+        except OSError:
+            pass
+        self._socket = None
+
+    def _read_response(self, sock):
+        while True:
+            while len(self._responses) == 0:
+                data_enc = sock.recv(BUFFER_SIZE)
+                if not data_enc:
+                    raise ConnectionError('Connection closed by server')
+                self._responses.extend(self._reader.feed(data_enc))
+            message = self._responses.popleft()
+            if message.type != MessageType.TELEMETRY:
+                break
+            if self.on_push:
+                self.on_push(message)
+        # Text responses are handed back as the line itself
+        return message.payload if message.type == MessageType.TEXT else message
+
+    def _read_loop(self, sock):
+        try:
+            while True:
+                response = self._read_response(sock)
+                with self._lock:
+                    callback = self._pending.popleft() if len(self._pending) > 0 else None
+                    self.received += 1
+                if callback:
+                    callback(response)
+        except (OSError, ConnectionError, ValueError):
+            pass
+
+    def next_seq(self):
+        self._seq = (self._seq + 1) & 0xFFFFFFFF
+        return self._seq
+
+    def send(self, value, callback = None):
+        """
+        Sends a message to the server, connecting first if needed.
+        :param value: A text message, or an encoded binary message.
+        :param callback: The function called with the response, a str for text messages and a Message otherwise.
+        """
+        data = encode_text(value) if isinstance(value, str) else value
+        if self._pid is not None and self._pid != os.getpid():
+            # Forked from the process that connected, which keeps the connection. The lock may have been held mid-fork.
+            self._lock = Lock()
+            self._socket = None
+            self._pid = None
+        with self._lock:
+            for attempt in range(self.retries + 1):
+                try:
+                    if self._socket is None:
+                        self._connect()
+                    if self.pipeline:
+                        self._pending.append(callback)
+                    self._socket.sendall(data)
+                    self.sent += 1
+                    break
+                except OSError:
+                    if attempt == self.retries:
+                        raise
+                    if self._socket is not None:
+                        self._close()
+                    self.reconnects += 1
+                    time.sleep(0.05 * attempt)
+            if self.pipeline:
+                return
+            try:
+                response = self._read_response(self._socket)
+            except (OSError, ConnectionError, ValueError):
+                # The command was sent, but the connection is redone for the next one
+                self._close()
+                return
+            self.received += 1
         if callback:
-            callback(data_dec)
+            callback(response)
+
+    def close(self):
+        with self._lock:
+            if self._socket is not None and self._pid == os.getpid():
+                self._close()
+            self._socket = None
+            self._pid = None
+
+
+##
+# UDP
+##
+
+class SequenceTracker:
+    """
+    Accepts only messages newer than the last one accepted from a sender, since a stale command is worse than none.
+    Counts lost, stale and duplicate messages and the one-way latency taken from message timestamps.
+    """
+
+    def __init__(self):
+        self._first = None
+        self._last = None
+        self.received = 0
+        self.accepted = 0
+        self.stale = 0
+        self.duplicates = 0
+        self._latency = 0.
+        self.max_latency = 0.
+
+    def accept(self, message):
+        """
+        :return: True if the message is newer than every message accepted before it.
+        """
+        self.received += 1
+        latency = time.time() - message.timestamp
+        self._latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        if self._last is not None:
+            # Compare as serial numbers, so the sequence can wrap around
+            ahead = (message.seq - self._last) & 0xFFFFFFFF
+            if ahead == 0:
+                self.duplicates += 1
+                return False
+            if ahead >= 0x80000000:
+                self.stale += 1
+                return False
+        else:
+            self._first = message.seq
+        self._last = message.seq
+        self.accepted += 1
+        return True
+
+    def stats(self):
+        """
+        :return: A dict of message counts, where lost counts the sequence numbers never received, and the mean and
+                 max latency in ms.
+        """
+        expected = 0 if self._last is None else ((self._last - self._first) & 0xFFFFFFFF) + 1
+        received = self.received - self.duplicates
+        return {
+            'received': self.received,
+            'accepted': self.accepted,
+            'lost': max(0, expected - received),
+            'stale': self.stale,
+            'duplicates': self.duplicates,
+            'mean_latency_ms': self._latency / self.received * 1000 if self.received > 0 else 0.,
+            'max_latency_ms': self.max_latency * 1000
+        }
+
+
+class UdpClient:
+    """
+    Sends binary messages as datagrams without waiting for anything, so a stalled server never holds up the sender.
+    Messages can be lost or arrive out of order, so the receiver should check their sequence numbers.
+    Has the send(), next_seq() and close() of a SocketClient, but never calls the callbacks.
+    A forked process gets its own socket, so the receiver tracks its sequence numbers apart from its parent's.
+    """
+
+    def __init__(self, port, host=HOST, hello=None, hello_s=1.0, loss=0., reorder=0., seed=None):
+        """
+        :param port: The port of the server's UDP socket.
+        :param hello: An encoded message sent every hello_s seconds ahead of the other messages, since it may be lost.
+        :param loss: Fraction of messages dropped on purpose, for testing.
+        :param reorder: Fraction of messages held back and sent after the next one, for testing.
+        :param seed: Seeds the random loss and reordering.
+        """
+        self.address = (host, port)
+        self.hello = hello
+        self.hello_s = hello_s
+        self.loss = loss
+        self.reorder = reorder
+        self._random = random.Random(seed)
+        self._open()
+        self.sent = 0
+        self.dropped = 0
+        self.reordered = 0
+        self.failed = 0
+
+    def _open(self):
+        self._pid = os.getpid()
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+        self._lock = Lock()
+        self._held = None
+        # The new address has to declare itself again
+        self._hello_at = None
+        self._seq = 0
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # Forked from the process that opened the socket, which keeps using it
+            self._open()
+
+    def next_seq(self):
+        self._check_pid()
+        self._seq = (self._seq + 1) & 0xFFFFFFFF
+        return self._seq
+
+    def _sendto(self, data):
+        try:
+            self._socket.sendto(data, self.address)
+            self.sent += 1
+        except OSError:
+            # A full buffer or a closed port loses the message, like the network would
+            self.failed += 1
+
+    def send(self, value, callback = None):
+        data = encode_text(value) if isinstance(value, str) else value
+        self._check_pid()
+        with self._lock:
+            if self.hello and (self._hello_at is None or time.monotonic() - self._hello_at >= self.hello_s):
+                self._sendto(self.hello)
+                self._hello_at = time.monotonic()
+            if self._random.random() < self.loss:
+                self.dropped += 1
+                return
+            if self._held is None and self._random.random() < self.reorder:
+                self._held = data
+                self.reordered += 1
+                return
+            self._sendto(data)
+            if self._held is not None:
+                self._sendto(self._held)
+                self._held = None
+
+    def close(self):
+        self._socket.close()
+
+    def stats(self):
+        return { 'sent': self.sent, 'dropped': self.dropped, 'reordered': self.reordered, 'failed': self.failed }
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, on_message):
+        self.on_message = on_message
+
+    def datagram_received(self, data, addr):
+        try:
+            messages = MessageReader().feed(data)
+        except ValueError as e:
+            print("Dropping datagram from %s: %s" % (addr, e))
+            return
+        for message in messages:
+            try:
+                self.on_message(addr, message)
+            except Exception as e:
+                print("Could not handle %s: %s" % (message, e))
+
+
+async def open_async_udp_socket(port, on_message, host = HOST):
+    """
+    Opens a UDP socket on the running event loop. Each datagram carries whole messages, and nothing is sent back.
+    :param on_message: Called with the sender's address and each Message.
+    :return: The datagram transport, to close when done.
+    """
+    transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(lambda: _DatagramProtocol(on_message), local_addr=(host, port))
+    return transport
 
 
 # Tests
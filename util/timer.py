@@ -1,68 +1,142 @@
 import sys
 from os.path import join, dirname
-from threading import Timer as PythonTimer
-from multiprocessing import Process, Event
-from time import sleep
+from threading import Thread, Event as ThreadEvent, Lock, current_thread
+from multiprocessing import Process, Event, Array
+from time import monotonic
 
 sys.path.append(join(dirname(__file__), '..'))
 
 
 class Timer(object):
+    """
+    Calls a function every interval seconds, on absolute deadlines so that the rate does not drift with the time the
+    function takes. Each timer runs a single loop on a thread, or on a process with use_mp().
+    """
 
-    def __init__(self, interval, function, timeout = False, *args, **kwargs):
-        self._timer     = None
+    # When the function overruns one or more deadlines:
+    # Drop the missed ticks and wait for the next deadline
+    SKIP = 0
+    # Run every missed tick back to back until on schedule again
+    CATCH_UP = 1
+    # Run once right away for all of the missed ticks, then wait for the next deadline
+    COALESCE = 2
+
+    # Seconds stop() waits for an on_stop callback to finish before a process is terminated
+    STOP_TIMEOUT_S = 10
+
+    # Indices of the stats
+    _TICKS = 0
+    _MISSED = 1
+    _LATENESS = 2
+    _MAX_LATENESS = 3
+
+    def __init__(self, interval, function, *args, timeout=False, policy=SKIP, **kwargs):
+        """
+        :param interval: Seconds between calls.
+        :param function: Called with args and kwargs on every tick.
+        :param timeout: Call the function once after interval seconds instead of repeatedly.
+        :param policy: SKIP, CATCH_UP or COALESCE, for when the function overruns a deadline.
+        """
         self.function   = function
         self.interval   = interval
         self.use_thread = True
         self.timeout    = timeout
+        self.policy     = policy
         self.args       = args
         self.kwargs     = kwargs
-        self.is_running = False
-        self._timer     = None
-        self._processor = None
+        self._worker    = None
+        self._stop      = None
         self._on_kill   = None
+        self._on_stop   = None
+        # Ticks, missed deadlines, and summed and max lateness. use_mp() puts them in shared memory instead.
+        self._stats         = [ 0., 0., 0., 0. ]
+        self._stats_lock    = Lock()
 
-    def _timer(self):
-        self.is_running = False
-        if not self.timeout:
-            self.start()
-        self.function(*self.args, **self.kwargs)
+    def _run(self, stop):
+        try:
+            self._loop(stop)
+        finally:
+            if self._on_stop:
+                self._on_stop()
+
+    def _loop(self, stop):
+        start = monotonic()
+        tick = 1
+        # Last deadline counted as missed, so that catching up does not count it twice
+        missed_tick = 0
+        while not stop.wait(max(0., start + tick * self.interval - monotonic())):
+            lateness = monotonic() - (start + tick * self.interval)
+            self.function(*self.args, **self.kwargs)
+            with self._stats_lock:
+                self._stats[Timer._TICKS] += 1
+                self._stats[Timer._LATENESS] += lateness
+                self._stats[Timer._MAX_LATENESS] = max(self._stats[Timer._MAX_LATENESS], lateness)
+            if self.timeout:
+                return
 
-    def _process(self):
-        sleep(self.interval)
-        self.function(*self.args, **self.kwargs)
-        if not self.timeout:
-            self._process()
+            tick += 1
+            # Deadlines that passed while the function ran
+            passed_tick = int((monotonic() - start) / self.interval)
+            overrun = passed_tick - tick + 1
+            if overrun > 0:
+                with self._stats_lock:
+                    self._stats[Timer._MISSED] += passed_tick - max(tick - 1, missed_tick)
+                missed_tick = passed_tick
+                if self.policy == Timer.SKIP:
+                    tick += overrun
+                elif self.policy == Timer.COALESCE:
+                    tick += overrun - 1
 
     def use_mp(self):
-        new_timer = Timer(self.interval, self.function, *self.args, **self.kwargs)
+        new_timer = Timer(self.interval, self.function, *self.args, timeout=self.timeout, policy=self.policy, **self.kwargs)
         new_timer.use_thread = False
+        new_timer._on_stop = self._on_stop
+        # Shared with the process
+        new_timer._stats = Array('d', 4)
+        new_timer._stats_lock = new_timer._stats.get_lock()
         return new_timer
 
+    @property
+    def is_running(self):
+        return self._worker is not None and self._worker.is_alive()
+
     def start(self):
         if not self.is_running:
             if self.use_thread:
-                self._timer = PythonTimer(self.interval, self._timer)
-                self._timer.start()
+                self._stop = ThreadEvent()
+                self._worker = Thread(target=self._run, args=(self._stop,), daemon=True)
             else:
-                self._processor = Process(target=self._process)
-                self._processor.start()
-            self.is_running = True
+                self._stop = Event()
+                self._worker = Process(target=self._run, args=(self._stop,))
+            self._worker.start()
 
     def stop(self):
-        if ((self.use_thread and self._timer) or (not self.use_thread and self._processor)) and self.is_running:
+        if self.is_running:
+            self._stop.set()
+            timeout = self.interval + (Timer.STOP_TIMEOUT_S if self._on_stop else 0)
             if self.use_thread:
-                self._timer.cancel()
+                # The function may stop its own timer
+                if self._worker is not current_thread():
+                    self._worker.join(timeout)
             else:
-                self._processor.terminate()
-            self.is_running = False
+                self._worker.join(timeout)
+                if self._worker.is_alive():
+                    self._worker.terminate()
 
     def toggle(self):
         if self.is_running:
             self.stop()
         else:
             self.start()
-    
+
+    def on_stop(self, callback):
+        """
+        Calls callback in the timer's thread or process once it stops, such as to flush what the function left
+        buffered there. stop() waits for it.
+        """
+        self._on_stop = callback
+        return self
+
     def on_kill(self, callback):
         self._on_kill = callback
         return self
@@ -71,3 +145,21 @@ class Timer(object):
         self.stop()
         if self._on_kill:
             self._on_kill()
+
+    def stats(self):
+        """
+        :return: A dict of ticks run, deadlines missed, and the mean and max lateness of the ticks in ms.
+        """
+        with self._stats_lock:
+            ticks, missed, lateness, max_lateness = self._stats[:]
+        return {
+            'ticks': int(ticks),
+            'missed': int(missed),
+            'mean_lateness_ms': lateness / ticks * 1000 if ticks > 0 else 0.,
+            'max_lateness_ms': max_lateness * 1000
+        }
+
+    def report(self):
+        stats = self.stats()
+        return 'Timer: %d ticks, %d missed deadlines, lateness %.2f ms mean, %.2f ms max' % (
+            stats['ticks'], stats['missed'], stats['mean_lateness_ms'], stats['max_lateness_ms'])